@@ -3,32 +3,224 @@ bon-soleil RAG Service
 ChromaDB + FastAPI — 完全黒箱RAGコンテナ
 
 API:
-  POST /ingest          { text, metadata?, collection?, doc_id? }
-  POST /ingest/batch    [{ text, metadata?, collection?, doc_id? }]
-  POST /search          { query, n?, collection?, where? }
-  GET  /collections
-  GET  /documents       ?collection=xxx&limit=50&offset=0
+  POST /ingest          { text, metadata?, collection?, doc_id?, chunk?, chunk_size?, chunk_overlap?, embedding? }
+  POST /ingest/batch    [{ text, metadata?, collection?, doc_id?, chunk?, ... }]  ?batch_size=64
+  POST /ingest/jobs     [{ text, ... }]  ?batch_size=64  → 202 { id, status, ... }
+  GET  /ingest/jobs
+  GET  /ingest/jobs/{id}
+  DELETE /ingest/jobs/{id}
+  POST /search          { query?, embedding?, n?, collection?, where?, collapse?, mode?, diversify?, mmr_lambda?, dedup_threshold? }
+  POST /search/batch    [{ query, n?, collection?, where?, ... }]
+  POST /search/federated { query?, embedding?, collections: [...], n?, where?, collapse?, mode?, normalize? }
+  GET  /health          プロセスが応答するか
+  GET  /ready           ウォームアップ済みか（未完了・失敗は503）
+  GET  /stats
+  GET  /metrics         Prometheus text format
+  GET  /collections      ?refresh=false
+  POST /collections     { name, hnsw?: { M?, construction_ef?, search_ef?, ... } }
+  GET  /collections/{name}/hnsw
+  PUT  /collections/{name}/hnsw { search_ef }
+  GET  /documents       ?collection=xxx&limit=50&offset=0  (or &cursor=) &fields=metadata,text&snippet=
+  GET  /export          ?collection=xxx&fields=metadata,text  → NDJSON stream
   GET  /document/{id}   ?collection=xxx
   PUT  /document/{id}   { text?, metadata?, collection? }
   DELETE /document/{id} ?collection=xxx
+  DELETE /documents     { ids?, where?, collection?, dry_run? }
+  POST /dedup/jobs      { collection?, threshold?, method?, k?, action?, keep_by? }  → 202 { id, status, ... }
+  GET  /dedup/jobs
+  GET  /dedup/jobs/{id} ?limit=20
+  GET  /dedup/jobs/{id}/clusters  → NDJSON stream
+  DELETE /dedup/jobs/{id}
+  GET  /sync
+  POST /sync            ?source=xxx
   DELETE /collection    { collection }
+  GET  /snapshots
+  POST /snapshot/export { collection, name?, dtype? }
+  POST /snapshot/import { name, collection?, force? }
+  GET  /quantized/report ?collection=xxx&k=10&samples=50
 """
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Any
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Optional, Any, Literal
+from chromadb.api.types import validate_metadata
+from chromadb.config import Settings
+from chromadb.utils import embedding_functions
+from batching import MicroBatcher
+from cache import EmbeddingCache, ResultCache
+from chroma_hnsw import UnsupportedChromaVersion, hnsw_params, set_search_ef, to_metadata
+from chroma_sqlite import ChromaSQLite
+from chunking import chunk_id, chunk_text, collapse_hits
+from diversify import drop_near_duplicates, mmr
+from lazy_index import LazyIndexes
+from lexical import LexicalIndex
+from metadata_index import FilterPlanner, MetadataIndex, evaluable, matches
+from metrics import Metrics, MetricsMiddleware, stage
+from quantized import QuantizedIndex, exact_topk, normalize, row_bytes, topk
+from snapshot import SnapshotError, export_collection, import_snapshot, read_manifest
+from executors import BoundedExecutor, Overloaded, offload
+from fs_sync import DirectorySync, SyncSourceNotFound, load_sources
+from jobs import IngestJobs, JobNotFound
+from near_dups import DedupJobNotFound, NearDuplicateJobs
+from startup import Startup
+from registry import CollectionRegistry
 import chromadb
+from collections import deque
+from concurrent.futures import Future
+import base64
 import hashlib
+import json
+import logging
 import os
+import re
+import threading
+import time
+
+import numpy as np
 
 app = FastAPI(title="bon-soleil RAG Service", version="1.0.0")
 
+# 起動の段階ごとの所要時間とウォームアップの状態（startup.py、/ready）
+startup = Startup()
+
 # ChromaDB — データはvolumeにマウントされた/data に永続化
 CHROMA_PATH = os.environ.get("CHROMA_PATH", "/data/chroma")
-client = chromadb.PersistentClient(path=CHROMA_PATH)
+with startup.phase("chroma_client"):
+    client = chromadb.PersistentClient(
+        path=CHROMA_PATH,
+        # 既定のテレメトリ実装はスレッドセーフでないので無効化（chroma_telemetry.py）
+        settings=Settings(anonymized_telemetry=False, chroma_product_telemetry_impl="chroma_telemetry.NoProductTelemetry"),
+    )
+# ページング・全件走査用にchroma.sqlite3を読み取り専用で直接引く
+chroma_db = ChromaSQLite(CHROMA_PATH)
 
 DEFAULT_COLLECTION = os.environ.get("DEFAULT_COLLECTION", "default")
 
+# スナップショットの置き場所（既定はCHROMA_PATHと同じvolume内）
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(os.path.dirname(CHROMA_PATH.rstrip("/")), "snapshots"))
+
+# バックグラウンドingestジョブの保存先（既定はCHROMA_PATHと同じvolume内）
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(os.path.dirname(CHROMA_PATH.rstrip("/")), "jobs"))
+
+# ディレクトリ同期のマニフェストの保存先（既定はCHROMA_PATHと同じvolume内）
+SYNC_DIR = os.environ.get("SYNC_DIR", os.path.join(os.path.dirname(CHROMA_PATH.rstrip("/")), "sync"))
+
+# 近似重複検出ジョブの保存先（既定はCHROMA_PATHと同じvolume内）
+DEDUP_DIR = os.environ.get("DEDUP_DIR", os.path.join(os.path.dirname(CHROMA_PATH.rstrip("/")), "dedup"))
+
+# コレクション全件を走査する処理（export・インデックス構築など）で1回に読む件数
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "500"))
+
+# GET /documents の limit の上限
+DOCUMENTS_MAX_LIMIT = int(os.environ.get("DOCUMENTS_MAX_LIMIT", "1000"))
+
+# 一括削除で1回のdeleteにまとめる件数
+DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", "1000"))
+
+# 一括ingest時に1回のembedding/upsertへまとめる件数
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "64"))
+
+# chunk=true でingestした時の分割サイズ（文字数）と重なり
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "50"))
+# collapse=true の検索で親ドキュメント単位にまとめる前に多めに取る倍率
+COLLAPSE_OVERFETCH = int(os.environ.get("COLLAPSE_OVERFETCH", "4"))
+# mode=hybrid でベクトル/語彙それぞれから取る候補数の下限と、RRFの定数k
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "50"))
+RRF_K = int(os.environ.get("RRF_K", "60"))
+# メタデータインデックスで where を絞れない語彙検索で、BM25上位を多めに取ってから where で絞る倍率
+LEXICAL_WHERE_OVERFETCH = int(os.environ.get("LEXICAL_WHERE_OVERFETCH", "10"))
+# diversify / dedup_threshold 指定時に多めに取る候補の倍率
+DIVERSIFY_OVERFETCH = int(os.environ.get("DIVERSIFY_OVERFETCH", "4"))
+# 量子化二次インデックス（int8 / binary、空なら使わない）。件数が QUANTIZED_MIN_DOCS〜QUANTIZED_MAX_DOCS のコレクションで
+# 量子化行列を総当たりして n×QUANTIZED_RESCORE 件の候補を拾い、float32で再スコアする。
+# 総当たりは件数に比例して遅くなるので、HNSWより速い上限（bench.py quantized で測る）を QUANTIZED_MAX_DOCS にする（0なら無制限）
+QUANTIZED_INDEX = os.environ.get("QUANTIZED_INDEX", "")
+QUANTIZED_MIN_DOCS = int(os.environ.get("QUANTIZED_MIN_DOCS", "0"))
+QUANTIZED_MAX_DOCS = int(os.environ.get("QUANTIZED_MAX_DOCS", "1000"))
+QUANTIZED_RESCORE = int(os.environ.get("QUANTIZED_RESCORE", "4"))
+# where検索の候補集合を引くためにインデックスするメタデータキー（カンマ区切り、空なら使わない）。
+# 候補をメモリ上のembedding（METADATA_VECTOR_KIND: float32 / int8 / binary）で総当たりするか、
+# Chromaのフィルタ付き近傍検索にするかは実測の所要時間で選ぶ（まだ測っていない間は候補がMETADATA_BRUTE_FORCE_MAX件以下なら総当たり）
+METADATA_INDEX_KEYS = [k.strip() for k in os.environ.get("METADATA_INDEX_KEYS", "").split(",") if k.strip()]
+METADATA_BRUTE_FORCE_MAX = int(os.environ.get("METADATA_BRUTE_FORCE_MAX", "2000"))
+METADATA_VECTOR_KIND = os.environ.get("METADATA_VECTOR_KIND", "float32")
+# 採点用行列の全コレクション合計の上限（バイト、0なら無制限）。超えるコレクションはChromaのフィルタ付き近傍検索にする
+METADATA_VECTOR_MAX_BYTES = int(os.environ.get("METADATA_VECTOR_MAX_BYTES", "536870912"))
+
+# 新しく作るコレクションのHNSW既定値（空ならChromaの既定: M=16, construction_ef=100, search_ef=10）
+HNSW_DEFAULTS = {
+    key: int(os.environ[env])
+    for key, env in (("hnsw:M", "HNSW_M"), ("hnsw:construction_ef", "HNSW_CONSTRUCTION_EF"), ("hnsw:search_ef", "HNSW_SEARCH_EF"))
+    if os.environ.get(env)
+}
+
+# 起動時のウォームアップ（WARMUP=1 で有効）。モデルの読み込みとダミーのembeddingを行い、
+# WARMUP_COLLECTIONS（カンマ区切り）のコレクションのHNSWインデックスと設定済みの補助インデックスを読み込む。
+# 終わるまで /ready は503を返す。WARMUP_LEXICAL=1 なら語彙インデックスも構築する
+WARMUP = os.environ.get("WARMUP", "0") == "1"
+WARMUP_COLLECTIONS = [c.strip() for c in os.environ.get("WARMUP_COLLECTIONS", "").split(",") if c.strip()]
+WARMUP_LEXICAL = os.environ.get("WARMUP_LEXICAL", "0") == "1"
+
+# embeddingモデルの置き場所（空ならChromaの既定 ~/.cache/chroma/onnx_models）。
+# volume内を指せばコンテナを作り直してもモデルを再ダウンロードしない
+EMBEDDING_MODEL_DIR = os.environ.get("EMBEDDING_MODEL_DIR", "")
+
+# embeddingはサービス側で明示的に呼ぶ（バッチ化・キャッシュのため）
+embedding_fn = embedding_functions.DefaultEmbeddingFunction()
+if EMBEDDING_MODEL_DIR and hasattr(embedding_fn, "DOWNLOAD_PATH"):
+    embedding_fn.DOWNLOAD_PATH = os.path.join(EMBEDDING_MODEL_DIR, embedding_fn.MODEL_NAME)
+
+# クエリembeddingのLRUキャッシュ（TTLは秒、0で無期限）
+query_embedding_cache = EmbeddingCache(
+    maxsize=int(os.environ.get("QUERY_EMBED_CACHE_SIZE", "2048")),
+    ttl=float(os.environ.get("QUERY_EMBED_CACHE_TTL", "3600")),
+)
+
+# /search結果キャッシュ。書き込みでコレクション単位に無効化される（TTLは外部書き込みへの保険）
+search_result_cache = ResultCache(
+    maxsize=int(os.environ.get("SEARCH_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL", "600")),
+)
+
+# 同時検索のクエリembeddingをまとめるマイクロバッチ（SEARCH_MICROBATCH=1 で有効）
+SEARCH_MICROBATCH = os.environ.get("SEARCH_MICROBATCH", "0") == "1"
+
+logger = logging.getLogger("rag_service")
+
+# 用途別の上限付きワーカープール。あふれたら待たせずにRetry-After付きで断る
+RETRY_AFTER_SEC = int(os.environ.get("RETRY_AFTER_SEC", "1"))
+embed_executor = BoundedExecutor(
+    "embed", int(os.environ.get("EMBED_WORKERS", "2")), int(os.environ.get("EMBED_QUEUE", "64")),
+    status_code=503, retry_after=RETRY_AFTER_SEC,
+)
+query_executor = BoundedExecutor(
+    "query", int(os.environ.get("QUERY_WORKERS", "8")), int(os.environ.get("QUERY_QUEUE", "64")),
+    status_code=503, retry_after=RETRY_AFTER_SEC,
+)
+write_executor = BoundedExecutor(
+    "write", int(os.environ.get("WRITE_WORKERS", "2")), int(os.environ.get("WRITE_QUEUE", "16")),
+    status_code=429, retry_after=RETRY_AFTER_SEC,
+)
+# /search/federated がコレクションごとの検索を並行に流すプール（queryプール内から待つのでデッドロックしないよう別にする）
+federated_executor = BoundedExecutor(
+    "federated", int(os.environ.get("FEDERATED_WORKERS", "8")), int(os.environ.get("FEDERATED_QUEUE", "64")),
+    status_code=503, retry_after=RETRY_AFTER_SEC,
+)
+
+# リクエスト・段階ごとの所要時間（/metrics）。SERVER_TIMING=1 でレスポンスに Server-Timing ヘッダーも付ける
+metrics = Metrics(enabled=os.environ.get("METRICS_ENABLED", "1") == "1")
+app.add_middleware(MetricsMiddleware, metrics=metrics, server_timing=os.environ.get("SERVER_TIMING", "0") == "1")
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": str(exc), "pool": exc.pool},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # --- スキーマ ---
 
 class IngestRequest(BaseModel):
@@ -36,16 +228,73 @@ class IngestRequest(BaseModel):
     metadata: Optional[dict[str, Any]] = None
     collection: Optional[str] = None
     doc_id: Optional[str] = None  # 省略時はtext hashから自動生成
+    chunk: bool = False  # trueならサーバー側で分割し "{doc_id}#{i}" のチャンクとして保存
+    chunk_size: Optional[int] = None
+    chunk_overlap: Optional[int] = None
+    embedding: Optional[str] = None  # 計算済みembedding（float32リトルエンディアンのbase64）。あればモデルを通さない
 
 class SearchRequest(BaseModel):
-    query: str
+    query: str = ""  # embedding を渡す vector 検索では省略可
+    embedding: Optional[str] = None  # 計算済みのクエリembedding（float32リトルエンディアンのbase64）
     n: Optional[int] = 5
     collection: Optional[str] = None
     where: Optional[dict] = None  # metadata filter
+    collapse: bool = False  # チャンクのヒットを親ドキュメント単位にまとめる
+    mode: Literal["vector", "lexical", "hybrid"] = "vector"  # hybrid: ベクトルとBM25をRRFで統合
+    diversify: bool = False  # MMRで似た結果ばかりにならないよう並べ替える
+    mmr_lambda: float = Field(0.5, ge=0.0, le=1.0)  # 1に近いほど関連度重視、0に近いほど多様性重視
+    dedup_threshold: Optional[float] = Field(None, gt=0.0, le=1.0)  # これ以上似ている結果は1件に絞る
+
+class FederatedSearchRequest(BaseModel):
+    query: str = ""
+    embedding: Optional[str] = None
+    collections: list[str] = Field(min_length=1)
+    n: Optional[int] = 5
+    where: Optional[dict] = None  # 全コレクションに同じ条件を掛ける
+    collapse: bool = False
+    mode: Literal["vector", "lexical", "hybrid"] = "vector"
+    normalize: Literal["minmax", "zscore", "none"] = "minmax"  # コレクションごとのスコア正規化
+
+class HnswSettings(BaseModel):
+    M: Optional[int] = Field(None, ge=2)  # グラフの次数。大きいほど高recall・高メモリ
+    construction_ef: Optional[int] = Field(None, ge=1)  # 構築時の探索幅
+    search_ef: Optional[int] = Field(None, ge=1)  # 検索時の探索幅（作成後も変更可）
+    num_threads: Optional[int] = Field(None, ge=1)
+    resize_factor: Optional[float] = Field(None, gt=1.0)
+    batch_size: Optional[int] = Field(None, gt=2)
+    sync_threshold: Optional[int] = Field(None, gt=2)
+
+class CreateCollectionRequest(BaseModel):
+    name: str
+    hnsw: Optional[HnswSettings] = None
 
 class DeleteCollectionRequest(BaseModel):
     collection: str
 
+class DeleteDocumentsRequest(BaseModel):
+    collection: Optional[str] = None
+    ids: Optional[list[str]] = None
+    where: Optional[dict] = None  # ids と両方指定した場合は両方に当てはまるものだけ
+    dry_run: bool = False  # trueなら消さずに件数だけ返す
+
+class DedupJobRequest(BaseModel):
+    collection: Optional[str] = None
+    threshold: float = Field(0.95, gt=0.0, le=1.0)  # これ以上似ている組を重複とみなす（コサイン類似度）
+    method: Literal["auto", "exact", "ann"] = "auto"  # auto: DEDUP_EXACT_MAX件以下なら exact
+    k: int = Field(10, ge=1, le=100)  # ann で1件ごとに見る近傍数
+    action: Literal["report", "delete", "merge"] = "report"
+    keep_by: Optional[str] = None  # 残す1件を選ぶメタデータキー（値が最大のもの。省略時は本文が最長のもの）
+
+class SnapshotExportRequest(BaseModel):
+    collection: str
+    name: Optional[str] = None  # 省略時は "{collection}-{UTC時刻}"
+    dtype: str = "float32"  # float32 | float16
+
+class SnapshotImportRequest(BaseModel):
+    name: str
+    collection: Optional[str] = None  # 省略時はスナップショット元のコレクション名
+    force: bool = False  # embeddingモデルが違っても投入する
+
 class UpdateDocumentRequest(BaseModel):
     text: Optional[str] = None
     metadata: Optional[dict[str, Any]] = None
@@ -53,115 +302,1157 @@ class UpdateDocumentRequest(BaseModel):
 
 # --- ヘルパー ---
 
-def get_collection(name: Optional[str] = None):
-    col_name = name or DEFAULT_COLLECTION
+def open_collection(col_name: str, metadata: Optional[dict] = None):
+    """既存ならそのまま開き、なければ metadata（HNSW設定など）付きで作る"""
     return client.get_or_create_collection(
         name=col_name,
-        metadata={"hnsw:space": "cosine"}
+        metadata={"hnsw:space": "cosine", **HNSW_DEFAULTS, **(metadata or {})},
+        embedding_function=embedding_fn,
     )
 
+# コレクションハンドルと件数のキャッシュ（件数はCOUNT_RECONCILE_SEC秒ごとに実数と突き合わせ）
+collections = CollectionRegistry(
+    open_collection,
+    reconcile_interval=float(os.environ.get("COUNT_RECONCILE_SEC", "300")),
+)
+
+def get_collection(name: Optional[str] = None):
+    return collections.get(name or DEFAULT_COLLECTION)
+
+def existing_ids(col, ids: list[str]) -> set[str]:
+    """ids のうち既にコレクションにあるもの"""
+    if not ids:
+        return set()
+    return set(col.get(ids=ids, include=[])["ids"])
+
 def make_id(text: str) -> str:
     return hashlib.sha256(text.encode()).hexdigest()[:16]
 
+def embedding_model_id() -> str:
+    """キャッシュキー用のembeddingモデル識別子"""
+    model = getattr(embedding_fn, "MODEL_NAME", None) or getattr(embedding_fn, "model_name", "")
+    return f"{type(embedding_fn).__name__}:{model}"
+
+def embed_texts(texts: list[str]) -> np.ndarray:
+    """テキスト列をまとめて1回のforward passでembedding"""
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+
+    def run() -> np.ndarray:
+        with stage("embed"):
+            return np.asarray(embedding_fn(texts), dtype=np.float32)
+
+    return embed_executor.call(run)
+
+embed_batcher = MicroBatcher(
+    embed_texts,
+    max_batch=int(os.environ.get("MICROBATCH_MAX_BATCH", "32")),
+    max_wait_ms=float(os.environ.get("MICROBATCH_MAX_WAIT_MS", "5")),
+)
+
+def embed_queries(queries: list[str]) -> list[np.ndarray]:
+    """クエリをembedding。キャッシュにないものだけまとめてモデルに通す"""
+    model_id = embedding_model_id()
+    vectors: list[Optional[np.ndarray]] = [query_embedding_cache.lookup(model_id, q) for q in queries]
+    missing = list(dict.fromkeys(q for q, v in zip(queries, vectors) if v is None))
+    if missing:
+        if SEARCH_MICROBATCH:
+            with stage("embed"):
+                embedded = embed_batcher.submit(missing)
+        else:
+            embedded = embed_texts(missing)
+        fresh = {q: query_embedding_cache.store(model_id, q, e) for q, e in zip(missing, embedded)}
+        vectors = [v if v is not None else fresh[q] for q, v in zip(queries, vectors)]
+    return vectors
+
+def decode_embedding(data: str) -> np.ndarray:
+    """base64（float32リトルエンディアン）の計算済みembeddingを復元する"""
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except ValueError:
+        raise ValueError("embedding is not valid base64")
+    if not raw or len(raw) % 4:
+        raise ValueError("embedding must be a non-empty float32 array")
+    vector = np.frombuffer(raw, dtype="<f4").astype(np.float32)
+    if not np.isfinite(vector).all():
+        raise ValueError("embedding contains NaN or inf")
+    return vector
+
+# コレクションのembedding次元（空のコレクションは記録しない）
+_dims: dict[str, int] = {}
+
+def collection_dim(col) -> Optional[int]:
+    dim = _dims.get(col.name)
+    if dim is None:
+        got = col.get(limit=1, include=["embeddings"])
+        if got["ids"]:
+            dim = _dims[col.name] = len(got["embeddings"][0])
+    return dim
+
+def supplied_embedding(col, data: str, dim: Optional[int] = None) -> np.ndarray:
+    """計算済みembeddingを復元し、次元をコレクション（空なら dim）と突き合わせる。合わなければ ValueError"""
+    vector = decode_embedding(data)
+    expected = collection_dim(col) or dim
+    if expected is not None and len(vector) != expected:
+        raise ValueError(f"embedding dimension {len(vector)} does not match collection {col.name} ({expected})")
+    return vector
+
+def query_vector(col, req: SearchRequest) -> np.ndarray:
+    """検索リクエストのクエリembedding（計算済みが渡されていればそれを使う）"""
+    if req.embedding:
+        return supplied_embedding(col, req.embedding)
+    return embed_queries([req.query])[0]
+
+def invalidate(col_name: str) -> None:
+    """コレクションへの書き込み後に呼ぶ。以降の検索はキャッシュを使わない"""
+    search_result_cache.bump(col_name)
+
+def load_texts(col_name: str):
+    """語彙インデックス構築用に (id, text) をページ単位で読み出す"""
+    col = get_collection(col_name)
+    for ids in chroma_db.iter_id_pages(str(col.id), EXPORT_PAGE_SIZE):
+        got = col.get(ids=ids, include=["documents"])
+        yield from zip(got["ids"], got["documents"])
+
+def load_vectors(col_name: str):
+    """量子化インデックス構築用に (ids, embedding行列) をページ単位で読み出す"""
+    col = get_collection(col_name)
+    for ids in chroma_db.iter_id_pages(str(col.id), EXPORT_PAGE_SIZE):
+        got = col.get(ids=ids, include=["embeddings"])
+        yield got["ids"], np.asarray(got["embeddings"], dtype=np.float32)
+
+def load_metadatas(col_name: str):
+    """メタデータインデックス構築用に (id, metadata) をページ単位で読み出す"""
+    col = get_collection(col_name)
+    for ids in chroma_db.iter_id_pages(str(col.id), EXPORT_PAGE_SIZE):
+        got = col.get(ids=ids, include=["metadatas"])
+        yield from zip(got["ids"], got["metadatas"])
+
+lexical_indexes = LazyIndexes(LexicalIndex, load_texts)
+quantized_indexes = LazyIndexes(lambda: QuantizedIndex(QUANTIZED_INDEX), load_vectors)
+metadata_indexes = LazyIndexes(lambda: MetadataIndex(METADATA_INDEX_KEYS), load_metadatas)
+# where候補の採点用にメモリ上に持つembedding（METADATA_INDEX_KEYS がある時だけ使う）
+candidate_vectors = LazyIndexes(lambda: QuantizedIndex(METADATA_VECTOR_KIND), load_vectors, METADATA_VECTOR_MAX_BYTES)
+filter_planner = FilterPlanner(METADATA_BRUTE_FORCE_MAX)
+
+def candidate_vectors_fit(col, count: int) -> bool:
+    """このコレクションの採点用行列を METADATA_VECTOR_MAX_BYTES 内で持てるか"""
+    dim = collection_dim(col)
+    return dim is not None and candidate_vectors.fits(col.name, count * row_bytes(METADATA_VECTOR_KIND, dim))
+
+def where_candidates(col, where: Optional[dict]) -> tuple[Optional[set[str]], bool]:
+    """(where を満たすidを含む候補集合, 候補集合がそのまま答えか)。メタデータインデックスで絞り込めない時は (None, False)"""
+    if not METADATA_INDEX_KEYS or not where:
+        return None, False
+    with stage("metadata_filter"):
+        index = metadata_indexes.get(col.name)
+        candidates = index.candidates(where)
+        return candidates, candidates is not None and index.covers(where)
+
+# --- 補助インデックスの差分更新（書き込み系から呼ぶ） ---
+
+def index_upserted(col_name: str, records: list[tuple[str, str, Optional[dict]]],
+                   embeddings: Optional[np.ndarray] = None) -> None:
+    """records は (id, text, metadata)。embeddings は records と同じ順の行列（なければ量子化インデックスがある時だけ読み直す）"""
+    index = lexical_indexes.peek(col_name)
+    if index is not None:
+        for doc_id, text, _ in records:
+            index.add(doc_id, text)
+    index_metadata_updated(col_name, [(doc_id, meta) for doc_id, _, meta in records])
+    vector_indexes = [i for i in (quantized_indexes.peek(col_name), candidate_vectors.peek(col_name)) if i is not None]
+    if vector_indexes and records:
+        ids = [doc_id for doc_id, _, _ in records]
+        if embeddings is None:
+            got = get_collection(col_name).get(ids=ids, include=["embeddings"])
+            ids, embeddings = got["ids"], got["embeddings"]
+        for index in vector_indexes:
+            index.upsert(ids, embeddings)
+
+def index_metadata_updated(col_name: str, items: list[tuple[str, Optional[dict]]]) -> None:
+    """メタデータだけの更新（Chromaと同じくキー単位でマージ）"""
+    index = metadata_indexes.peek(col_name)
+    if index is not None:
+        for doc_id, meta in items:
+            index.update(doc_id, meta)
+
+def index_deleted(col_name: str, ids: list[str]) -> None:
+    for index in (lexical_indexes.peek(col_name), metadata_indexes.peek(col_name)):
+        if index is not None:
+            for doc_id in ids:
+                index.remove(doc_id)
+    for index in (quantized_indexes.peek(col_name), candidate_vectors.peek(col_name)):
+        if index is not None:
+            index.remove(ids)
+
+def index_dropped(col_name: str) -> None:
+    _dims.pop(col_name, None)
+    lexical_indexes.drop(col_name)
+    quantized_indexes.drop(col_name)
+    metadata_indexes.drop(col_name)
+    candidate_vectors.drop(col_name)
+
+def chunked(seq: list, size: int):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def expand_item(item: IngestRequest, doc_id: str, meta: dict) -> list[tuple[str, str, dict]]:
+    """ingest対象を (id, text, metadata) のレコード列にする。chunk指定時はチャンクに分割"""
+    if not item.chunk:
+        return [(doc_id, item.text, meta)]
+    pieces = chunk_text(item.text, item.chunk_size or CHUNK_SIZE,
+                        item.chunk_overlap if item.chunk_overlap is not None else CHUNK_OVERLAP)
+    if not pieces:
+        return [(doc_id, item.text, meta)]
+    records = []
+    for i, piece in enumerate(pieces):
+        # upsertはメタデータをキー単位でマージするので、見出しがなくても section を書いて旧版の値を消す
+        chunk_meta = {**meta, "parent_id": doc_id, "chunk_index": i, "chunk_count": len(pieces),
+                      "section": piece["section"] or ""}
+        records.append((chunk_id(doc_id, i), piece["text"], chunk_meta))
+    return records
+
+def item_vector(col, item: IngestRequest, dim: Optional[int] = None) -> Optional[np.ndarray]:
+    """item の計算済みembedding（なければ None）。不正なら ValueError"""
+    if not item.embedding:
+        return None
+    if item.chunk:
+        raise ValueError("embedding cannot be combined with chunk")
+    return supplied_embedding(col, item.embedding, dim)
+
+def embed_in_parallel(batches: list[list[str]]):
+    """バッチを埋め込みプールのワーカー数ぶん並列にembeddingし、入力順に (結果 or 例外) を返す"""
+    def submit(texts: list[str]) -> Future:
+        if texts:
+            return embed_executor.submit(embed_texts, texts)
+        done: Future = Future()  # 全件計算済みのバッチはプールを使わない
+        done.set_result(np.empty((0, 0), dtype=np.float32))
+        return done
+
+    pending: deque = deque()
+    it = iter(batches)
+    for texts in it:
+        pending.append(submit(texts))
+        if len(pending) >= embed_executor.workers:
+            break
+    while pending:
+        fut = pending.popleft()
+        texts = next(it, None)
+        if texts is not None:
+            pending.append(submit(texts))
+        yield fut.exception() or fut.result()
+
+def fetch_existing(col, ids: list[str]) -> dict[str, tuple[str, dict]]:
+    """ids のうち既にあるものの {id: (text, metadata)}"""
+    if not ids:
+        return {}
+    got = col.get(ids=ids, include=["documents", "metadatas"])
+    return {i: (doc, meta or {}) for i, doc, meta in zip(got["ids"], got["documents"], got["metadatas"])}
+
+def upsert_records(col, records: list[tuple[str, str, Optional[dict]]], size: int,
+                   vectors: Optional[dict[str, np.ndarray]] = None) -> tuple[dict[str, str], dict[str, int]]:
+    """size件ずつ並列にembeddingしてupsertする。({失敗id: エラー}, 件数内訳) を返す
+
+    既存と本文が同じレコードはembeddingし直さない（メタデータが変わっていればメタデータだけ更新、
+    同じなら何もしない）。vectors（id → 計算済みembedding）にあるレコードはモデルを通さず、
+    本文が同じでも渡されたembeddingで書き換える。
+    バッチ単位で失敗した場合は1件ずつ投入し直して原因のレコードだけを切り分ける。
+    件数の増減はレジストリに反映する（キャッシュ無効化は呼び出し側で）。
+    """
+    vectors = vectors or {}
+    failed: dict[str, str] = {}
+    written = {"embedded": 0, "metadata_only": 0, "unchanged": 0}
+    to_embed: list[tuple[str, str, Optional[dict]]] = []
+    known: set[str] = set()
+    for batch in chunked(records, size):
+        with stage("fetch_existing"):
+            existing = fetch_existing(col, [rid for rid, _, _ in batch])
+        known.update(existing)
+        meta_only = []
+        for rid, text, meta in batch:
+            if rid in vectors or rid not in existing or existing[rid][0] != text:
+                to_embed.append((rid, text, meta))
+            elif meta and any(existing[rid][1].get(k) != v for k, v in meta.items()):
+                meta_only.append((rid, meta))
+            else:
+                written["unchanged"] += 1
+        if meta_only:
+            # upsertと同じくメタデータはキー単位でマージされる
+            try:
+                col.update(ids=[rid for rid, _ in meta_only], metadatas=[meta for _, meta in meta_only])
+                written["metadata_only"] += len(meta_only)
+                index_metadata_updated(col.name, meta_only)
+            except Exception:
+                for rid, meta in meta_only:
+                    try:
+                        col.update(ids=[rid], metadatas=[meta])
+                        written["metadata_only"] += 1
+                        index_metadata_updated(col.name, [(rid, meta)])
+                    except Exception as e:
+                        failed[rid] = str(e)
+
+    batches = list(chunked(to_embed, size))
+    texts = [[text for rid, text, _ in b if rid not in vectors] for b in batches]
+    for batch, embeddings in zip(batches, embed_in_parallel(texts)):
+        try:
+            if isinstance(embeddings, Exception):
+                raise embeddings
+            if len(embeddings) < len(batch):
+                computed = iter(embeddings)
+                embeddings = np.asarray([vectors[rid] if rid in vectors else next(computed) for rid, _, _ in batch],
+                                        dtype=np.float32)
+            with stage("upsert"):
+                col.upsert(
+                    ids=[rid for rid, _, _ in batch],
+                    embeddings=embeddings,
+                    documents=[text for _, text, _ in batch],
+                    metadatas=[meta or None for _, _, meta in batch],
+                )
+        except Exception:
+            embeddings = None  # 1件ずつの投入はChroma側でembeddingする（計算済みのものはそれを使う）
+            for rid, text, meta in batch:
+                try:
+                    supplied = {"embeddings": [vectors[rid]]} if rid in vectors else {}
+                    col.upsert(ids=[rid], documents=[text], metadatas=[meta or None], **supplied)
+                except Exception as e:
+                    failed[rid] = str(e)
+        with stage("index_update"):
+            index_upserted(col.name, [r for r in batch if r[0] not in failed], embeddings)
+        written["embedded"] += sum(1 for rid, _, _ in batch if rid not in failed)
+        collections.adjust(col.name, sum(1 for rid, _, _ in batch if rid not in known and rid not in failed))
+    return failed, written
+
+def drop_stale_chunks(col, keep: dict[str, list[str]]) -> int:
+    """再ingestで不要になった旧チャンク（と分割前の同じidの文書）を消す
+
+    keep は 親id → 今回書いたレコードid。チャンク分割しない再ingestでも呼ぶ（前回分割した時のチャンクを消す）。
+    """
+    keep_ids = {rid for rids in keep.values() for rid in rids}
+    stale = []
+    for parents in chunked(list(keep), client.get_max_batch_size()):
+        found = col.get(where={"parent_id": {"$in": parents}}, include=[])["ids"]
+        stale += [i for i in found if i not in keep_ids]
+    stale += list(existing_ids(col, [parent_id for parent_id in keep if parent_id not in keep_ids]))
+    if stale:
+        col.delete(ids=stale)
+        collections.adjust(col.name, -len(stale))
+        index_deleted(col.name, stale)
+    return len(stale)
+
 # --- エンドポイント ---
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok", "chroma_path": CHROMA_PATH}
 
+@app.get("/ready")
+async def ready():
+    """ウォームアップが済んでいれば200。起動中・ウォームアップ中・失敗時は503（ロードバランサ・オーケストレータ向け）"""
+    return JSONResponse(status_code=200 if startup.ready else 503, content=startup.status())
+
+@app.get("/stats")
+async def stats():
+    return {
+        "embedding_model": embedding_model_id(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "search_result_cache": search_result_cache.stats(),
+        "collections": collections.stats(),
+        "lexical_indexes": lexical_indexes.stats(),
+        "quantized_indexes": {"kind": QUANTIZED_INDEX or None, "min_docs": QUANTIZED_MIN_DOCS,
+                              "max_docs": QUANTIZED_MAX_DOCS,
+                              "collections": quantized_indexes.stats()},
+        "metadata_indexes": {"keys": METADATA_INDEX_KEYS, "brute_force_max": METADATA_BRUTE_FORCE_MAX,
+                             "collections": metadata_indexes.stats(), "vectors": candidate_vectors.stats(),
+                             "vector_bytes": candidate_vectors.nbytes(), "vector_max_bytes": METADATA_VECTOR_MAX_BYTES,
+                             "planner": filter_planner.stats()},
+        "microbatch": {"enabled": SEARCH_MICROBATCH, **embed_batcher.stats()},
+        "executors": {e.name: e.stats() for e in (embed_executor, query_executor, write_executor, federated_executor)},
+        "ingest_jobs": ingest_jobs.stats(),
+        "startup": startup.status(),
+    }
+
+metrics.describe("rag_request_duration_seconds", "histogram", "Request latency by endpoint (until response start)")
+metrics.describe("rag_requests_total", "counter", "Requests by endpoint and status")
+metrics.describe("rag_stage_duration_seconds", "histogram", "Per-request time spent in each stage")
+
+@metrics.collector
+def service_metrics():
+    caches = {"query_embedding": query_embedding_cache.stats(), "search_result": search_result_cache.stats()}
+    executors = {e.name: e.stats() for e in (embed_executor, query_executor, write_executor, federated_executor)}
+    batcher = embed_batcher.stats()
+    aux = {"lexical": lexical_indexes.stats(), "quantized": quantized_indexes.stats(), "metadata": metadata_indexes.stats(),
+           "candidate_vectors": candidate_vectors.stats()}
+    yield ("rag_cache_hits_total", "counter", "Cache hits",
+           [({"cache": name}, c["hits"]) for name, c in caches.items()])
+    yield ("rag_cache_misses_total", "counter", "Cache misses",
+           [({"cache": name}, c["misses"]) for name, c in caches.items()])
+    yield ("rag_cache_evictions_total", "counter", "Cache evictions",
+           [({"cache": name}, c["evictions"]) for name, c in caches.items()])
+    yield ("rag_cache_hit_ratio", "gauge", "Cache hit ratio since start",
+           [({"cache": name}, c["hit_rate"]) for name, c in caches.items()])
+    yield ("rag_cache_entries", "gauge", "Cache entries",
+           [({"cache": name}, c["size"]) for name, c in caches.items()])
+    yield ("rag_executor_in_flight", "gauge", "Running + queued tasks per pool",
+           [({"pool": name}, e["in_flight"]) for name, e in executors.items()])
+    yield ("rag_executor_capacity", "gauge", "workers + max queue per pool",
+           [({"pool": name}, e["limit"]) for name, e in executors.items()])
+    yield ("rag_executor_completed_total", "counter", "Completed tasks per pool",
+           [({"pool": name}, e["completed"]) for name, e in executors.items()])
+    yield ("rag_executor_rejected_total", "counter", "Tasks rejected with 429/503 per pool",
+           [({"pool": name}, e["rejected"]) for name, e in executors.items()])
+    yield ("rag_microbatch_batches_total", "counter", "Query embedding micro-batches", [({}, batcher["batches"])])
+    yield ("rag_microbatch_items_total", "counter", "Queries embedded via micro-batches", [({}, batcher["items"])])
+    yield ("rag_microbatch_queued", "gauge", "Queries waiting for a micro-batch", [({}, batcher["queued"])])
+    yield ("rag_ingest_jobs", "gauge", "Background ingest jobs by status",
+           [({"status": status}, n) for status, n in ingest_jobs.stats()["by_status"].items()])
+    yield ("rag_collection_documents", "gauge", "Documents per collection (registry count)",
+           [({"collection": name}, n) for name, n in collections.stats()["counts"].items()])
+    yield ("rag_index_documents", "gauge", "Documents held by auxiliary in-memory indexes",
+           [({"index": kind, "collection": name}, st["documents"]) for kind, cols in aux.items() for name, st in cols.items()])
+    yield ("rag_index_bytes", "gauge", "Quantized / candidate vector index size in bytes",
+           [({"index": kind, "collection": name}, st["bytes"])
+            for kind in ("quantized", "candidate_vectors") for name, st in aux[kind].items()])
+    boot = startup.status()
+    yield ("rag_ready", "gauge", "1 once startup and warm-up have finished", [({}, int(startup.ready))])
+    yield ("rag_startup_phase_seconds", "gauge", "Time spent in each startup phase",
+           [({"phase": p["name"]}, p["seconds"]) for p in boot["phases"]])
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/collections")
-def list_collections():
+def list_collections(refresh: bool = False):
+    """refresh=true で保持している件数を実数と突き合わせ直す"""
     cols = client.list_collections()
+    count = collections.reconcile if refresh else collections.count
     return {
         "collections": [
-            {"name": c.name, "count": c.count()}
+            {"name": c.name, "count": count(c.name)}
             for c in cols
         ]
     }
 
+def collection_exists(name: str) -> bool:
+    return any(c.name == name for c in client.list_collections())
+
+@app.post("/collections", status_code=201)
+@offload(write_executor)
+def create_collection(req: CreateCollectionRequest):
+    """HNSWパラメータを指定してコレクションを作る（未指定の項目は HNSW_* 環境変数 → Chromaの既定値）"""
+    if collection_exists(req.name):
+        raise HTTPException(status_code=409, detail=f"collection already exists: {req.name}")
+    try:
+        col = open_collection(req.name, to_metadata(req.hnsw.model_dump()) if req.hnsw else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"name": col.name, "hnsw": hnsw_params(client, col)}
+
+@app.get("/collections/{name}/hnsw")
+def get_collection_hnsw(name: str):
+    if not collection_exists(name):
+        raise HTTPException(status_code=404, detail=f"collection not found: {name}")
+    return {"name": name, "hnsw": hnsw_params(client, get_collection(name))}
+
+@app.put("/collections/{name}/hnsw")
+@offload(write_executor)
+def update_collection_hnsw(name: str, req: HnswSettings):
+    """search_ef だけは作成後も変えられる（即時反映・永続化）。M などはコレクションの作り直しが要る"""
+    if not collection_exists(name):
+        raise HTTPException(status_code=404, detail=f"collection not found: {name}")
+    fixed = sorted(k for k, v in req.model_dump().items() if v is not None and k != "search_ef")
+    if fixed:
+        raise HTTPException(status_code=400, detail=f"{fixed} cannot be changed after creation; "
+                                                    "rebuild the collection with tune_hnsw.py --apply")
+    if req.search_ef is None:
+        raise HTTPException(status_code=400, detail="search_ef is required")
+    try:
+        set_search_ef(client, get_collection(name), req.search_ef)
+    except UnsupportedChromaVersion as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    collections.drop(name)  # ハンドルのメタデータを読み直す
+    invalidate(name)
+    return {"name": name, "hnsw": hnsw_params(client, get_collection(name))}
+
 @app.post("/ingest")
+@offload(write_executor)
 def ingest(req: IngestRequest):
+    """本文が既存と同じならembeddingし直さない（メタデータだけ更新 or 何もしない）"""
     col = get_collection(req.collection)
     doc_id = req.doc_id or make_id(req.text)
     meta = req.metadata or {}
+    try:
+        vector = item_vector(col, req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    col.upsert(
-        ids=[doc_id],
-        documents=[req.text],
-        metadatas=[meta]
-    )
-    return {"id": doc_id, "collection": col.name, "status": "ok"}
+    records = expand_item(req, doc_id, meta)
+    try:
+        failed, written = upsert_records(col, records, INGEST_BATCH_SIZE,
+                                         {doc_id: vector} if vector is not None else None)
+        if failed:
+            raise HTTPException(status_code=400, detail=next(iter(failed.values())))
+        drop_stale_chunks(col, {doc_id: [rid for rid, _, _ in records]})
+    finally:
+        # 途中で失敗（埋め込みプールの満杯など）しても、それまでに書いた分があるのでキャッシュは捨てる
+        invalidate(col.name)
+    response = {"id": doc_id, "collection": col.name, "status": "ok", "written": written}
+    if req.chunk:
+        response["chunks"] = len(records)
+    return response
 
 @app.post("/ingest/batch")
-def ingest_batch(items: list[IngestRequest]):
-    """複数ドキュメントを一括ingest"""
-    results = []
-    for item in items:
-        col = get_collection(item.collection)
+@offload(write_executor)
+def ingest_batch(items: list[IngestRequest], batch_size: Optional[int] = None):
+    return ingest_items(items, batch_size)
+
+def ingest_items(items: list[IngestRequest], batch_size: Optional[int] = None) -> dict:
+    """複数ドキュメントを一括ingest（/ingest/batch とバックグラウンドジョブの本体）
+
+    コレクションごとにまとめ、batch_size件ずつ1回のembedding + 1回のupsertで投入する。
+    チャンク単位で失敗した場合は1件ずつ投入し直して、失敗したitemだけをerrorsに返す。
+    """
+    started = time.perf_counter()
+    size = max(1, min(batch_size or INGEST_BATCH_SIZE, client.get_max_batch_size()))
+
+    # コレクションごとにグルーピング（同一idは後勝ち）
+    groups: dict[str, dict[str, tuple[str, dict, list[int]]]] = {}
+    vectors: dict[str, dict[str, np.ndarray]] = {}  # collection → id → 計算済みembedding
+    dims: dict[str, int] = {}  # 空のコレクションに計算済みembeddingを入れる時の次元（最初のitemに揃える）
+    parents: dict[int, tuple[str, str, list[str]]] = {}  # item index → (collection, doc_id, レコードid)
+    errors = []
+    for idx, item in enumerate(items):
+        col_name = item.collection or DEFAULT_COLLECTION
         doc_id = item.doc_id or make_id(item.text)
         meta = item.metadata or {}
-        col.upsert(ids=[doc_id], documents=[item.text], metadatas=[meta])
-        results.append({"id": doc_id, "collection": col.name})
-    return {"ingested": len(results), "items": results}
+        try:
+            if meta:
+                validate_metadata(meta)
+            vector = item_vector(get_collection(col_name), item, dims.get(col_name)) if item.embedding else None
+        except ValueError as e:
+            errors.append({"index": idx, "id": doc_id, "collection": col_name, "error": str(e)})
+            continue
+        group = groups.setdefault(col_name, {})
+        group_vectors = vectors.setdefault(col_name, {})
+        records = expand_item(item, doc_id, meta)
+        for rid, text, rmeta in records:
+            prev = group.pop(rid, None)
+            group[rid] = (text, rmeta, (prev[2] if prev else []) + [idx])
+            if vector is not None:
+                group_vectors[rid] = vector
+                dims.setdefault(col_name, len(vector))
+            else:
+                group_vectors.pop(rid, None)
+        parents[idx] = (col_name, doc_id, [rid for rid, _, _ in records])
 
-@app.post("/search")
-def search(req: SearchRequest):
-    col = get_collection(req.collection)
-    if col.count() == 0:
-        return {"results": [], "collection": col.name, "total": 0}
+    done: dict[int, dict] = {}
+    written = {"embedded": 0, "metadata_only": 0, "unchanged": 0}
+    for col_name, group in groups.items():
+        indices = sorted({idx for _, _, idxs in group.values() for idx in idxs})
+        try:
+            col = get_collection(col_name)
+        except Exception as e:
+            errors.extend({"index": idx, "id": parents[idx][1], "collection": col_name, "error": str(e)} for idx in indices)
+            continue
+        try:
+            failed, col_written = upsert_records(col, [(rid, text, meta) for rid, (text, meta, _) in group.items()],
+                                                 size, vectors.get(col_name))
+            for k, v in col_written.items():
+                written[k] += v
+            keep: dict[str, list[str]] = {}
+            for idx in indices:
+                _, doc_id, rids = parents[idx]
+                errs = [failed[rid] for rid in rids if rid in failed]
+                if errs:
+                    errors.append({"index": idx, "id": doc_id, "collection": col.name, "error": errs[0]})
+                    continue
+                done[idx] = {"id": doc_id, "collection": col.name}
+                if items[idx].chunk:
+                    done[idx]["chunks"] = len(rids)
+                keep[doc_id] = rids  # 同じ親が複数回来た場合は最後のitemのレコード構成を正とする
+            drop_stale_chunks(col, keep)
+        finally:
+            # 途中で失敗（埋め込みプールの満杯など）しても、それまでに書いた分があるのでキャッシュは捨てる
+            invalidate(col.name)
 
-    kwargs = {
-        "query_texts": [req.query],
-        "n_results": min(req.n or 5, col.count()),
-        "include": ["documents", "metadatas", "distances"]
+    elapsed = time.perf_counter() - started
+    results = [done[idx] for idx in sorted(done)]
+    logger.info("ingest_batch: %d docs in %.3fs (%.1f docs/s, batch_size=%d, errors=%d, embedded=%d, metadata_only=%d, unchanged=%d)",
+                len(results), elapsed, len(results) / elapsed if elapsed else 0.0, size, len(errors),
+                written["embedded"], written["metadata_only"], written["unchanged"])
+    return {
+        "ingested": len(results),
+        "items": results,
+        "errors": sorted(errors, key=lambda e: e["index"]),
+        "written": written,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "docs_per_sec": round(len(results) / elapsed, 1) if elapsed else None,
     }
-    if req.where:
-        kwargs["where"] = req.where
 
-    res = col.query(**kwargs)
+ingest_jobs = IngestJobs(
+    JOBS_DIR,
+    lambda items, batch_size: ingest_items([IngestRequest(**item) for item in items], batch_size),
+    workers=int(os.environ.get("JOB_WORKERS", "1")),
+    slice_size=int(os.environ.get("JOB_SLICE_SIZE", "256")),
+)
+with startup.phase("ingest_jobs"):
+    ingest_jobs.start()
+
+@app.post("/ingest/jobs", status_code=202)
+def submit_ingest_job(items: list[IngestRequest], batch_size: Optional[int] = None):
+    """itemsを保存してすぐにジョブidを返す。処理はバックグラウンドのワーカーが行う"""
+    return ingest_jobs.submit([item.model_dump(exclude_none=True) for item in items], batch_size)
+
+@app.get("/ingest/jobs")
+def list_ingest_jobs():
+    return {"jobs": ingest_jobs.all(), **ingest_jobs.stats()}
+
+@app.get("/ingest/jobs/{job_id}")
+def get_ingest_job(job_id: str):
+    try:
+        return ingest_jobs.status(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=f"job not found: {job_id}")
+
+@app.delete("/ingest/jobs/{job_id}")
+def cancel_ingest_job(job_id: str):
+    """未完了のジョブを取り消す（処理済みのスライスは戻さない）"""
+    try:
+        return ingest_jobs.cancel(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=f"job not found: {job_id}")
+
+def search_cache_key(col_name: str, req: SearchRequest) -> tuple:
+    # 世代は検索前に読む（検索中の書き込みで古い結果が新世代に載らないように）
+    return search_result_cache.make_key(
+        col_name, search_result_cache.generation(col_name), req.model_dump(exclude={"collection"})
+    )
 
+def fetch_n(req: SearchRequest) -> int:
+    """近傍検索で取る件数（collapse時は親単位にまとめる分を多めに取る）"""
+    n = req.n or 5
+    return n * COLLAPSE_OVERFETCH if req.collapse else n
+
+def candidate_n(req: SearchRequest) -> int:
+    """検索エンジンから取る候補数（多様化・重複除去する分はさらに多めに取る）"""
+    n = fetch_n(req)
+    return n * DIVERSIFY_OVERFETCH if req.diversify or req.dedup_threshold is not None else n
+
+def diversify_hits(col, req: SearchRequest, hits: list[dict], embeddings: dict[str, Any]) -> list[dict]:
+    """候補をMMRで並べ替え / 近似重複を除去して fetch_n(req) 件にする"""
+    missing = [h["id"] for h in hits if h["id"] not in embeddings]
+    if missing:
+        with stage("fetch_candidates"):
+            got = col.get(ids=missing, include=["embeddings"])
+        embeddings.update(zip(got["ids"], got["embeddings"]))
+    hits = [h for h in hits if h["id"] in embeddings]
+    if not hits:
+        return hits
+    query = query_vector(col, req) if req.diversify else None
+    with stage("diversify"):
+        matrix = np.asarray([embeddings[h["id"]] for h in hits], dtype=np.float32)
+        if req.diversify:
+            order = mmr(query, matrix, fetch_n(req), req.mmr_lambda, req.dedup_threshold)
+        else:
+            order = drop_near_duplicates(matrix, req.dedup_threshold)[:fetch_n(req)]
+    return [hits[i] for i in order]
+
+def finalize_hits(hits: list[dict], req: SearchRequest) -> list[dict]:
+    n = req.n or 5
+    return collapse_hits(hits, n) if req.collapse else hits[:n]
+
+def format_hits(res: dict, row: int, n: Optional[int] = None) -> list[dict]:
+    """col.query結果のrow番目のクエリ分をAPIレスポンス形式に変換"""
     results = []
-    for i, doc in enumerate(res["documents"][0]):
+    for i, doc in enumerate(res["documents"][row][:n]):
         results.append({
             "text": doc,
-            "metadata": res["metadatas"][0][i],
-            "score": round(1 - res["distances"][0][i], 4),  # cosine: distance→similarity
-            "id": res["ids"][0][i]
+            "metadata": res["metadatas"][row][i],
+            "score": round(1 - res["distances"][row][i], 4),  # cosine: distance→similarity
+            "id": res["ids"][row][i]
         })
+    return results
 
-    return {
+def quantized_size_ok(count: int) -> bool:
+    return bool(QUANTIZED_INDEX) and count >= QUANTIZED_MIN_DOCS and (not QUANTIZED_MAX_DOCS or count <= QUANTIZED_MAX_DOCS)
+
+def use_quantized(req: SearchRequest, count: int) -> bool:
+    # whereで絞る検索はChroma側のフィルタ付き近傍検索に任せる
+    if req.where:
+        return False
+    if not quantized_size_ok(count):
+        # 上限を超えて育ったコレクションは持っていた量子化行列も捨てる
+        quantized_indexes.drop(req.collection or DEFAULT_COLLECTION)
+        return False
+    return True
+
+def score_candidates(col, queries: list[np.ndarray], ids: list[str], n: int,
+                     embeddings: Optional[dict] = None) -> list[list[dict]]:
+    """候補idのfloat32 embeddingと各クエリのコサイン類似度を総当たりで計算し、クエリごとに上位n件にする"""
+    if not ids:
+        return [[] for _ in queries]
+    with stage("fetch_candidates"):
+        got = col.get(ids=ids, include=["embeddings", "documents", "metadatas"])
+    if not got["ids"]:
+        return [[] for _ in queries]
+    with stage("score_candidates"):
+        matrix = np.asarray(got["embeddings"], dtype=np.float32)
+        scores = normalize(np.asarray(queries, dtype=np.float32)) @ normalize(matrix).T
+    results = []
+    for row in scores:
+        order = np.argsort(-row, kind="stable")[:n]
+        if embeddings is not None:
+            embeddings.update((got["ids"][i], matrix[i]) for i in order)
+        results.append([
+            {"text": got["documents"][i], "metadata": got["metadatas"][i], "score": round(float(row[i]), 4), "id": got["ids"][i]}
+            for i in order
+        ])
+    return results
+
+def quantized_hits(col, req: SearchRequest, n: int, embeddings: Optional[dict] = None) -> list[dict]:
+    """量子化インデックスで n×QUANTIZED_RESCORE 件の候補を拾い、float32で再スコアする"""
+    query = query_vector(col, req)
+    with stage("quantized_scan"):
+        candidates = quantized_indexes.get(col.name).search(query, n * QUANTIZED_RESCORE)
+    return score_candidates(col, [query], [doc_id for doc_id, _ in candidates], n, embeddings=embeddings)[0]
+
+def get_matching(col, ids: list[str], include: list[str], where: Optional[dict]) -> dict:
+    """ids のうち where に当てはまるものを読む（include には metadatas を含めること）
+
+    ids と where を一緒にChromaに渡すと where の判定がコレクション全体を走査して遅いので、
+    メモリ上で判定できる where は読んだメタデータに当てはめる。
+    """
+    local = bool(where) and evaluable(where)
+    kwargs = {"ids": ids, "include": include}
+    if where and not local:
+        kwargs["where"] = where
+    with stage("fetch_candidates"):
+        got = col.get(**kwargs)
+    if not local:
+        return got
+    keep = [i for i, meta in enumerate(got["metadatas"]) if matches(where, meta)]
+    return {key: [got[key][i] for i in keep] for key in ["ids"] + include}
+
+def fetch_ranked(col, ranked: list[list[tuple[str, float]]], n: int, where: Optional[dict] = None,
+                 embeddings: Optional[dict] = None) -> list[list[dict]]:
+    """クエリごとのスコア順の (id, score) 列から、上位n件だけ本文・メタデータを読んでヒットにする
+
+    where を渡すと読んだものを判定し、当てはまらなかった分は続きから読み足す。
+    """
+    include = ["documents", "metadatas"] + (["embeddings"] if embeddings is not None else [])
+    docs: dict[str, tuple] = {}
+    seen: set[str] = set()
+    hits: list[list[dict]] = [[] for _ in ranked]
+    pos = [0] * len(ranked)
+    while True:
+        wanted: dict[int, list[tuple[str, float]]] = {}
+        for qi, rows in enumerate(ranked):
+            missing = n - len(hits[qi])
+            if missing > 0 and pos[qi] < len(rows):
+                step = missing * 2 if where else missing
+                wanted[qi] = rows[pos[qi]:pos[qi] + step]
+                pos[qi] += step
+        if not wanted:
+            return hits
+        ids = list(dict.fromkeys(doc_id for rows in wanted.values() for doc_id, _ in rows if doc_id not in seen))
+        if ids:
+            got = get_matching(col, ids, include, where)
+            seen.update(ids)
+            for i, doc_id in enumerate(got["ids"]):
+                docs[doc_id] = (got["documents"][i], got["metadatas"][i],
+                                got["embeddings"][i] if embeddings is not None else None)
+        for qi, rows in wanted.items():
+            for doc_id, score in rows:
+                if doc_id in docs and len(hits[qi]) < n:
+                    text, meta, vector = docs[doc_id]
+                    hits[qi].append({"text": text, "metadata": meta, "score": round(score, 4), "id": doc_id})
+                    if embeddings is not None:
+                        embeddings[doc_id] = vector
+
+def filtered_hits(col, queries: list[np.ndarray], candidates: set[str], exact: bool, n: int,
+                  where: Optional[dict], embeddings: Optional[dict] = None) -> list[list[dict]]:
+    """where の候補をメモリ上のembeddingで総当たりし、上位だけ本文・メタデータを読む
+
+    exact（候補集合がそのまま答え）なら where の判定はしない。
+    """
+    index = candidate_vectors.get(col.name)
+    started = time.perf_counter()
+    with stage("score_candidates"):
+        ids, scores = index.score(np.asarray(queries, dtype=np.float32), candidates)
+        ranked = []
+        for row in scores:
+            order = topk(row, n if exact else len(row))
+            ranked.append([(ids[i], float(row[i])) for i in order])
+    scored = time.perf_counter()
+    hits = fetch_ranked(col, ranked, n, None if exact else where, embeddings)
+    filter_planner.record_brute_force(col.name, scored - started, len(candidates), time.perf_counter() - scored)
+    return hits
+
+def vector_hits(col, req: SearchRequest, n: int, count: int, embeddings: Optional[dict] = None) -> list[dict]:
+    """embeddings を渡すと候補のembeddingも {id: vector} で詰めて返す"""
+    candidates, exact = where_candidates(col, req.where)
+    if (candidates is not None and candidate_vectors_fit(col, count)
+            and filter_planner.choose(col.name, len(candidates)) == "brute_force"):
+        # 絞り込まれた候補だけをメモリ上で総当たり（取りこぼしがない）
+        return filtered_hits(col, [query_vector(col, req)], candidates, exact, n, req.where, embeddings)[0]
+    if use_quantized(req, count):
+        return quantized_hits(col, req, n, embeddings)
+    kwargs = {
+        "query_embeddings": [query_vector(col, req)],
+        "n_results": min(n, count),
+        "include": ["documents", "metadatas", "distances"]
+    }
+    if embeddings is not None:
+        kwargs["include"].append("embeddings")
+    if req.where:
+        kwargs["where"] = req.where
+    started = time.perf_counter()
+    with stage("vector_query"):
+        res = col.query(**kwargs)
+    if candidates is not None:
+        filter_planner.record_ann(col.name, time.perf_counter() - started)
+    if embeddings is not None:
+        embeddings.update(zip(res["ids"][0], res["embeddings"][0]))
+    return format_hits(res, 0)
+
+def lexical_docs(col, ranked: list[tuple[str, float]], where: Optional[dict]) -> list[dict]:
+    """BM25の (id, score) 列を本文・メタデータ付きのヒットにする（where に当てはまらないものは落ちる）"""
+    if not ranked:
+        return []
+    got = get_matching(col, [doc_id for doc_id, _ in ranked], ["documents", "metadatas"], where)
+    docs = {doc_id: (text, meta) for doc_id, text, meta in zip(got["ids"], got["documents"], got["metadatas"])}
+    return [
+        {"text": docs[doc_id][0], "metadata": docs[doc_id][1], "score": round(score, 4), "id": doc_id}
+        for doc_id, score in ranked if doc_id in docs
+    ]
+
+def lexical_hits(col, req: SearchRequest, n: int) -> list[dict]:
+    """語彙インデックスのBM25上位n件
+
+    where はメタデータインデックスの候補だけを採点するか、LEXICAL_WHERE_OVERFETCH 倍取ってから絞る。
+    絞った結果がn件に足りず、まだ続きがありうる時は where に当てはまるidを引いて、それだけを採点し直す。
+    """
+    index = lexical_indexes.get(col.name)
+    candidates, exact = where_candidates(col, req.where)
+    k = n * LEXICAL_WHERE_OVERFETCH if req.where and candidates is None else n
+    with stage("lexical"):
+        ranked = index.search(req.query, k, allowed=candidates)
+    hits = lexical_docs(col, ranked, None if exact else req.where)
+    if req.where and len(hits) < n and len(ranked) == k:
+        with stage("fetch_existing"):
+            allowed = col.get(where=req.where, include=[])["ids"]
+        with stage("lexical"):
+            ranked = index.search(req.query, n, allowed=allowed)
+        hits = lexical_docs(col, ranked, req.where)
+    return hits[:n]
+
+def fuse_rrf(vector: list[dict], lexical: list[dict]) -> list[dict]:
+    """Reciprocal Rank Fusion: score = Σ 1 / (RRF_K + rank)"""
+    fused: dict[str, dict] = {}
+    for key, hits in (("vector_score", vector), ("lexical_score", lexical)):
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit["id"], {**hit, "score": 0.0, "vector_score": None, "lexical_score": None})
+            entry["score"] += 1 / (RRF_K + rank)
+            entry[key] = hit["score"]
+    for entry in fused.values():
+        entry["score"] = round(entry["score"], 6)
+    return sorted(fused.values(), key=lambda h: h["score"], reverse=True)
+
+def validate_query(col, req: SearchRequest) -> Optional[np.ndarray]:
+    """query / embedding の指定を検証し、計算済みembeddingがあれば復元して返す"""
+    if req.mode != "vector" and not req.query:
+        raise HTTPException(status_code=400, detail=f"query is required for mode={req.mode}")
+    if not req.embedding:
+        if not req.query:
+            raise HTTPException(status_code=400, detail="query or embedding is required")
+        return None
+    try:
+        return supplied_embedding(col, req.embedding)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def run_search(req: SearchRequest) -> dict:
+    col = get_collection(req.collection)
+    validate_query(col, req)
+    cache_key = search_cache_key(col.name, req)
+    cached = search_result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    with stage("count"):
+        count = collections.count(col.name)
+    if count == 0:
+        return {"results": [], "collection": col.name, "total": 0}
+
+    reorder = req.diversify or req.dedup_threshold is not None
+    embeddings: Optional[dict] = {} if reorder else None
+    if req.mode == "lexical":
+        hits = lexical_hits(col, req, candidate_n(req))
+    elif req.mode == "hybrid":
+        m = max(candidate_n(req), HYBRID_CANDIDATES)
+        hits = fuse_rrf(vector_hits(col, req, m, count, embeddings), lexical_hits(col, req, m))
+    else:
+        hits = vector_hits(col, req, candidate_n(req), count, embeddings)
+    if reorder:
+        hits = diversify_hits(col, req, hits, embeddings)
+    results = finalize_hits(hits, req)
+
+    response = {
         "results": results,
         "collection": col.name,
         "total": len(results)
     }
+    search_result_cache.put(cache_key, response)
+    return response
+
+@app.post("/search")
+@offload(query_executor)
+def search(req: SearchRequest):
+    return run_search(req)
+
+@app.post("/search/batch")
+@offload(query_executor)
+def search_batch(reqs: list[SearchRequest]):
+    """複数クエリを一括検索
+
+    キャッシュにないクエリをまとめて1回でembeddingし、(collection, where) ごとに
+    1回のcol.queryへ複数のquery_embeddingsとして渡す。結果はリクエスト順に返す。
+    """
+    responses: list[Optional[dict]] = [None] * len(reqs)
+    pending: dict[str, list[tuple[int, tuple]]] = {}
+    cols = {}
+    supplied: dict[int, np.ndarray] = {}  # 計算済みembeddingが渡されたリクエスト
+    for idx, req in enumerate(reqs):
+        col_name = req.collection or DEFAULT_COLLECTION
+        try:
+            if col_name not in cols:
+                cols[col_name] = get_collection(col_name)
+            if req.mode != "vector" or req.diversify or req.dedup_threshold is not None \
+                    or use_quantized(req, collections.count(col_name)):
+                # 語彙/ハイブリッド/多様化/量子化インデックス経由は1件ずつ
+                responses[idx] = run_search(req)
+                continue
+            vector = validate_query(cols[col_name], req)
+            if vector is not None:
+                supplied[idx] = vector
+        except Exception as e:
+            responses[idx] = {"results": [], "collection": col_name, "total": 0, "error": str(e)}
+            continue
+        cache_key = search_cache_key(col_name, req)
+        cached = search_result_cache.get(cache_key)
+        if cached is not None:
+            responses[idx] = cached
+        else:
+            pending.setdefault(col_name, []).append((idx, cache_key))
+
+    with stage("count"):
+        counts = {col_name: collections.count(col_name) for col_name in pending}
+    indices = [idx for col_name, entries in pending.items() if counts[col_name] for idx, _ in entries
+               if idx not in supplied]
+    vectors = {**supplied, **dict(zip(indices, embed_queries([reqs[idx].query for idx in indices])))}
+    for col_name, entries in pending.items():
+        col = cols[col_name]
+        count = counts[col_name]
+        # 同じwhereのクエリは1回のcol.queryにまとめる（nは最大値で取って後で切り詰め）
+        by_where: dict[str, list[tuple[int, tuple]]] = {}
+        for idx, cache_key in entries:
+            by_where.setdefault(json.dumps(reqs[idx].where, sort_keys=True), []).append((idx, cache_key))
+        for group in by_where.values():
+            where = reqs[group[0][0]].where
+            try:
+                hits = [[] for _ in group]
+                n = max(fetch_n(reqs[idx]) for idx, _ in group)
+                candidates, exact = where_candidates(col, where) if count else (None, False)
+                if (candidates is not None and candidate_vectors_fit(col, count)
+                        and filter_planner.choose(col_name, len(candidates)) == "brute_force"):
+                    scored = filtered_hits(col, [vectors[idx] for idx, _ in group], candidates, exact, n, where)
+                    hits = [finalize_hits(rows[:fetch_n(reqs[idx])], reqs[idx]) for rows, (idx, _) in zip(scored, group)]
+                elif count:
+                    kwargs = {
+                        "query_embeddings": [vectors[idx] for idx, _ in group],
+                        "n_results": min(n, count),
+                        "include": ["documents", "metadatas", "distances"],
+                    }
+                    if where:
+                        kwargs["where"] = where
+                    started = time.perf_counter()
+                    with stage("vector_query"):
+                        res = col.query(**kwargs)
+                    if candidates is not None:
+                        filter_planner.record_ann(col_name, time.perf_counter() - started)
+                    hits = [finalize_hits(format_hits(res, row, fetch_n(reqs[idx])), reqs[idx])
+                            for row, (idx, _) in enumerate(group)]
+            except Exception as e:
+                for idx, _ in group:
+                    responses[idx] = {"results": [], "collection": col_name, "total": 0, "error": str(e)}
+                continue
+            for (idx, cache_key), results in zip(group, hits):
+                responses[idx] = {"results": results, "collection": col_name, "total": len(results)}
+                if count:
+                    search_result_cache.put(cache_key, responses[idx])
+
+    return {"responses": responses, "total": len(responses)}
+
+def normalize_scores(scores: list[float], method: str) -> np.ndarray:
+    """1コレクション分のスコアを正規化する（minmax: 0〜1、zscore: 平均0・標準偏差1、none: そのまま）
+
+    minmax はコレクション内の順位を0〜1に広げるだけなので、各コレクションの1位は弱い一致でも1になる。
+    全件が同じスコア（1件だけの時も）なら広げようがないので、元のスコアを0〜1に丸めて使う。
+    """
+    x = np.asarray(scores, dtype=np.float64)
+    if method == "minmax":
+        span = x.max() - x.min()
+        return (x - x.min()) / span if span else np.clip(x, 0, 1)
+    if method == "zscore":
+        std = x.std()
+        return (x - x.mean()) / std if std else np.zeros_like(x)
+    return x
+
+@app.post("/search/federated")
+@offload(query_executor)
+def search_federated(req: FederatedSearchRequest):
+    """複数コレクションを並行に検索し、正規化したスコアで1つの上位n件にまとめる
+
+    クエリは最初に1回だけembeddingし、各コレクションの検索（/search と同じ処理・キャッシュ）に渡す。
+    失敗したコレクションは collections に error を入れ、残りの結果だけで返す。
+    存在しないコレクションは作らずに missing に入れる。
+    """
+    if not req.query and (req.mode != "vector" or not req.embedding):
+        raise HTTPException(status_code=400, detail="query is required" if req.embedding else "query or embedding is required")
+    existing = {c.name for c in client.list_collections()}
+    names = [name for name in dict.fromkeys(req.collections) if name in existing]
+    missing = [name for name in dict.fromkeys(req.collections) if name not in existing]
+    embedding = req.embedding
+    if embedding is None and req.mode != "lexical":
+        vector = embed_queries([req.query])[0]
+        embedding = base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode()
+    base = req.model_dump(exclude={"collections", "embedding", "normalize"})
+    futures = {
+        name: federated_executor.submit(run_search, SearchRequest(**base, collection=name, embedding=embedding))
+        for name in names
+    }
+
+    merged = []
+    summary: dict[str, dict] = {name: {"total": 0, "error": "collection not found"} for name in missing}
+    for name, fut in futures.items():
+        try:
+            hits = fut.result()["results"]
+        except Exception as e:
+            summary[name] = {"total": 0, "error": getattr(e, "detail", None) or str(e)}
+            continue
+        summary[name] = {"total": len(hits)}
+        if hits:
+            scores = normalize_scores([h["score"] for h in hits], req.normalize)
+            merged.extend({**h, "collection": name, "score": round(float(s), 4), "raw_score": h["score"]}
+                          for h, s in zip(hits, scores))
+    merged.sort(key=lambda h: (h["score"], h["raw_score"]), reverse=True)
+    results = merged[:req.n or 5]
+    return {"results": results, "total": len(results), "collections": summary, "missing": missing}
 
 @app.delete("/collection")
+@offload(write_executor)
 def delete_collection(req: DeleteCollectionRequest):
     try:
         client.delete_collection(req.collection)
+        collections.drop(req.collection)
+        index_dropped(req.collection)
+        invalidate(req.collection)
         return {"deleted": req.collection, "status": "ok"}
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+DOCUMENT_FIELDS = ("metadata", "text")
+
+def parse_fields(fields: str) -> set[str]:
+    wanted = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = wanted - set(DOCUMENT_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown fields: {sorted(unknown)} (allowed: {DOCUMENT_FIELDS})")
+    return wanted
+
+def get_documents(col, fields: set[str], ids: Optional[list[str]] = None, **kwargs) -> list[dict]:
+    """col.get結果を {id, text?, metadata?} のリストにする（ids指定時はその順に並べる）"""
+    include = [inc for f, inc in (("text", "documents"), ("metadata", "metadatas")) if f in fields]
+    result = col.get(ids=ids, include=include, **kwargs)
+    docs = []
+    for i, doc_id in enumerate(result["ids"]):
+        doc = {"id": doc_id}
+        if "text" in fields:
+            doc["text"] = result["documents"][i]
+        if "metadata" in fields:
+            doc["metadata"] = result["metadatas"][i] or {}
+        docs.append(doc)
+    if ids is not None:
+        order = {doc_id: i for i, doc_id in enumerate(ids)}
+        docs.sort(key=lambda d: order[d["id"]])
+    return docs
+
+def truncate_texts(docs: list[dict], snippet: Optional[int]) -> list[dict]:
+    if snippet is not None:
+        for doc in docs:
+            if "text" in doc and len(doc["text"]) > snippet:
+                doc["text"] = doc["text"][:snippet] + "…"
+    return docs
+
+def encode_cursor(doc_id: str) -> str:
+    return base64.urlsafe_b64encode(doc_id.encode()).decode()
+
+def decode_cursor(cursor: str) -> Optional[str]:
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
 @app.get("/documents")
-def list_documents(collection: Optional[str] = None, limit: int = 50, offset: int = 0):
+@offload(query_executor)
+def list_documents(collection: Optional[str] = None, limit: int = Query(50, ge=1, le=DOCUMENTS_MAX_LIMIT),
+                   offset: int = Query(0, ge=0),
+                   cursor: Optional[str] = None, fields: str = "metadata,text", snippet: Optional[int] = None):
+    """ドキュメント一覧
+
+    cursor を指定（最初のページは空文字）するとid順のキーセットページングになり、
+    レスポンスの next_cursor で次のページを引ける（深いページでも速い）。
+    fields で返す項目（metadata, text）を絞り、snippet でtextを先頭N文字に切り詰める。
+    """
     col = get_collection(collection)
-    if col.count() == 0:
-        return {"documents": [], "total": 0, "collection": col.name}
-    result = col.get(
-        limit=limit, offset=offset,
-        include=["documents", "metadatas"]
+    wanted = parse_fields(fields)
+    total = collections.count(col.name)
+    if total == 0:
+        response = {"documents": [], "total": 0, "collection": col.name}
+        if cursor is not None:
+            response["next_cursor"] = None
+        return response
+
+    if cursor is not None:
+        ids = chroma_db.page_ids(str(col.id), decode_cursor(cursor), limit)
+        docs = get_documents(col, wanted, ids=ids) if ids else []
+        next_cursor = encode_cursor(ids[-1]) if ids and len(ids) == limit else None
+        return {"documents": truncate_texts(docs, snippet), "total": total, "collection": col.name,
+                "next_cursor": next_cursor}
+
+    docs = get_documents(col, wanted, limit=limit, offset=offset)
+    return {"documents": truncate_texts(docs, snippet), "total": total, "collection": col.name}
+
+@app.get("/export")
+def export_documents(collection: Optional[str] = None, fields: str = "metadata,text", snippet: Optional[int] = None):
+    """コレクション全体をid順にNDJSONでストリーミング（1行1ドキュメント、メモリは1ページ分）"""
+    col = get_collection(collection)
+    wanted = parse_fields(fields)
+
+    def generate():
+        for ids in chroma_db.iter_id_pages(str(col.id), EXPORT_PAGE_SIZE):
+            for doc in truncate_texts(get_documents(col, wanted, ids=ids), snippet):
+                yield json.dumps(doc, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{col.name}.ndjson"'},
     )
-    docs = []
-    for i, doc_id in enumerate(result["ids"]):
-        docs.append({
-            "id": doc_id,
-            "text": result["documents"][i],
-            "metadata": result["metadatas"][i] or {},
-        })
-    return {"documents": docs, "total": col.count(), "collection": col.name}
 
 @app.get("/document/{doc_id}")
+@offload(query_executor)
 def get_document(doc_id: str, collection: Optional[str] = None):
     col = get_collection(collection)
     result = col.get(ids=[doc_id], include=["documents", "metadatas"])
@@ -175,6 +1466,7 @@ def get_document(doc_id: str, collection: Optional[str] = None):
     }
 
 @app.put("/document/{doc_id}")
+@offload(write_executor)
 def update_document(doc_id: str, req: UpdateDocumentRequest):
     col = get_collection(req.collection)
     # 既存データ取得
@@ -187,16 +1479,349 @@ def update_document(doc_id: str, req: UpdateDocumentRequest):
     new_text = req.text if req.text is not None else current_text
     new_meta = {**current_meta, **(req.metadata or {})}
     new_meta["updated_at"] = __import__("datetime").datetime.utcnow().isoformat()
-    # upsertで再embed
-    col.upsert(ids=[doc_id], documents=[new_text], metadatas=[new_meta])
-    return {"id": doc_id, "collection": col.name, "status": "updated"}
+    reembedded = new_text != current_text
+    if reembedded:
+        # 本文が変わった時だけ再embed
+        embeddings = embed_texts([new_text])
+        col.upsert(ids=[doc_id], embeddings=embeddings, documents=[new_text], metadatas=[new_meta])
+        index_upserted(col.name, [(doc_id, new_text, new_meta)], embeddings)
+    else:
+        col.update(ids=[doc_id], metadatas=[new_meta])
+        index_metadata_updated(col.name, [(doc_id, new_meta)])
+    invalidate(col.name)
+    return {"id": doc_id, "collection": col.name, "status": "updated", "reembedded": reembedded}
 
 @app.delete("/document/{doc_id}")
+@offload(write_executor)
 def delete_document(doc_id: str, collection: Optional[str] = None):
     col = get_collection(collection)
+    removed = len(existing_ids(col, [doc_id]))
     col.delete(ids=[doc_id])
+    collections.adjust(col.name, -removed)
+    index_deleted(col.name, [doc_id])
+    invalidate(col.name)
     return {"deleted": doc_id, "collection": col.name, "status": "ok"}
 
+def delete_ids(col, ids: list[str]) -> None:
+    """存在を確認済みのidを消し、件数と補助インデックスに反映する（キャッシュ無効化は呼び出し側で）"""
+    with stage("delete"):
+        col.delete(ids=ids)
+    collections.adjust(col.name, -len(ids))
+    with stage("index_update"):
+        index_deleted(col.name, ids)
+
+def delete_matching(col, ids: Optional[list[str]] = None, where: Optional[dict] = None, dry_run: bool = False) -> int:
+    """ids / where に当てはまるドキュメントを DELETE_BATCH_SIZE 件ずつまとめて消し、消した件数を返す"""
+    size = max(1, min(DELETE_BATCH_SIZE, client.get_max_batch_size()))
+    deleted = 0
+    try:
+        if ids:
+            for batch in chunked(list(dict.fromkeys(ids)), size):
+                kwargs = {"where": where} if where else {}
+                with stage("fetch_existing"):
+                    found = col.get(ids=batch, include=[], **kwargs)["ids"]
+                if found and not dry_run:
+                    delete_ids(col, found)
+                deleted += len(found)
+        elif dry_run:
+            with stage("fetch_existing"):
+                deleted = len(col.get(where=where, include=[])["ids"])
+        else:
+            # 消した分だけ先頭が進むので、毎回先頭から size 件ずつ取って消す
+            while True:
+                with stage("fetch_existing"):
+                    found = col.get(where=where, limit=size, include=[])["ids"]
+                if not found:
+                    break
+                delete_ids(col, found)
+                deleted += len(found)
+    finally:
+        if deleted and not dry_run:
+            invalidate(col.name)
+    return deleted
+
+@app.delete("/documents")
+@offload(write_executor)
+def delete_documents(req: DeleteDocumentsRequest):
+    """ids / where に当てはまるドキュメントをまとめて消す"""
+    if not req.ids and not req.where:
+        raise HTTPException(status_code=400, detail="ids or where is required")
+    col = get_collection(req.collection)
+    started = time.perf_counter()
+    try:
+        deleted = delete_matching(col, req.ids, req.where, req.dry_run)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    elapsed = time.perf_counter() - started
+    logger.info("delete_documents: %d docs from %s in %.3fs (dry_run=%s)", deleted, col.name, elapsed, req.dry_run)
+    return {"deleted": deleted, "collection": col.name, "dry_run": req.dry_run,
+            "elapsed_ms": round(elapsed * 1000, 1), "status": "ok"}
+
+# ディレクトリ → RAG の差分同期（fs_sync.py）。SYNC_SOURCES が空なら何もしない
+directory_sync = DirectorySync(
+    load_sources(json.loads(os.environ.get("SYNC_SOURCES", "[]"))),
+    SYNC_DIR,
+    ingest=lambda items: ingest_items([IngestRequest(**item) for item in items]),
+    delete=lambda col_name, ids: delete_matching(get_collection(col_name), ids),
+    read_workers=int(os.environ.get("SYNC_READ_WORKERS", "4")),
+    slice_size=int(os.environ.get("SYNC_SLICE_SIZE", "256")),
+    max_file_bytes=int(os.environ.get("SYNC_MAX_FILE_BYTES", "5000000")),
+)
+with startup.phase("directory_sync"):
+    directory_sync.start(float(os.environ.get("SYNC_INTERVAL_SEC", "0")))
+
+@app.get("/sync")
+def sync_status():
+    return {"sources": directory_sync.status()}
+
+@app.post("/sync")
+@offload(write_executor)
+def run_sync(source: Optional[str] = None):
+    """source 省略時は全ソースを順に同期する"""
+    names = [source] if source else list(directory_sync.sources)
+    results = []
+    for name in names:
+        try:
+            results.append(directory_sync.sync(name))
+        except SyncSourceNotFound:
+            raise HTTPException(status_code=404, detail=f"sync source not found: {name}")
+        except OSError as e:
+            results.append({"source": name, "error": str(e)})
+    return {"results": results}
+
+def neighbors(col_name: str, matrix: np.ndarray, k: int) -> tuple[list[list[str]], list[list[float]]]:
+    res = get_collection(col_name).query(query_embeddings=matrix, n_results=k, include=["distances"])
+    return res["ids"], res["distances"]
+
+def fetch_documents(col_name: str, ids: list[str]) -> dict[str, tuple[str, dict]]:
+    got = get_collection(col_name).get(ids=ids, include=["documents", "metadatas"])
+    return {doc_id: (text, meta) for doc_id, text, meta in zip(got["ids"], got["documents"], got["metadatas"])}
+
+def replace_metadata(col_name: str, doc_id: str, metadata: dict) -> None:
+    get_collection(col_name).update(ids=[doc_id], metadatas=[metadata])
+    index_metadata_updated(col_name, [(doc_id, metadata)])
+    invalidate(col_name)
+
+# 近似重複の検出ジョブ（near_dups.py）。コレクションのembeddingをページ単位で流してクラスタにまとめる
+dedup_jobs = NearDuplicateJobs(
+    DEDUP_DIR,
+    count=collections.reconcile,
+    pages=load_vectors,
+    search=neighbors,
+    fetch=fetch_documents,
+    delete=lambda col_name, ids: delete_matching(get_collection(col_name), ids),
+    update_metadata=replace_metadata,
+    exact_max=int(os.environ.get("DEDUP_EXACT_MAX", "100000")),
+    page_size=EXPORT_PAGE_SIZE,
+)
+with startup.phase("dedup_jobs"):
+    dedup_jobs.start()
+
+@app.post("/dedup/jobs", status_code=202)
+def submit_dedup_job(req: DedupJobRequest):
+    """近似重複の検出ジョブを積んですぐにジョブidを返す"""
+    name = req.collection or DEFAULT_COLLECTION
+    if not collection_exists(name):
+        raise HTTPException(status_code=404, detail=f"collection not found: {name}")
+    return dedup_jobs.submit(name, req.threshold, req.method, req.k, req.action, req.keep_by)
+
+@app.get("/dedup/jobs")
+def list_dedup_jobs():
+    return {"jobs": dedup_jobs.all()}
+
+@app.get("/dedup/jobs/{job_id}")
+def get_dedup_job(job_id: str, limit: int = 20):
+    """ジョブの状態と、大きい順に limit 件のクラスタ"""
+    try:
+        return {**dedup_jobs.status(job_id), "top_clusters": list(dedup_jobs.clusters(job_id, max(0, limit)))}
+    except DedupJobNotFound:
+        raise HTTPException(status_code=404, detail=f"job not found: {job_id}")
+
+@app.get("/dedup/jobs/{job_id}/clusters")
+def export_dedup_clusters(job_id: str):
+    """全クラスタをNDJSONで返す（1行1クラスタ）"""
+    try:
+        dedup_jobs.status(job_id)
+    except DedupJobNotFound:
+        raise HTTPException(status_code=404, detail=f"job not found: {job_id}")
+    lines = (json.dumps(c, ensure_ascii=False) + "\n" for c in dedup_jobs.clusters(job_id))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@app.delete("/dedup/jobs/{job_id}")
+def cancel_dedup_job(job_id: str):
+    """実行中・待機中のジョブを取り消す（消し終えたクラスタは戻さない）"""
+    try:
+        return dedup_jobs.cancel(job_id)
+    except DedupJobNotFound:
+        raise HTTPException(status_code=404, detail=f"job not found: {job_id}")
+
+SNAPSHOT_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+def snapshot_path(name: str) -> str:
+    if not SNAPSHOT_NAME_RE.match(name) or ".." in name:
+        raise HTTPException(status_code=400, detail=f"invalid snapshot name: {name}")
+    return os.path.join(SNAPSHOT_DIR, name)
+
+@app.get("/snapshots")
+def list_snapshots():
+    snapshots = []
+    if os.path.isdir(SNAPSHOT_DIR):
+        for name in sorted(os.listdir(SNAPSHOT_DIR)):
+            try:
+                manifest = read_manifest(os.path.join(SNAPSHOT_DIR, name))
+            except (SnapshotError, OSError, ValueError):
+                continue
+            snapshots.append({"name": name, **{k: manifest[k] for k in ("collection", "count", "dim", "dtype", "created_at")}})
+    return {"snapshots": snapshots, "path": SNAPSHOT_DIR}
+
+@app.post("/snapshot/export")
+@offload(write_executor)
+def snapshot_export(req: SnapshotExportRequest):
+    """コレクションをembedding込みでスナップショットに書き出す"""
+    if req.collection not in {c.name for c in client.list_collections()}:
+        raise HTTPException(status_code=404, detail=f"collection not found: {req.collection}")
+    col = get_collection(req.collection)
+    name = req.name or f"{col.name}-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}"
+    path = snapshot_path(name)
+    if os.path.exists(path):
+        raise HTTPException(status_code=409, detail=f"snapshot already exists: {name}")
+    try:
+        result = export_collection(col, chroma_db.iter_id_pages, path, req.dtype,
+                                   embedding_model=embedding_model_id(), page_size=EXPORT_PAGE_SIZE)
+    except SnapshotError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"name": name, **result}
+
+@app.post("/snapshot/import")
+@offload(write_executor)
+def snapshot_import(req: SnapshotImportRequest):
+    """スナップショットをembeddingモデルを通さずに投入する（同じidは上書き）"""
+    path = snapshot_path(req.name)
+    if not os.path.isdir(path):
+        raise HTTPException(status_code=404, detail=f"snapshot not found: {req.name}")
+    try:
+        result = import_snapshot(open_collection, path, req.collection, embedding_model=embedding_model_id(),
+                                 force=req.force, batch_size=min(1000, client.get_max_batch_size()))
+    except SnapshotError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    collections.reconcile(result["collection"])
+    index_dropped(result["collection"])
+    invalidate(result["collection"])
+    return {"name": req.name, **result}
+
+def recall(found: list[str], truth: list[str]) -> float:
+    return len(set(found) & set(truth)) / len(truth) if truth else 1.0
+
+@app.get("/quantized/report")
+@offload(query_executor)
+def quantized_report(collection: Optional[str] = None, k: int = 10, samples: int = 50,
+                     kind: Optional[str] = None):
+    """量子化インデックスのメモリとrecall@kの報告
+
+    コレクションからsamples件を無作為に選んでクエリにし、全件総当たり（float32）の上位kを正解として
+    HNSW（col.query）・量子化のみ・量子化+再スコアのrecall@kと1クエリあたりの時間を測る。
+    kind を指定すると QUANTIZED_INDEX と違う方式でもその場で構築して測る（常駐はさせない）。
+    """
+    kind = kind or QUANTIZED_INDEX or "int8"
+    if kind not in ("int8", "binary"):
+        raise HTTPException(status_code=400, detail=f"unsupported quantization: {kind}")
+    col = get_collection(collection)
+    if kind == QUANTIZED_INDEX:
+        index = quantized_indexes.get(col.name)
+    else:
+        index = QuantizedIndex(kind)
+        index.build(load_vectors(col.name))
+    if not len(index):
+        return {"collection": col.name, "kind": kind, "documents": 0}
+    k = max(1, min(k, len(index)))
+    rng = np.random.default_rng(0)
+    sample_ids = [index.ids[i] for i in rng.choice(np.flatnonzero(index.alive[:len(index.ids)]),
+                                                     size=min(samples, len(index)), replace=False)]
+    got = col.get(ids=sample_ids, include=["embeddings"])
+    queries = np.asarray(got["embeddings"], dtype=np.float32)
+
+    started = time.perf_counter()
+    truth = [[doc_id for doc_id, _ in hits] for hits in exact_topk(queries, load_vectors(col.name), k)]
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    timings = {"hnsw": 0.0, "quantized": 0.0, "quantized_rescored": 0.0}
+    recalls = {"hnsw": [], "quantized": [], "quantized_rescored": []}
+    for q, expected in zip(queries, truth):
+        t0 = time.perf_counter()
+        res = col.query(query_embeddings=[q], n_results=k, include=[])
+        t1 = time.perf_counter()
+        first = index.search(q, k)
+        t2 = time.perf_counter()
+        candidates = index.search(q, k * QUANTIZED_RESCORE)
+        rescored = score_candidates(col, [q], [doc_id for doc_id, _ in candidates], k)[0]
+        t3 = time.perf_counter()
+        for name, found, elapsed in (("hnsw", res["ids"][0], t1 - t0), ("quantized", [i for i, _ in first], t2 - t1),
+                                     ("quantized_rescored", [h["id"] for h in rescored], t3 - t2)):
+            recalls[name].append(recall(found, expected))
+            timings[name] += elapsed
+    stats = index.stats()
+    return {
+        "collection": col.name,
+        "kind": kind,
+        "documents": stats["documents"],
+        "dim": stats["dim"],
+        "k": k,
+        "samples": len(queries),
+        "rescore_factor": QUANTIZED_RESCORE,
+        "memory": {
+            "quantized_bytes": stats["bytes"],
+            "float32_bytes": stats["float32_bytes"],
+            "ratio": round(stats["bytes"] / stats["float32_bytes"], 4) if stats["float32_bytes"] else None,
+        },
+        "recall_at_k": {name: round(float(np.mean(v)), 4) for name, v in recalls.items()},
+        "latency_ms": {
+            "exact": round(exact_ms, 3),
+            **{name: round(t * 1000 / len(queries), 3) for name, t in timings.items()},
+        },
+    }
+
+# --- 起動時のウォームアップ ---
+
+def warm_up_collection(name: str, query: np.ndarray) -> None:
+    """HNSWセグメントを開いて1回検索し、設定済みの補助インデックスを構築しておく"""
+    col = get_collection(name)
+    count = collections.reconcile(name)
+    if not count:
+        return
+    col.query(query_embeddings=[query], n_results=1, include=[])
+    if METADATA_INDEX_KEYS:
+        metadata_indexes.get(name)
+        if candidate_vectors_fit(col, count):
+            candidate_vectors.get(name)
+    if quantized_size_ok(count):
+        quantized_indexes.get(name)
+    if WARMUP_LEXICAL:
+        lexical_indexes.get(name)
+
+def warm_up() -> None:
+    """モデルが使えなければ failed。コレクションの失敗は警告だけにして ready にする"""
+    try:
+        with startup.phase("embedding_model"):
+            query = embed_texts(["warm-up"])[0]
+    except Exception as e:
+        startup.mark_failed(f"embedding model: {e}")
+        return
+    existing = {c.name for c in client.list_collections()}
+    for name in WARMUP_COLLECTIONS:
+        if name not in existing:
+            logger.warning("warm-up: collection %s does not exist, skipped", name)
+            continue
+        try:
+            with startup.phase(f"collection:{name}"):
+                warm_up_collection(name, query)
+        except Exception as e:
+            logger.warning("warm-up of collection %s failed: %s", name, e)
+    startup.mark_ready()
+
+startup.loaded(warming=WARMUP)
+if WARMUP:
+    threading.Thread(target=warm_up, name="rag-warmup", daemon=True).start()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=3001)
@@ -0,0 +1,97 @@
+"""
+同時に来たリクエストを数ミリ秒だけ溜めて1回の処理にまとめるマイクロバッチャ
+
+各リクエストスレッドは submit() でブロックし、ワーカースレッドが
+max_wait_ms 待つか max_batch 件たまった時点でまとめて fn に渡し、結果を振り分けて返す。
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Optional, Sequence
+import queue
+import threading
+import time
+
+
+class MicroBatcher:
+    def __init__(self, fn: Callable[[list], Sequence[Any]], max_batch: int = 32, max_wait_ms: float = 5.0):
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: queue.Queue[tuple[list, Future, float]] = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # 統計
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes: dict[int, int] = {}
+        self._waits: deque[float] = deque(maxlen=1024)  # 直近のキュー待ち時間（秒）
+
+    def submit(self, items: list) -> list:
+        """items を処理キューに載せ、バッチ処理された結果を同じ順で返す"""
+        if not items:
+            return []
+        self._ensure_worker()
+        fut: Future = Future()
+        self._queue.put((items, fut, time.perf_counter()))
+        return fut.result()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="microbatcher", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(entry)
+                size += len(entry[0])
+            self._flush(pending, size)
+
+    def _flush(self, pending: list[tuple[list, Future, float]], size: int) -> None:
+        started = time.perf_counter()
+        for _, _, enqueued_at in pending:
+            self._waits.append(started - enqueued_at)
+        self.batches += 1
+        self.items += size
+        self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+        try:
+            results = self.fn([item for items, _, _ in pending for item in items])
+        except Exception as e:
+            for _, fut, _ in pending:
+                fut.set_exception(e)
+            return
+        offset = 0
+        for items, fut, _ in pending:
+            fut.set_result(list(results[offset:offset + len(items)]))
+            offset += len(items)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def pct(p: float):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 3) if waits else None
+
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else None,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queue_wait_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)},
+            "queued": self._queue.qsize(),
+        }
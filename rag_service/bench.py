@@ -0,0 +1,377 @@
+"""
+rag_service のベンチマーク（オフライン・プロセス内）
+
+FastAPIアプリをプロセス内で起動し（httpx の ASGITransport 経由、ネットワーク・Docker不要）、
+合成した日英混在コーパスを段階的に投入しながら次を測る。
+- ingest: /ingest/batch のスループット（docs/s）
+- search: /search のレイテンシ p50/p95/p99（並列度ごと）とスループット
+- memory: 各段階のRSSとピークRSS
+
+embeddingは --embedding fake（既定。トークンのハッシュから作る決定的なベクトル、モデル不要）か
+--embedding default（本番と同じ DefaultEmbeddingFunction）を選べる。
+コレクションは --sizes の小さい順に同じものへ差分を足して育てる（1k → 10k → ... と測る）。
+
+  python bench.py run --sizes 1000,10000 --concurrency 1,4,16 --out bench-results
+  python bench.py compare bench-results/a.json bench-results/b.json
+  python bench.py quantized --sizes 10000,50000,100000,200000 --kind int8
+
+quantized は量子化二次インデックス（QUANTIZED_INDEX）の総当たり＋再スコアと、ChromaのHNSW検索の
+1クエリあたりの時間を件数ごとに比べ、量子化の方が速い最大件数を QUANTIZED_MAX_DOCS の目安として出す。
+
+結果は <out>/bench-<時刻>.json（設定・環境・全結果）と同名の .csv（1行1計測）に書く。
+検索キャッシュは既定で無効（--cache で有効）。httpx が必要（pip install httpx）。
+"""
+
+from typing import Iterator, Optional
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# --- 合成コーパス ---
+
+JA_SUBJECTS = ["営業部", "キャスト", "店長", "新人スタッフ", "経理", "広報チーム", "開発チーム", "お客様", "本部", "シフト担当"]
+JA_OBJECTS = ["週次報告", "売上目標", "シフト表", "給与明細", "接客マニュアル", "キャンペーン", "予算案", "在庫", "議事録", "研修資料"]
+JA_VERBS = ["を確認した", "を更新した", "について相談した", "を共有した", "を見直した", "を提出した", "を延期した", "に合意した"]
+JA_PLACES = ["東京", "大阪", "名古屋", "福岡", "札幌", "横浜", "京都", "神戸"]
+EN_WORDS = ("meeting budget report schedule shift payroll customer campaign inventory review release deploy "
+            "incident onboarding training feedback roadmap metrics revenue forecast policy contract invoice").split()
+CASTS = [f"cast{i:03d}" for i in range(200)]
+SOURCES = ["slack", "notion", "mail", "wiki", "drive"]
+
+
+def _ja_sentence(rng: random.Random) -> str:
+    return f"{rng.choice(JA_PLACES)}の{rng.choice(JA_SUBJECTS)}が{rng.choice(JA_OBJECTS)}{rng.choice(JA_VERBS)}。"
+
+
+def _en_sentence(rng: random.Random) -> str:
+    words = rng.sample(EN_WORDS, rng.randint(5, 10))
+    return " ".join(words).capitalize() + "."
+
+
+def make_document(i: int, seed: int = 0) -> dict:
+    """i番目の合成ドキュメント（同じ i・seed なら常に同じ内容）"""
+    rng = random.Random(seed * 1_000_003 + i)
+    lang = "ja" if rng.random() < 0.7 else "en"
+    sentences = [_ja_sentence(rng) if lang == "ja" or rng.random() < 0.2 else _en_sentence(rng)
+                 for _ in range(rng.randint(2, 8))]
+    return {
+        "doc_id": f"bench-{i}",
+        "text": (" " if lang == "en" else "").join(sentences) + f" #{i}",
+        "metadata": {"cast": rng.choice(CASTS), "source": rng.choice(SOURCES), "lang": lang},
+    }
+
+
+def make_queries(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed + 7919)
+    queries = []
+    for _ in range(count):
+        if rng.random() < 0.7:
+            queries.append(f"{rng.choice(JA_PLACES)} {rng.choice(JA_SUBJECTS)} {rng.choice(JA_OBJECTS)}")
+        else:
+            queries.append(" ".join(rng.sample(EN_WORDS, 3)))
+    return queries
+
+
+# --- 決定的なダミーembedding ---
+
+class HashEmbedding:
+    """語彙インデックスと同じトークン（CJK bigram + 英数字単語）を符号付きハッシュで dim 次元へ写す
+
+    同じテキストからは常に同じベクトルになり、トークンを共有するテキスト同士は似たベクトルになる。
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def __call__(self, input: list[str]) -> list[np.ndarray]:
+        from lexical import tokenize
+
+        out = []
+        for text in input:
+            v = np.zeros(self.dim, dtype=np.float32)
+            for token in tokenize(text):
+                h = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+                v[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+            norm = np.linalg.norm(v)
+            out.append(v / norm if norm else v)
+        return out
+
+
+# --- 計測 ---
+
+def rss_mb() -> float:
+    """現在のRSS（/proc がなければピーク値で代用）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def percentiles(samples_ms: list[float]) -> dict:
+    a = np.asarray(samples_ms)
+    return {
+        "p50_ms": round(float(np.percentile(a, 50)), 3),
+        "p95_ms": round(float(np.percentile(a, 95)), 3),
+        "p99_ms": round(float(np.percentile(a, 99)), 3),
+        "mean_ms": round(float(a.mean()), 3),
+        "max_ms": round(float(a.max()), 3),
+    }
+
+
+def environment() -> dict:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        rev = ""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "git_rev": rev or None,
+    }
+
+
+async def ingest(client, collection: str, start: int, stop: int, chunk: int, seed: int) -> dict:
+    started = time.perf_counter()
+    failed = 0
+    for lo in range(start, stop, chunk):
+        items = [{**make_document(i, seed), "collection": collection} for i in range(lo, min(lo + chunk, stop))]
+        r = await client.post("/ingest/batch", json=items)
+        r.raise_for_status()
+        failed += len(r.json().get("errors", []))
+    elapsed = time.perf_counter() - started
+    return {"docs": stop - start, "failed": failed, "elapsed_s": round(elapsed, 3),
+            "docs_per_sec": round((stop - start) / elapsed, 1) if elapsed else None}
+
+
+async def search(client, collection: str, queries: list[str], concurrency: int, body: dict) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    queue: asyncio.Queue = asyncio.Queue()
+    for q in queries:
+        queue.put_nowait(q)
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            q = queue.get_nowait()
+            t0 = time.perf_counter()
+            r = await client.post("/search", json={"query": q, "collection": collection, **body})
+            latencies.append((time.perf_counter() - t0) * 1000)
+            if r.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"queries": len(queries), "errors": errors, "qps": round(len(queries) / elapsed, 1) if elapsed else None,
+            **percentiles(latencies)}
+
+
+async def run(args) -> dict:
+    import httpx
+
+    import app as rag_app
+
+    if args.embedding == "fake":
+        rag_app.embedding_fn = HashEmbedding(args.dim)
+    transport = httpx.ASGITransport(app=rag_app.app)
+    results = []
+    searches = [json.loads(s) for s in args.search] or [{}]
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        done = 0
+        for size in sorted(args.sizes):
+            row = await ingest(client, args.collection, done, size, args.ingest_chunk, args.seed)
+            done = size
+            results.append({"phase": "ingest", "size": size, **row, "rss_mb": round(rss_mb(), 1),
+                            "peak_rss_mb": round(peak_rss_mb(), 1)})
+            print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+            # 最初の検索で作られる補助インデックスの構築を計測から外す
+            for body in searches:
+                await client.post("/search", json={"query": "warmup", "collection": args.collection, **body})
+            for body in searches:
+                for concurrency in args.concurrency:
+                    queries = make_queries(args.queries, seed=args.seed + size + concurrency)
+                    row = await search(client, args.collection, queries, concurrency, {"n": args.n, **body})
+                    results.append({"phase": "search", "size": size, "concurrency": concurrency,
+                                    "request": body, **row, "rss_mb": round(rss_mb(), 1),
+                                    "peak_rss_mb": round(peak_rss_mb(), 1)})
+                    print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "environment": environment(),
+        "embedding_model": rag_app.embedding_model_id(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results,
+    }
+
+
+def quantized_crossover(args) -> dict:
+    """件数ごとに HNSW の col.query と、量子化行列の総当たり → n×rescore 件のfloat32再スコアを比べる"""
+    import chromadb
+
+    from quantized import QuantizedIndex, normalize
+
+    path = args.chroma_path or tempfile.mkdtemp(prefix="rag-bench-")
+    client = chromadb.PersistentClient(path=path)
+    col = client.get_or_create_collection(args.collection, metadata={"hnsw:space": "cosine"}, embedding_function=None)
+    embed = HashEmbedding(args.dim)
+    index = QuantizedIndex(args.kind)
+    queries = np.asarray(embed(make_queries(args.queries, seed=args.seed)), dtype=np.float32)
+    results = []
+    done = 0
+    for size in sorted(args.sizes):
+        for start in range(done, size, 2000):
+            docs = [make_document(i, args.seed) for i in range(start, min(start + 2000, size))]
+            vectors = np.asarray(embed([d["text"] for d in docs]), dtype=np.float32)
+            ids = [d["doc_id"] for d in docs]
+            col.add(ids=ids, embeddings=vectors, documents=[d["text"] for d in docs])
+            index.upsert(ids, vectors)
+        done = size
+        hnsw_ms, quantized_ms = [], []
+        for q in queries:
+            t = time.perf_counter()
+            col.query(query_embeddings=[q], n_results=args.n, include=["documents", "metadatas", "distances"])
+            hnsw_ms.append((time.perf_counter() - t) * 1000)
+            t = time.perf_counter()
+            candidates = [doc_id for doc_id, _ in index.search(q, args.n * args.rescore)]
+            got = col.get(ids=candidates, include=["embeddings", "documents", "metadatas"])
+            scores = normalize(np.asarray(got["embeddings"], dtype=np.float32)) @ normalize(q[None])[0]
+            np.argsort(-scores)[:args.n]
+            quantized_ms.append((time.perf_counter() - t) * 1000)
+        results.append({"phase": "quantized", "size": size, "kind": args.kind, "dim": args.dim,
+                        "hnsw_p50_ms": percentiles(hnsw_ms)["p50_ms"],
+                        "quantized_p50_ms": percentiles(quantized_ms)["p50_ms"],
+                        "index_mb": round(index.nbytes() / 2**20, 1)})
+        print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+    faster = [r["size"] for r in results if r["quantized_p50_ms"] < r["hnsw_p50_ms"]]
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "environment": environment(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results,
+        "quantized_max_docs": max(faster) if faster else 0,
+    }
+
+
+def write_results(report: dict, out_dir: str) -> str:
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, f"bench-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}")
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    fields = list(dict.fromkeys(k for row in report["results"] for k in row))
+    with open(base + ".csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in report["results"]:
+            writer.writerow({k: json.dumps(v, ensure_ascii=False) if isinstance(v, dict) else v for k, v in row.items()})
+    return base + ".json"
+
+
+def _key(row: dict) -> tuple:
+    return row["phase"], row["size"], row.get("concurrency"), json.dumps(row.get("request"), sort_keys=True)
+
+
+def compare(base_path: str, new_path: str) -> Iterator[str]:
+    """2回分の結果を同じ (phase, size, concurrency, request) 同士で並べる"""
+    with open(base_path, encoding="utf-8") as f:
+        base = {_key(r): r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+    metrics = {"ingest": ("docs_per_sec", "rss_mb"), "search": ("p50_ms", "p95_ms", "p99_ms", "qps", "rss_mb"),
+               "quantized": ("hnsw_p50_ms", "quantized_p50_ms")}
+    for row in new:
+        old: Optional[dict] = base.get(_key(row))
+        if old is None:
+            continue
+        label = f"{row['phase']:6} size={row['size']:<8} c={row.get('concurrency') or '-':<3}"
+        if row.get("request"):
+            label += f" {json.dumps(row['request'], ensure_ascii=False)}"
+        parts = []
+        for m in metrics[row["phase"]]:
+            a, b = old.get(m), row.get(m)
+            if a and b is not None:
+                parts.append(f"{m} {a} → {b} ({(b - a) / a * 100:+.1f}%)")
+        yield f"{label}  " + "  ".join(parts)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="rag_service benchmark")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_run = sub.add_parser("run")
+    p_run.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 10000])
+    p_run.add_argument("--concurrency", type=lambda s: [int(x) for x in s.split(",")], default=[1, 4, 16])
+    p_run.add_argument("--queries", type=int, default=200, help="並列度ごとの検索回数")
+    p_run.add_argument("--n", type=int, default=5)
+    p_run.add_argument("--search", action="append", default=[],
+                       help='検索リクエストの追加パラメータ（JSON、複数可）例: \'{"mode": "hybrid"}\'')
+    p_run.add_argument("--embedding", choices=["fake", "default"], default="fake")
+    p_run.add_argument("--dim", type=int, default=384, help="fake embedding の次元")
+    p_run.add_argument("--ingest-chunk", type=int, default=500, help="1回の /ingest/batch に載せる件数")
+    p_run.add_argument("--collection", default="bench")
+    p_run.add_argument("--seed", type=int, default=0)
+    p_run.add_argument("--chroma-path", help="既定は一時ディレクトリ（終了後も残す）")
+    p_run.add_argument("--cache", action="store_true", help="クエリembedding・検索結果キャッシュを有効にする")
+    p_run.add_argument("--out", default="bench-results")
+    p_cmp = sub.add_parser("compare")
+    p_cmp.add_argument("base")
+    p_cmp.add_argument("new")
+    p_q = sub.add_parser("quantized")
+    p_q.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[10000, 50000, 100000])
+    p_q.add_argument("--kind", choices=["int8", "binary"], default="int8")
+    p_q.add_argument("--rescore", type=int, default=4, help="QUANTIZED_RESCORE と同じ")
+    p_q.add_argument("--queries", type=int, default=100)
+    p_q.add_argument("--n", type=int, default=5)
+    p_q.add_argument("--dim", type=int, default=384)
+    p_q.add_argument("--collection", default="bench-quantized")
+    p_q.add_argument("--seed", type=int, default=0)
+    p_q.add_argument("--chroma-path", help="既定は一時ディレクトリ（終了後も残す）")
+    p_q.add_argument("--out", default="bench-results")
+    args = parser.parse_args()
+
+    if args.cmd == "compare":
+        for line in compare(args.base, args.new):
+            print(line)
+        return
+    if args.cmd == "quantized":
+        os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        report = quantized_crossover(args)
+        print(write_results(report, args.out))
+        print(f"QUANTIZED_MAX_DOCS={report['quantized_max_docs']}")
+        return
+
+    # app の import 前に環境変数を決める（CHROMA_PATH・キャッシュはimport時に読まれる）
+    os.environ["CHROMA_PATH"] = args.chroma_path or tempfile.mkdtemp(prefix="rag-bench-")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    if not args.cache:
+        os.environ["QUERY_EMBED_CACHE_SIZE"] = "0"
+        os.environ["SEARCH_CACHE_SIZE"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = asyncio.run(run(args))
+    report["config"]["chroma_path"] = os.environ["CHROMA_PATH"]
+    print(write_results(report, args.out))
+
+
+if __name__ == "__main__":
+    main()
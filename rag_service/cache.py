@@ -0,0 +1,120 @@
+"""
+rag_service 内プロセスキャッシュ
+
+- EmbeddingCache: クエリ文字列 → embeddingベクトル（モデル単位でキー分け）
+- ResultCache:    検索結果（コレクションごとの世代番号で書き込み時に無効化）
+"""
+
+from collections import OrderedDict
+from typing import Any, Optional
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class LRUCache:
+    """サイズ上限 + TTL付きのスレッドセーフなLRU"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl  # 秒。0以下なら期限なし
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Any, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+class EmbeddingCache(LRUCache):
+    """クエリembeddingのキャッシュ
+
+    キーは (モデル識別子, クエリ文字列)。モデルを差し替えても古いベクトルは使われない。
+    値は書き換え不可のfloat32配列で保持する。
+    """
+
+    def lookup(self, model_id: str, text: str) -> Optional[np.ndarray]:
+        return self.get((model_id, text))
+
+    def store(self, model_id: str, text: str, embedding: Any) -> np.ndarray:
+        vec = np.array(embedding, dtype=np.float32)
+        vec.flags.writeable = False
+        self.put((model_id, text), vec)
+        return vec
+
+
+class ResultCache(LRUCache):
+    """/search結果のキャッシュ
+
+    コレクションごとに世代番号を持ち、キーに世代を含める。書き込み系エンドポイントが
+    bump() すると、それ以前の世代で作られたエントリには二度とヒットしない（古いものはLRUで自然に追い出される）。
+    検索開始前に generation() を読み、その世代で store() することで、検索中に書き込みが
+    走った場合も古い結果が新しい世代に載ることはない。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 0.0):
+        super().__init__(maxsize, ttl)
+        self._generations: dict[str, int] = {}
+        self._gen_lock = threading.Lock()
+
+    def generation(self, collection: str) -> int:
+        return self._generations.get(collection, 0)
+
+    def bump(self, collection: str) -> int:
+        with self._gen_lock:
+            gen = self._generations.get(collection, 0) + 1
+            self._generations[collection] = gen
+            return gen
+
+    @staticmethod
+    def make_key(collection: str, generation: int, *parts: Any) -> tuple:
+        return (collection, generation, json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str))
+
+    def stats(self) -> dict:
+        return {**super().stats(), "generations": dict(self._generations)}
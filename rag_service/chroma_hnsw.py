@@ -0,0 +1,128 @@
+"""
+ChromaDB (0.5系 PersistentClient) のHNSWパラメータの参照・変更
+
+Chromaはコレクション作成時のメタデータ（hnsw:M など）をベクトルセグメントのメタデータに写し、
+セグメントを開く時にだけ読む。公開APIでは作成後に変えられないので、search_ef（検索時の探索幅）だけは
+セグメントのメタデータを直接書き換え、読み込み済みのhnswlibインデックスにも set_ef で反映する。
+M・construction_ef はグラフの作りそのものなので、変えるにはコレクションを作り直すしかない
+（tune_hnsw.py --apply）。
+
+セグメントの読み書きは非公開の内部API（client._server の sysdb・segment manager）を使うので、
+動作を確かめた版（TESTED_CHROMADB、requirements.txt で固定）以外では UnsupportedChromaVersion にする。
+その場合も参照（hnsw_params）は公開APIのコレクションメタデータから読む。
+"""
+
+from typing import Any
+import uuid
+
+import chromadb
+from chromadb.types import SegmentScope
+from chromadb.utils.read_write_lock import WriteRWLock
+
+TESTED_CHROMADB = ("0.5.20",)
+
+# APIでの名前 → コレクション/セグメントのメタデータキー
+HNSW_KEYS = {
+    "space": "hnsw:space",
+    "M": "hnsw:M",
+    "construction_ef": "hnsw:construction_ef",
+    "search_ef": "hnsw:search_ef",
+    "num_threads": "hnsw:num_threads",
+    "resize_factor": "hnsw:resize_factor",
+    "batch_size": "hnsw:batch_size",
+    "sync_threshold": "hnsw:sync_threshold",
+}
+# Chromaの既定値（メタデータに書かれていない時に効いている値）
+HNSW_DEFAULTS = {"space": "l2", "M": 16, "construction_ef": 100, "search_ef": 10}
+
+
+def to_metadata(params: dict[str, Any]) -> dict[str, Any]:
+    """{"M": 32, ...} → {"hnsw:M": 32, ...}（None の項目は除く）"""
+    unknown = set(params) - set(HNSW_KEYS)
+    if unknown:
+        raise ValueError(f"unknown hnsw parameters: {sorted(unknown)}")
+    return {HNSW_KEYS[k]: v for k, v in params.items() if v is not None}
+
+
+def from_metadata(metadata: dict[str, Any]) -> dict[str, Any]:
+    """メタデータから hnsw の項目だけを {"M": 32, ...} で取り出す（未指定はChromaの既定値）"""
+    params = dict(HNSW_DEFAULTS)
+    params.update({k: metadata[key] for k, key in HNSW_KEYS.items() if key in metadata})
+    return params
+
+
+class UnsupportedChromaVersion(RuntimeError):
+    pass
+
+
+def _server(client):
+    """内部APIを持つサーバーオブジェクト。確かめていない版・形が違う場合は UnsupportedChromaVersion"""
+    detail = (f"changing search_ef in place needs chromadb {' / '.join(TESTED_CHROMADB)} "
+              f"(installed: {chromadb.__version__}); rebuild the collection with tune_hnsw.py --apply instead")
+    if chromadb.__version__ not in TESTED_CHROMADB:
+        raise UnsupportedChromaVersion(detail)
+    server = getattr(client, "_server", None)
+    manager = getattr(server, "_manager", None)
+    if not all(hasattr(obj, attr) for obj, attr in ((server, "_sysdb"), (manager, "segment_cache"), (manager, "_instances"))):
+        raise UnsupportedChromaVersion(detail)
+    return server
+
+
+def _vector_segment(client, col) -> dict:
+    segments = _server(client)._sysdb.get_segments(collection=col.id, scope=SegmentScope.VECTOR)
+    if not segments:
+        raise ValueError(f"vector segment not found: {col.name}")
+    return segments[0]
+
+
+def hnsw_params(client, col) -> dict[str, Any]:
+    """いま効いているHNSWパラメータ（セグメントのメタデータ。内部APIが使えない版ではコレクションのメタデータ）"""
+    try:
+        return from_metadata(_vector_segment(client, col)["metadata"] or {})
+    except UnsupportedChromaVersion:
+        return from_metadata(col.metadata or {})
+
+
+def set_search_ef(client, col, search_ef: int) -> None:
+    """search_ef を永続化し、読み込み済みのインデックスにも即時に反映する"""
+    if search_ef < 1:
+        raise ValueError("search_ef must be >= 1")
+    server = _server(client)
+    segment = _vector_segment(client, col)
+    server._sysdb.update_segment(collection=col.id, id=segment["id"], metadata={"hnsw:search_ef": search_ef})
+    # コレクションのメタデータ（スナップショットに書き出される）も揃える。update_collection は全置換
+    server._sysdb.update_collection(id=col.id, metadata={**(col.metadata or {}), "hnsw:search_ef": search_ef})
+    manager = server._manager
+    manager.segment_cache[SegmentScope.VECTOR].pop(col.id)  # 次にセグメントを開く時は新しい値を読む
+    instance = manager._instances.get(segment["id"])
+    if instance is not None:
+        with WriteRWLock(instance._lock):
+            instance._params.search_ef = search_ef
+            if instance._index is not None:
+                instance._index.set_ef(search_ef)
+
+
+def rebuild_collection(client, col, metadata: dict[str, Any], page_ids, page_size: int = 500) -> Any:
+    """metadata（HNSW設定込み）で作り直したコレクションに全件をembedding込みで移し、元の名前で差し替える
+
+    page_ids(collection_id, page_size) はidのページ列を返すもの。移し終えるまで元のコレクションは残し、
+    削除 → 改名の間に失敗した場合は一時コレクション（名前を例外に含める）にデータが残る。
+    """
+    name = col.name
+    tmp_name = f"{name[:50]}-rebuild-{uuid.uuid4().hex[:6]}"
+    tmp = client.create_collection(tmp_name, metadata=metadata, embedding_function=None)
+    try:
+        for ids in page_ids(str(col.id), page_size):
+            got = col.get(ids=ids, include=["embeddings", "documents", "metadatas"])
+            tmp.add(ids=got["ids"], embeddings=got["embeddings"], documents=got["documents"],
+                    metadatas=[m or None for m in got["metadatas"]])
+    except BaseException:
+        client.delete_collection(tmp_name)
+        raise
+    try:
+        client.delete_collection(name)
+        tmp.modify(name=name)
+    except Exception as e:
+        raise RuntimeError(f"rebuild of {name} failed after copying; data is in collection {tmp_name}") from e
+    return client.get_collection(name, embedding_function=None)
+
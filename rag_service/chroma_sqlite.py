@@ -0,0 +1,64 @@
+"""
+ChromaDB (PersistentClient) の chroma.sqlite3 を読み取り専用で直接引くヘルパー
+
+Chromaの col.get(limit, offset) は OFFSET 走査なので深いページほど遅い。
+embeddings テーブルには UNIQUE(segment_id, embedding_id) のインデックスがあるので、
+ドキュメントidのキーセット（id > 前ページ末尾）でページングすればどの位置でも同じコストで引ける。
+ここではidの列挙だけを行い、本文やメタデータは col.get(ids=...) で取る。
+"""
+
+from typing import Iterator, Optional
+import os
+import sqlite3
+import threading
+
+
+class ChromaSQLite:
+    def __init__(self, chroma_path: str):
+        self.db_path = os.path.join(chroma_path, "chroma.sqlite3")
+        self._local = threading.local()
+        self._segments: dict[str, str] = {}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def metadata_segment(self, collection_id: str) -> Optional[str]:
+        seg = self._segments.get(collection_id)
+        if seg is None:
+            row = self._conn().execute(
+                "SELECT id FROM segments WHERE collection = ? AND scope = 'METADATA'",
+                (collection_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            seg = self._segments[collection_id] = row[0]
+        return seg
+
+    def page_ids(self, collection_id: str, after: Optional[str], limit: int) -> list[str]:
+        """id昇順で after より後ろの id を最大 limit 件"""
+        seg = self.metadata_segment(collection_id)
+        if seg is None:
+            return []
+        rows = self._conn().execute(
+            "SELECT embedding_id FROM embeddings WHERE segment_id = ? AND embedding_id > ? "
+            "ORDER BY embedding_id LIMIT ?",
+            (seg, after or "", limit),
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def iter_id_pages(self, collection_id: str, page_size: int = 500) -> Iterator[list[str]]:
+        """コレクション全体のidをページ単位で列挙（メモリは1ページ分だけ）"""
+        after = None
+        while True:
+            ids = self.page_ids(collection_id, after, page_size)
+            if not ids:
+                return
+            yield ids
+            after = ids[-1]
+
+    def forget(self, collection_id: str) -> None:
+        self._segments.pop(collection_id, None)
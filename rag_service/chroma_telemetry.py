@@ -0,0 +1,17 @@
+"""
+Chromaの製品テレメトリを無効にするための差し替え実装
+
+chromadb 0.5 の Posthog.capture はロックなしで dict を更新するので、
+複数スレッドから col.get / col.query を同時に呼ぶと KeyError になることがある。
+このサービスは外部へ送信もしないので、イベントごと捨てる。
+"""
+
+from overrides import override
+
+from chromadb.telemetry.product import ProductTelemetryClient, ProductTelemetryEvent
+
+
+class NoProductTelemetry(ProductTelemetryClient):
+    @override
+    def capture(self, event: ProductTelemetryEvent) -> None:
+        pass
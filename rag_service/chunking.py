@@ -0,0 +1,116 @@
+"""
+長文のサーバー側チャンク分割
+
+- Markdownの見出しでセクションに分け、見出しパスをチャンクのメタデータに残す
+- セクション内は日本語（。！？）・英語（. ! ?）の文境界と空行で文に分ける
+- 文を size 文字までまとめ、直前チャンク末尾の overlap 文字分の文を次チャンクの先頭に重ねる
+"""
+
+from typing import Optional
+import re
+
+HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+FENCE_RE = re.compile(r"^\s*(```|~~~)")
+# 文末記号（閉じ括弧込み）・英文の文末+空白・空行 のいずれかで区切る
+SENTENCE_RE = re.compile(
+    r".+?(?:[。！？!?]+[」』）)\]]*|(?<=[.!?])\s+|\n\s*\n|$)",
+    re.S,
+)
+
+
+def split_sections(text: str) -> list[tuple[str, str]]:
+    """(見出しパス, セクション本文) のリスト。コードブロック内の # は見出し扱いしない"""
+    sections: list[tuple[str, str]] = []
+    path: list[tuple[int, str]] = []
+    buf: list[str] = []
+    in_fence = False
+
+    def flush():
+        # 見出しだけのセクションは次のセクションの先頭にくっつける
+        if all(not line.strip() or HEADING_RE.match(line) for line in buf):
+            return
+        body = "\n".join(buf).strip()
+        sections.append((" > ".join(h for _, h in path), body))
+        buf.clear()
+
+    for line in text.splitlines():
+        if FENCE_RE.match(line):
+            in_fence = not in_fence
+        m = None if in_fence else HEADING_RE.match(line)
+        if m:
+            flush()
+            level = len(m.group(1))
+            path = [(lv, h) for lv, h in path if lv < level] + [(level, m.group(2))]
+        buf.append(line)
+    if any(line.strip() for line in buf):
+        sections.append((" > ".join(h for _, h in path), "\n".join(buf).strip()))
+    return sections
+
+
+def split_sentences(text: str) -> list[str]:
+    return [s for s in (m.group(0) for m in SENTENCE_RE.finditer(text)) if s.strip()]
+
+
+def _hard_split(sentence: str, size: int, overlap: int) -> list[str]:
+    step = max(1, size - overlap)
+    return [sentence[i:i + size] for i in range(0, len(sentence), step) if sentence[i:i + size].strip()]
+
+
+def pack(sentences: list[str], size: int, overlap: int) -> list[str]:
+    chunks: list[str] = []
+    current: list[str] = []
+    length = 0
+    for sentence in sentences:
+        if len(sentence) > size:
+            if current:
+                chunks.append("".join(current))
+                current, length = [], 0
+            chunks.extend(_hard_split(sentence, size, overlap))
+            continue
+        if current and length + len(sentence) > size:
+            chunks.append("".join(current))
+            # 末尾から overlap 文字以内に収まる文を次のチャンクへ持ち越す
+            carry: list[str] = []
+            carried = 0
+            for s in reversed(current):
+                if carried + len(s) > overlap or carried + len(s) + len(sentence) > size:
+                    break
+                carry.insert(0, s)
+                carried += len(s)
+            current, length = carry, carried
+        current.append(sentence)
+        length += len(sentence)
+    if current:
+        chunks.append("".join(current))
+    return [c.strip() for c in chunks if c.strip()]
+
+
+def chunk_text(text: str, size: int = 500, overlap: int = 50) -> list[dict]:
+    """text をチャンクに分割する。各要素は {"text", "section"}"""
+    size = max(1, size)
+    overlap = max(0, min(overlap, size // 2))
+    chunks = []
+    for section, body in split_sections(text):
+        for piece in pack(split_sentences(body), size, overlap):
+            chunks.append({"text": piece, "section": section})
+    return chunks
+
+
+def chunk_id(parent_id: str, index: int) -> str:
+    return f"{parent_id}#{index}"
+
+
+def collapse_hits(hits: list[dict], n: Optional[int] = None) -> list[dict]:
+    """チャンク単位のヒットを親ドキュメント単位にまとめる（スコア最大のチャンクを代表にする）"""
+    seen: dict[str, dict] = {}
+    for hit in hits:
+        parent = (hit.get("metadata") or {}).get("parent_id") or hit["id"]
+        best = seen.get(parent)
+        if best is None:
+            seen[parent] = {**hit, "parent_id": parent, "matched_chunks": 1}
+        else:
+            best["matched_chunks"] += 1
+            if hit["score"] > best["score"]:
+                seen[parent] = {**hit, "parent_id": parent, "matched_chunks": best["matched_chunks"]}
+    collapsed = sorted(seen.values(), key=lambda h: h["score"], reverse=True)
+    return collapsed[:n] if n is not None else collapsed
@@ -0,0 +1,103 @@
+"""
+用途別の上限付きスレッドプールとアドミッション制御
+
+embedding・検索・書き込みをそれぞれ別プールで動かし、重い処理が /health などを巻き込まないようにする。
+実行中 + 待機中が workers + max_queue を超えたら即座に Overloaded を投げ、
+app側でRetry-After付きの429/503に変換する。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+from metrics import mark_handler_done, record_stage
+
+
+class Overloaded(Exception):
+    def __init__(self, pool: str, status_code: int = 503, retry_after: int = 1):
+        super().__init__(f"{pool} queue is full")
+        self.pool = pool
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    def __init__(self, name: str, workers: int, max_queue: int, status_code: int = 503, retry_after: int = 1):
+        self.name = name
+        self.workers = max(1, workers)
+        self.limit = self.workers + max(0, max_queue)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix=f"rag-{name}")
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _admit(self) -> None:
+        with self._lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                raise Overloaded(self.name, self.status_code, self.retry_after)
+            self.in_flight += 1
+
+    def _release(self, _=None) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def _run_marked(self, submitted: float, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        record_stage(f"queue_{self.name}", time.perf_counter() - submitted)
+        self._local.inside = True
+        return fn(*args, **kwargs)
+
+    def submit(self, fn: Callable, *args: Any, **kwargs: Any):
+        """呼び出し元のcontextvars（リクエストの計測先など）を引き継いで実行する"""
+        self._admit()
+        try:
+            ctx = contextvars.copy_context()
+            fut = self._pool.submit(ctx.run, self._run_marked, time.perf_counter(), fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        fut.add_done_callback(self._release)
+        return fut
+
+    async def run(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        """イベントループから呼ぶ"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def call(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        """別プールのワーカースレッドから同期的に呼ぶ（自プール内からなら直接実行）"""
+        if getattr(self._local, "inside", False):
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+def offload(executor: BoundedExecutor):
+    """同期エンドポイント関数を executor 上で動くasyncエンドポイントに変換する
+
+    元の同期関数は __wrapped__ から呼べる。
+    """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        async def endpoint(*args: Any, **kwargs: Any) -> Any:
+            result = await executor.run(fn, *args, **kwargs)
+            mark_handler_done()
+            return result
+        return endpoint
+    return decorator
@@ -0,0 +1,247 @@
+"""
+ディレクトリ → RAG の差分同期
+
+設定したディレクトリを走査し、ソースごとのマニフェスト（相対パス → mtime・サイズ・内容hash・doc id）と比べて
+新しいファイル・変わったファイルだけを投入し、消えたファイルのドキュメント（チャンク）を削除する。
+- mtime とサイズが同じファイルは読まない。違っていても内容hashが同じなら投入せずマニフェストだけ更新する
+- 読み込みとhash計算はスレッドプールで並列に行い、投入は slice_size 件ずつ ingest(items) に渡す
+  （app側の一括ingestと同じ経路。チャンクの組み直し・不要チャンクの削除もそちらで行う）
+- マニフェストはスライスごとに書き出すので、途中で止まっても次の同期は残りから進む
+- doc id は "{ソース名}:{相対パス}" で固定なので、ファイルを更新すると同じidのドキュメントが置き換わる
+
+<manifest_dir>/<ソース名>.json  {相対パス: {"mtime_ns", "size", "hash", "doc_ids"}}
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from chunking import chunk_id
+
+DEFAULT_PATTERNS = ["**/*.md", "**/*.txt"]
+SOURCE_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+logger = logging.getLogger("rag_service.sync")
+
+
+class SyncSourceNotFound(Exception):
+    pass
+
+
+def load_sources(raw: list[dict]) -> dict[str, dict]:
+    """SYNC_SOURCES の各要素を既定値で補う。name / path は必須"""
+    sources = {}
+    for entry in raw:
+        name, path = entry.get("name"), entry.get("path")
+        if not name or not path or not SOURCE_NAME_RE.match(name):
+            raise ValueError(f"sync source needs a valid name and path: {entry}")
+        patterns = entry.get("patterns") or DEFAULT_PATTERNS
+        sources[name] = {
+            "name": name,
+            "path": os.path.abspath(os.path.expanduser(path)),
+            "patterns": [patterns] if isinstance(patterns, str) else list(patterns),
+            "collection": entry.get("collection") or name,
+            "chunk": entry.get("chunk", True),
+            "chunk_size": entry.get("chunk_size"),
+            "chunk_overlap": entry.get("chunk_overlap"),
+        }
+    return sources
+
+
+def matches(rel: str, patterns: list[str]) -> bool:
+    # "**/*.md" はトップ直下のファイルにも当てる
+    return any(fnmatch.fnmatch(rel, p) or (p.startswith("**/") and fnmatch.fnmatch(rel, p[3:])) for p in patterns)
+
+
+def scan(source: dict) -> dict[str, tuple[int, int]]:
+    """ソースのディレクトリを走査して {相対パス: (mtime_ns, size)}"""
+    found = {}
+    root = source["path"]
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for filename in filenames:
+            if filename.startswith("."):
+                continue
+            full = os.path.join(dirpath, filename)
+            rel = os.path.relpath(full, root).replace(os.sep, "/")
+            if not matches(rel, source["patterns"]):
+                continue
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            found[rel] = (st.st_mtime_ns, st.st_size)
+    return found
+
+
+class DirectorySync:
+    def __init__(self, sources: dict[str, dict], manifest_dir: str,
+                 ingest: Callable[[list[dict]], dict], delete: Callable[[str, list[str]], int],
+                 read_workers: int = 4, slice_size: int = 256, max_file_bytes: int = 5_000_000):
+        self.sources = sources
+        self.manifest_dir = manifest_dir
+        self.ingest = ingest
+        self.delete = delete
+        self.read_workers = max(1, read_workers)
+        self.slice_size = max(1, slice_size)
+        self.max_file_bytes = max_file_bytes
+        self.last: dict[str, dict] = {}  # ソース名 → 直近の同期結果
+        self._locks = {name: threading.Lock() for name in sources}
+        self._thread: Optional[threading.Thread] = None
+
+    # --- マニフェスト ---
+
+    def _manifest_path(self, name: str) -> str:
+        return os.path.join(self.manifest_dir, f"{name}.json")
+
+    def load_manifest(self, name: str) -> dict[str, dict]:
+        try:
+            with open(self._manifest_path(name), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, name: str, manifest: dict[str, dict]) -> None:
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        path = self._manifest_path(name)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    # --- 同期 ---
+
+    def sync(self, name: str) -> dict:
+        source = self.sources.get(name)
+        if source is None:
+            raise SyncSourceNotFound(name)
+        with self._locks[name]:
+            result = self._sync(source)
+        self.last[name] = result
+        return result
+
+    def _read(self, source: dict, rel: str) -> tuple[str, Optional[str], Optional[str]]:
+        """(相対パス, 本文, 内容hash)。読めなければ本文は None でhashにエラー文を入れる"""
+        try:
+            with open(os.path.join(source["path"], rel), "rb") as f:
+                raw = f.read(self.max_file_bytes + 1)
+        except OSError as e:
+            return rel, None, str(e)
+        if len(raw) > self.max_file_bytes:
+            return rel, None, f"file is larger than {self.max_file_bytes} bytes"
+        return rel, raw.decode("utf-8", errors="replace"), hashlib.sha256(raw).hexdigest()
+
+    def _item(self, source: dict, rel: str, text: str, mtime_ns: int) -> dict:
+        item = {
+            "text": text,
+            "doc_id": f"{source['name']}:{rel}",
+            "collection": source["collection"],
+            "metadata": {
+                "source": source["name"],
+                "path": rel,
+                "title": os.path.splitext(os.path.basename(rel))[0],
+                "mtime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(mtime_ns / 1e9)),
+            },
+            "chunk": source["chunk"],
+        }
+        for key in ("chunk_size", "chunk_overlap"):
+            if source[key] is not None:
+                item[key] = source[key]
+        return item
+
+    def _sync(self, source: dict) -> dict:
+        started = time.perf_counter()
+        name = source["name"]
+        manifest = self.load_manifest(name)
+        if not os.path.isdir(source["path"]):
+            # マウントが外れた時に全件削除しないよう、ディレクトリがなければ何もしない
+            raise FileNotFoundError(f"sync source directory not found: {source['path']}")
+        on_disk = scan(source)
+        counts = {"scanned": len(on_disk), "unchanged": 0, "touched": 0, "added": 0, "updated": 0, "removed": 0}
+        failed: list[dict] = []
+
+        stale = [rel for rel, (mtime_ns, size) in on_disk.items()
+                 if rel not in manifest or (manifest[rel]["mtime_ns"], manifest[rel]["size"]) != (mtime_ns, size)]
+        counts["unchanged"] = len(on_disk) - len(stale)
+        gone = [rel for rel in manifest if rel not in on_disk]
+
+        with ThreadPoolExecutor(self.read_workers, thread_name_prefix=f"rag-sync-{name}") as pool:
+            for start in range(0, len(stale), self.slice_size):
+                pending: list[tuple[str, dict, str]] = []  # (相対パス, item, hash)
+                for rel, text, digest in pool.map(lambda r: self._read(source, r), stale[start:start + self.slice_size]):
+                    mtime_ns, size = on_disk[rel]
+                    if text is None:
+                        failed.append({"path": rel, "error": digest})
+                    elif not text.strip():
+                        gone.append(rel)  # 空になったファイルは消えたものとして扱う
+                    elif rel in manifest and manifest[rel]["hash"] == digest:
+                        manifest[rel].update(mtime_ns=mtime_ns, size=size)
+                        counts["touched"] += 1
+                    else:
+                        pending.append((rel, self._item(source, rel, text, mtime_ns), digest))
+                if pending:
+                    result = self.ingest([item for _, item, _ in pending])
+                    errors = {e["index"]: e["error"] for e in result["errors"]}
+                    done = {d["id"]: d for d in result["items"]}
+                    for idx, (rel, item, digest) in enumerate(pending):
+                        if idx in errors:
+                            failed.append({"path": rel, "error": errors[idx]})
+                            continue
+                        chunks = done.get(item["doc_id"], {}).get("chunks")
+                        doc_ids = [chunk_id(item["doc_id"], i) for i in range(chunks)] if chunks else [item["doc_id"]]
+                        counts["updated" if rel in manifest else "added"] += 1
+                        mtime_ns, size = on_disk[rel]
+                        manifest[rel] = {"mtime_ns": mtime_ns, "size": size, "hash": digest, "doc_ids": doc_ids}
+                self._save_manifest(name, manifest)
+
+        for rel in gone:
+            entry = manifest.pop(rel, None)
+            if entry is None:
+                continue
+            try:
+                self.delete(source["collection"], entry["doc_ids"])
+                counts["removed"] += 1
+            except Exception as e:
+                manifest[rel] = entry  # 次の同期でもう一度消す
+                failed.append({"path": rel, "error": str(e)})
+        self._save_manifest(name, manifest)
+
+        elapsed = time.perf_counter() - started
+        result = {"source": name, "collection": source["collection"], **counts, "failed": failed,
+                  "elapsed_ms": round(elapsed * 1000, 1), "finished_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        logger.info("sync %s: scanned=%d added=%d updated=%d removed=%d touched=%d failed=%d in %.2fs",
+                    name, counts["scanned"], counts["added"], counts["updated"], counts["removed"], counts["touched"],
+                    len(failed), elapsed)
+        return result
+
+    # --- 定期同期 ---
+
+    def start(self, interval: float) -> None:
+        """interval 秒ごとに全ソースを同期するデーモンスレッドを起動する（0以下なら何もしない）"""
+        if interval <= 0 or not self.sources or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="rag-sync", daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval: float) -> None:
+        while True:
+            for name in self.sources:
+                try:
+                    self.sync(name)
+                except Exception as e:
+                    logger.warning("sync %s failed: %s", name, e)
+                    self.last[name] = {"source": name, "error": str(e),
+                                       "finished_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+            time.sleep(interval)
+
+    def status(self) -> list[dict]:
+        return [
+            {**source, "files": len(self.load_manifest(name)), "last": self.last.get(name)}
+            for name, source in self.sources.items()
+        ]
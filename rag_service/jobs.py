@@ -0,0 +1,244 @@
+"""
+バックグラウンドingestジョブ
+
+投入したitemsはすぐにファイルへ書き出してジョブidを返し、ワーカースレッドが slice_size 件ずつ
+process(items, batch_size) に渡して処理する。進捗は1スライスごとに state.json へ書くので、
+再起動しても未完了のジョブは続きのスライスから再開する（再開したスライスは再投入になるが、
+本文が同じレコードは再embeddingされないので実質スキップされる）。
+
+<jobs_dir>/<job_id>/
+  items.jsonl   投入されたitems（1行1件。完了・取消後に削除）
+  state.json    状態・進捗・失敗
+"""
+
+from typing import Callable, Optional
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+ACTIVE = ("queued", "running")
+logger = logging.getLogger("rag_service.jobs")
+
+
+class JobNotFound(Exception):
+    pass
+
+
+class IngestJobs:
+    def __init__(self, jobs_dir: str, process: Callable[[list[dict], Optional[int]], dict], workers: int = 1,
+                 slice_size: int = 256, max_errors: int = 100, retries: int = 3, retry_wait: float = 2.0):
+        self.jobs_dir = jobs_dir
+        self.process = process
+        self.workers = max(1, workers)
+        self.slice_size = max(1, slice_size)
+        self.max_errors = max_errors
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self._states: dict[str, dict] = {}
+        self._runtime: dict[str, tuple[float, int]] = {}  # job_id → (このプロセスで走り始めた時刻, その時点のprocessed)
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._threads: list[threading.Thread] = []
+
+    # --- 起動・復元 ---
+
+    def start(self) -> None:
+        """保存済みジョブを読み込み、未完了のものを積み直してワーカーを起動する"""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            try:
+                with open(self._path(job_id, "state.json"), encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._states[job_id] = state
+            if state["status"] in ACTIVE:
+                state["status"] = "queued"
+                self._queue.put(job_id)
+                logger.info("resuming job %s at %d/%d", job_id, state["processed"], state["total"])
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"rag-job-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _path(self, job_id: str, name: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, name)
+
+    def _save(self, state: dict) -> None:
+        path = self._path(state["id"], "state.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    # --- API ---
+
+    def submit(self, items: list[dict], batch_size: Optional[int] = None) -> dict:
+        job_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.join(self.jobs_dir, job_id))
+        with open(self._path(job_id, "items.jsonl"), "w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        state = {
+            "id": job_id,
+            "status": "queued",
+            "total": len(items),
+            "processed": 0,
+            "ingested": 0,
+            "failed": 0,
+            "written": {},
+            "errors": [],
+            "batch_size": batch_size,
+            "elapsed_sec": 0.0,
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+        }
+        with self._lock:
+            self._states[job_id] = state
+            self._save(state)
+        self._queue.put(job_id)
+        return self.status(job_id)
+
+    def status(self, job_id: str) -> dict:
+        with self._lock:
+            state = self._states.get(job_id)
+            if state is None:
+                raise JobNotFound(job_id)
+            state = dict(state)
+            runtime = self._runtime.get(job_id)
+        total, processed = state["total"], state["processed"]
+        state["progress"] = round(processed / total, 4) if total else 1.0
+        rate = None
+        if runtime is not None:
+            elapsed = time.monotonic() - runtime[0]
+            rate = (processed - runtime[1]) / elapsed if elapsed > 0 and processed > runtime[1] else None
+        elif state["elapsed_sec"]:
+            rate = processed / state["elapsed_sec"]
+        state["docs_per_sec"] = round(rate, 1) if rate else None
+        state["eta_sec"] = round((total - processed) / rate, 1) if rate and state["status"] in ACTIVE else None
+        return state
+
+    def all(self) -> list[dict]:
+        with self._lock:
+            ids = sorted(self._states, reverse=True)
+        return [{k: v for k, v in self.status(job_id).items() if k != "errors"} for job_id in ids]
+
+    def cancel(self, job_id: str) -> dict:
+        with self._lock:
+            state = self._states.get(job_id)
+            if state is None:
+                raise JobNotFound(job_id)
+            if state["status"] in ACTIVE:
+                queued = state["status"] == "queued"
+                state["status"] = "cancelled"
+                state["finished_at"] = _now()
+                self._save(state)
+                if queued:
+                    self._remove_items(job_id)
+        return self.status(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts: dict[str, int] = {}
+            for state in self._states.values():
+                counts[state["status"]] = counts.get(state["status"], 0) + 1
+        return {"workers": self.workers, "slice_size": self.slice_size, "queued": self._queue.qsize(), "by_status": counts}
+
+    # --- ワーカー ---
+
+    def _worker(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.exception("job %s failed", job_id)
+                self._finish(job_id, "failed", error=str(e))
+
+    def _read_items(self, job_id: str, start: int):
+        with open(self._path(job_id, "items.jsonl"), encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if i >= start:
+                    yield json.loads(line)
+
+    def _run(self, job_id: str) -> None:
+        with self._lock:
+            state = self._states[job_id]
+            if state["status"] != "queued":
+                return
+            state["status"] = "running"
+            state["started_at"] = state["started_at"] or _now()
+            self._runtime[job_id] = (time.monotonic(), state["processed"])
+            self._save(state)
+        offset = state["processed"]
+        batch: list[dict] = []
+        for item in self._read_items(job_id, offset):
+            batch.append(item)
+            if len(batch) >= self.slice_size:
+                if not self._run_slice(job_id, offset, batch):
+                    break
+                offset += len(batch)
+                batch = []
+        else:
+            if not batch or self._run_slice(job_id, offset, batch):
+                self._finish(job_id, "completed")
+                return
+        self._finish(job_id, "cancelled")
+
+    def _run_slice(self, job_id: str, offset: int, items: list[dict]) -> bool:
+        """1スライス処理して進捗を保存する。取り消されていたら False"""
+        with self._lock:
+            if self._states[job_id]["status"] != "running":
+                return False
+            batch_size = self._states[job_id]["batch_size"]
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                result = self.process(items, batch_size)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("job %s slice at %d failed (%s), retrying", job_id, offset, e)
+                time.sleep(self.retry_wait * (attempt + 1))
+        with self._lock:
+            state = self._states[job_id]
+            state["processed"] = offset + len(items)
+            state["ingested"] += result["ingested"]
+            state["failed"] += len(result["errors"])
+            for k, v in result.get("written", {}).items():
+                state["written"][k] = state["written"].get(k, 0) + v
+            room = self.max_errors - len(state["errors"])
+            state["errors"].extend({**e, "index": e["index"] + offset} for e in result["errors"][:max(0, room)])
+            state["elapsed_sec"] = round(state["elapsed_sec"] + time.monotonic() - started, 3)
+            if state["status"] == "running":
+                self._save(state)
+            return state["status"] == "running"
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            state = self._states[job_id]
+            self._runtime.pop(job_id, None)
+            if state["status"] == "running":
+                state["status"] = status
+                state["error"] = error
+                state["finished_at"] = _now()
+                self._save(state)
+            if state["status"] in ("completed", "cancelled"):
+                self._remove_items(job_id)
+
+    def _remove_items(self, job_id: str) -> None:
+        try:
+            os.remove(self._path(job_id, "items.jsonl"))
+        except OSError:
+            pass
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
@@ -0,0 +1,78 @@
+"""
+コレクション名 → 補助インデックス（語彙・量子化など）の遅延構築レジストリ
+
+インデックスは初回の get() でコレクションの全件から構築し、以後は書き込み時に peek() で取り出して差分更新する。
+インデックス側は build(iterable) と stats() を持っていればよい（max_bytes を使う時は nbytes() も）。
+max_bytes を指定すると、呼び出し側が fits() で確かめてから get() することで合計バイト数を上限内に抑える。
+"""
+
+from typing import Any, Callable, Iterable, Optional
+import threading
+
+
+class LazyIndexes:
+    def __init__(self, factory: Callable[[], Any], load: Callable[[str], Iterable], max_bytes: int = 0):
+        self._factory = factory
+        self._load = load
+        self.max_bytes = max_bytes  # 全コレクション合計の上限（0以下なら無制限）
+        self._indexes: dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._building: dict[str, threading.Event] = {}
+
+    def get(self, name: str) -> Any:
+        """インデックスを返す（未構築なら構築する。同時に呼ばれても構築は1回）"""
+        index = self._indexes.get(name)
+        if index is not None and name not in self._building:
+            return index
+        with self._lock:
+            index = self._indexes.get(name)
+            event = self._building.get(name)
+            owner = index is None
+            if owner:
+                index = self._indexes[name] = self._factory()
+                event = self._building[name] = threading.Event()
+        if not owner:
+            if event is not None:
+                event.wait()
+                if self._indexes.get(name) is not index:
+                    # 構築が失敗した / 作り直された
+                    return self.get(name)
+            return index
+        try:
+            index.build(self._load(name))
+        except Exception:
+            with self._lock:
+                self._indexes.pop(name, None)
+            raise
+        finally:
+            with self._lock:
+                self._building.pop(name, None)
+            event.set()
+        return index
+
+    def peek(self, name: str) -> Optional[Any]:
+        """構築済み（または構築中）なら返す。書き込み時の差分更新用"""
+        return self._indexes.get(name)
+
+    def fits(self, name: str, nbytes: int) -> bool:
+        """name のインデックス（見込み nbytes バイト）を持っても max_bytes に収まるか
+
+        収まらない時は name の構築済みインデックスを捨てる（書き込みで大きくなって上限を超えた場合）。
+        """
+        if self.max_bytes <= 0:
+            return True
+        others = sum(index.nbytes() for n, index in list(self._indexes.items()) if n != name)
+        if others + nbytes <= self.max_bytes:
+            return True
+        self.drop(name)
+        return False
+
+    def nbytes(self) -> int:
+        return sum(index.nbytes() for index in list(self._indexes.values()))
+
+    def drop(self, name: str) -> None:
+        with self._lock:
+            self._indexes.pop(name, None)
+
+    def stats(self) -> dict:
+        return {name: index.stats() for name, index in list(self._indexes.items())}
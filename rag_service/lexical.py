@@ -0,0 +1,191 @@
+"""
+コレクションごとの語彙（キーワード）転置インデックス + BM25
+
+ベクトル検索だけでは取りこぼす人名・型番・キャスト名などの完全一致を拾うためのもの。
+- トークナイズ: NFKC正規化 + 小文字化。漢字・かな・カナの連続は文字bigram（1文字だけなら unigram）、
+  英数字は単語単位
+- インデックスはメモリ上に持ち、初回利用時にコレクションから構築（lazy_index.LazyIndexes）、
+  以後はサービス経由の書き込みで差分更新する
+- 構築中に来た書き込みは構築側より優先する（古い本文で上書きしない）
+- ドキュメントには行番号を振り、語ごとのポスティング（行番号・tf）を numpy 配列で持つ。
+  検索はポスティングごとのベクトル演算でスコアを足すので、コーパス全体に出る語でも Python のループにならない
+- 更新は新しい行への追記、削除は alive=False。死んだ行が半分を超えたらポスティングを詰め直す
+"""
+
+from collections import Counter
+from typing import Iterable, Optional
+import math
+import re
+import threading
+import unicodedata
+
+import numpy as np
+
+CJK_RE = re.compile(r"[ぁ-ゟ゠-ヿ㐀-䶿一-鿿豈-﫿々〆ー]+")
+WORD_RE = re.compile(r"[0-9a-zÀ-ɏ]+(?:[._\-][0-9a-zÀ-ɏ]+)*")
+
+
+def tokenize(text: str) -> list[str]:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens: list[str] = []
+    for run in CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(WORD_RE.findall(text))
+    return tokens
+
+
+class Posting:
+    """1語のポスティング。rows[:size] が行番号、tfs[:size] が語の出現回数（死んだ行も残る）"""
+
+    __slots__ = ("rows", "tfs", "size")
+
+    def __init__(self):
+        self.rows = np.empty(4, dtype=np.int32)
+        self.tfs = np.empty(4, dtype=np.float32)
+        self.size = 0
+
+    def append(self, row: int, tf: int) -> None:
+        if self.size == len(self.rows):
+            self.rows = np.resize(self.rows, self.size * 2)
+            self.tfs = np.resize(self.tfs, self.size * 2)
+        self.rows[self.size] = row
+        self.tfs[self.size] = tf
+        self.size += 1
+
+
+class LexicalIndex:
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, Posting] = {}
+        self.df: dict[str, int] = {}  # 語 → 生きている行のうちその語を含む数
+        self.doc_terms: dict[str, tuple[str, ...]] = {}
+        self.ids: list[Optional[str]] = []  # 行 → id
+        self.rows: dict[str, int] = {}  # id → 行
+        self.doc_len = np.empty(0, dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        self.total_len = 0
+        self.lock = threading.RLock()
+        self._touched: Optional[set[str]] = None  # 構築中に書き込みがあったid
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, doc_id: str, text: str) -> None:
+        with self.lock:
+            if self._touched is not None:
+                self._touched.add(doc_id)
+            self._add(doc_id, text)
+
+    def remove(self, doc_id: str) -> None:
+        with self.lock:
+            if self._touched is not None:
+                self._touched.add(doc_id)
+            self._remove(doc_id)
+            if len(self.ids) > 1024 and len(self.rows) < len(self.ids) // 2:
+                self.compact()
+
+    def _add(self, doc_id: str, text: str) -> None:
+        self._remove(doc_id)
+        counts = Counter(tokenize(text))
+        row = len(self.ids)
+        if row == len(self.alive):
+            capacity = max(1024, row * 2)
+            self.doc_len = np.resize(self.doc_len, capacity)
+            self.alive = np.resize(self.alive, capacity)
+        self.ids.append(doc_id)
+        self.rows[doc_id] = row
+        for term, tf in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = Posting()
+            posting.append(row, tf)
+            self.df[term] = self.df.get(term, 0) + 1
+        self.doc_terms[doc_id] = tuple(counts)
+        n = sum(counts.values())
+        self.doc_len[row] = n
+        self.alive[row] = True
+        self.total_len += n
+
+    def _remove(self, doc_id: str) -> None:
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return
+        for term in self.doc_terms.pop(doc_id, ()):
+            self.df[term] -= 1
+            if not self.df[term]:
+                del self.df[term]
+                del self.postings[term]
+        self.alive[row] = False
+        self.ids[row] = None
+        self.total_len -= int(self.doc_len[row])
+
+    def compact(self) -> None:
+        """死んだ行を除いて行番号とポスティングを振り直す"""
+        with self.lock:
+            keep = np.flatnonzero(self.alive[:len(self.ids)])
+            remap = np.full(len(self.ids), -1, dtype=np.int32)
+            remap[keep] = np.arange(len(keep), dtype=np.int32)
+            for posting in self.postings.values():
+                rows = posting.rows[:posting.size]
+                live = self.alive[rows]
+                posting.rows = remap[rows[live]]
+                posting.tfs = posting.tfs[:posting.size][live]
+                posting.size = len(posting.rows)
+            self.doc_len = self.doc_len[keep].copy()
+            self.alive = np.ones(len(keep), dtype=bool)
+            self.ids = [self.ids[i] for i in keep]
+            self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+    def build(self, docs: Iterable[tuple[str, str]]) -> None:
+        """(id, text) 列から構築。構築中に add/remove されたidは読み込んだ本文で上書きしない"""
+        with self.lock:
+            self._touched = set()
+        try:
+            for doc_id, text in docs:
+                with self.lock:
+                    if doc_id not in self._touched:
+                        self._add(doc_id, text or "")
+        finally:
+            with self.lock:
+                self._touched = None
+
+    def search(self, query: str, k: int = 10, allowed: Optional[Iterable[str]] = None) -> list[tuple[str, float]]:
+        """BM25スコア上位k件の (id, score)。allowed を渡すとそのidだけを採点する"""
+        terms = Counter(tokenize(query))
+        with self.lock:
+            # ポスティングは追記と詰め直し（配列の差し替え）でしか変わらないので、参照だけ取ってロックの外で採点する
+            n_docs = len(self.rows)
+            if not n_docs or not terms or k <= 0:
+                return []
+            size = len(self.ids)
+            ids = self.ids
+            avgdl = self.total_len / n_docs or 1.0
+            doc_len, alive = self.doc_len[:size], self.alive[:size].copy()
+            postings = [(qtf, self.df[term], self.postings[term].rows[:self.postings[term].size],
+                         self.postings[term].tfs[:self.postings[term].size])
+                        for term, qtf in terms.items() if term in self.postings]
+            if allowed is not None:
+                mask = np.zeros(size, dtype=bool)
+                mask[[self.rows[doc_id] for doc_id in allowed if doc_id in self.rows]] = True
+                alive &= mask
+        scores = np.zeros(size, dtype=np.float32)
+        for qtf, df, rows, tfs in postings:
+            live = alive[rows]
+            rows, tfs = rows[live], tfs[live]
+            if not len(rows):
+                continue
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = tfs + self.k1 * (1 - self.b + self.b * doc_len[rows] / avgdl)
+            scores[rows] += qtf * idf * tfs * (self.k1 + 1) / norm  # 1語の中で行は重複しない
+        hit = np.flatnonzero(scores > 0)
+        if len(hit) > k:
+            hit = hit[np.argpartition(-scores[hit], k)[:k]]
+        hit = hit[np.argsort(-scores[hit], kind="stable")]
+        return [(ids[row], float(scores[row])) for row in hit]
+
+    def stats(self) -> dict:
+        return {"documents": len(self.rows), "terms": len(self.postings)}
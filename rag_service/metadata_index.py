@@ -0,0 +1,269 @@
+"""
+コレクションごとのメタデータ転置インデックス（指定したキーだけ）
+
+where付き検索で、条件に合うidの候補集合を先に引くためのもの。
+- 値 → id集合 を持ち、{"key": v} / {"key": {"$eq": v}} / {"$in": [...]} / $and / $or を集合演算で解く
+- 返すのは「条件に合うidを必ず含む集合」（上位集合）。未インデックスのキーや $ne・$gt などは絞り込みに使わず、
+  最終的な判定は matches() でメタデータに当てはめて行う。covers(where) が真なら候補集合がそのまま答えなので判定は要らない
+- matches() はChroma（SQLite）の where と同じ意味で判定する（数値はintとfloatを区別しない、$ne・$nin はキーがなくても真）
+- Chromaのupsertとupdateはメタデータをキーごとにマージするのでここでもマージする
+- 構築中に来た書き込みは構築側より優先する（古いメタデータで上書きしない）
+"""
+
+from typing import Any, Iterable, Optional
+import operator
+import threading
+
+_MISSING = object()
+
+_COMPARE = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+def _kind(value: Any) -> Optional[str]:
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "str"
+    return None
+
+
+def evaluable(where: dict) -> bool:
+    """matches() で判定できる where か（知らない演算子や形の崩れたものはChromaに任せる）"""
+    if not isinstance(where, dict) or not where:
+        return False
+    for key, cond in where.items():
+        if key in ("$and", "$or"):
+            if not isinstance(cond, list) or len(cond) < 2 or not all(evaluable(c) for c in cond):
+                return False
+        elif key.startswith("$"):
+            return False
+        elif isinstance(cond, dict):
+            if len(cond) != 1:
+                return False
+            op, value = next(iter(cond.items()))
+            if op in ("$eq", "$ne"):
+                if _kind(value) is None:
+                    return False
+            elif op in _COMPARE:
+                if _kind(value) != "number":
+                    return False
+            elif op in ("$in", "$nin"):
+                if not isinstance(value, list) or not value or len({type(v) for v in value}) != 1 or _kind(value[0]) is None:
+                    return False
+            else:
+                return False
+        elif _kind(cond) is None:
+            return False
+    return True
+
+
+def _equal(stored: Any, value: Any) -> bool:
+    return stored is not _MISSING and _kind(stored) == _kind(value) and stored == value
+
+
+def matches(where: dict, metadata: Optional[dict]) -> bool:
+    """evaluable(where) な where をメタデータ1件に当てはめる"""
+    metadata = metadata or {}
+    for key, cond in where.items():
+        if key == "$and":
+            ok = all(matches(c, metadata) for c in cond)
+        elif key == "$or":
+            ok = any(matches(c, metadata) for c in cond)
+        else:
+            stored = metadata.get(key, _MISSING)
+            op, value = next(iter(cond.items())) if isinstance(cond, dict) else ("$eq", cond)
+            if op == "$eq":
+                ok = _equal(stored, value)
+            elif op == "$ne":
+                ok = not _equal(stored, value)
+            elif op == "$in":
+                ok = any(_equal(stored, v) for v in value)
+            elif op == "$nin":
+                ok = not any(_equal(stored, v) for v in value)
+            else:
+                ok = _kind(stored) == "number" and _COMPARE[op](stored, value)
+        if not ok:
+            return False
+    return True
+
+
+class MetadataIndex:
+    def __init__(self, keys: Iterable[str]):
+        self.keys = frozenset(keys)
+        self.postings: dict[str, dict[Any, set[str]]] = {key: {} for key in self.keys}
+        self.doc_values: dict[str, dict[str, Any]] = {}
+        self.lock = threading.RLock()
+        self._touched: Optional[set[str]] = None  # 構築中に書き込みがあったid
+
+    def __len__(self) -> int:
+        return len(self.doc_values)
+
+    def update(self, doc_id: str, metadata: Optional[dict]) -> None:
+        """metadata のうちインデックス対象のキーをマージする（ドキュメントがなければ登録する）"""
+        with self.lock:
+            if self._touched is not None:
+                self._touched.add(doc_id)
+            self._update(doc_id, metadata)
+
+    def remove(self, doc_id: str) -> None:
+        with self.lock:
+            if self._touched is not None:
+                self._touched.add(doc_id)
+            self._remove(doc_id)
+
+    def _update(self, doc_id: str, metadata: Optional[dict]) -> None:
+        values = self.doc_values.setdefault(doc_id, {})
+        for key, value in (metadata or {}).items():
+            if key not in self.keys or values.get(key, _MISSING) == value:
+                continue
+            self._unlink(doc_id, key, values.get(key, _MISSING))
+            values[key] = value
+            self.postings[key].setdefault(value, set()).add(doc_id)
+
+    def _remove(self, doc_id: str) -> None:
+        for key, value in self.doc_values.pop(doc_id, {}).items():
+            self._unlink(doc_id, key, value)
+
+    def _unlink(self, doc_id: str, key: str, value: Any) -> None:
+        if value is _MISSING:
+            return
+        ids = self.postings[key].get(value)
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del self.postings[key][value]
+
+    def build(self, docs: Iterable[tuple[str, Optional[dict]]]) -> None:
+        """(id, metadata) 列から構築。構築中に update/remove されたidは読み込んだ値で上書きしない"""
+        with self.lock:
+            self._touched = set()
+        try:
+            for doc_id, metadata in docs:
+                with self.lock:
+                    if doc_id not in self._touched:
+                        self._update(doc_id, metadata)
+        finally:
+            with self.lock:
+                self._touched = None
+
+    def candidates(self, where: Optional[dict]) -> Optional[set[str]]:
+        """where を満たすidを含む候補集合。絞り込めない条件なら None"""
+        if not where:
+            return None
+        with self.lock:
+            return self._resolve(where)
+
+    def covers(self, where: dict) -> bool:
+        """where を候補集合だけで正確に解けるか（インデックス対象キーの等値・$eq・$in と、その $and / $or だけ）"""
+        for key, cond in where.items():
+            if key in ("$and", "$or"):
+                if not all(self.covers(c) for c in cond):
+                    return False
+            elif key not in self.keys or key.startswith("$"):
+                return False
+            elif isinstance(cond, dict) and (len(cond) != 1 or next(iter(cond)) not in ("$eq", "$in")):
+                return False
+        return True
+
+    def _resolve(self, where: dict) -> Optional[set[str]]:
+        clauses: list[Optional[set[str]]] = []
+        for key, cond in where.items():
+            if key == "$and":
+                clauses.extend(self._resolve(c) for c in cond)
+            elif key == "$or":
+                parts = [self._resolve(c) for c in cond]
+                clauses.append(None if any(p is None for p in parts) else set().union(*parts))
+            else:
+                clauses.append(self._resolve_key(key, cond))
+        narrowed = [c for c in clauses if c is not None]
+        if not narrowed:
+            return None
+        return set.intersection(*sorted(narrowed, key=len))
+
+    def _resolve_key(self, key: str, cond: Any) -> Optional[set[str]]:
+        if key not in self.keys or key.startswith("$"):
+            return None
+        postings = self.postings[key]
+        if not isinstance(cond, dict):
+            return set(postings.get(cond, ()))
+        if len(cond) != 1:
+            return None
+        op, value = next(iter(cond.items()))
+        if op == "$eq":
+            return set(postings.get(value, ()))
+        if op == "$in":
+            return set().union(*(postings.get(v, ()) for v in value))
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self.doc_values),
+            "keys": {key: len(values) for key, values in self.postings.items()},
+        }
+
+
+
+class FilterPlanner:
+    """where付き検索で「候補の総当たり」と「Chromaのフィルタ付き近傍検索」のどちらが安いかを実測で選ぶ
+
+    コレクションごとに、総当たりの候補1件あたりの採点時間・上位の本文取得時間と、フィルタ付き近傍検索1回の時間を
+    指数移動平均で持ち、見積もりが小さい方を選ぶ。まだ測っていない方があればそちらを試し、
+    explore_every 回に1回は選ばなかった方も使って見積もりを更新する。
+    """
+
+    def __init__(self, brute_force_max: int = 2000, alpha: float = 0.2, explore_every: int = 50):
+        self.brute_force_max = brute_force_max  # どちらも測れていない時の候補数のしきい値
+        self.alpha = alpha
+        self.explore_every = explore_every
+        self._costs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, name: str) -> dict:
+        return self._costs.setdefault(name, {"per_candidate": None, "fetch": None, "ann": None,
+                                             "calls": 0, "brute_force": 0, "ann_calls": 0})
+
+    def choose(self, name: str, candidates: int) -> str:
+        """"brute_force" か "ann" """
+        with self._lock:
+            c = self._entry(name)
+            c["calls"] += 1
+            if c["per_candidate"] is None and c["ann"] is None:
+                brute = candidates <= self.brute_force_max
+            elif c["per_candidate"] is None:
+                brute = True
+            elif c["ann"] is None:
+                brute = False
+            else:
+                brute = c["per_candidate"] * candidates + c["fetch"] <= c["ann"]
+                if c["calls"] % self.explore_every == 0:
+                    brute = not brute
+            c["brute_force" if brute else "ann_calls"] += 1
+            return "brute_force" if brute else "ann"
+
+    def _average(self, c: dict, key: str, value: float) -> None:
+        c[key] = value if c[key] is None else (1 - self.alpha) * c[key] + self.alpha * value
+
+    def record_brute_force(self, name: str, score_sec: float, candidates: int, fetch_sec: float) -> None:
+        with self._lock:
+            c = self._entry(name)
+            self._average(c, "per_candidate", score_sec / max(candidates, 1))
+            self._average(c, "fetch", fetch_sec)
+
+    def record_ann(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._average(self._entry(name), "ann", seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "per_candidate_us": None if c["per_candidate"] is None else round(c["per_candidate"] * 1e6, 3),
+                    "fetch_ms": None if c["fetch"] is None else round(c["fetch"] * 1000, 3),
+                    "ann_ms": None if c["ann"] is None else round(c["ann"] * 1000, 3),
+                    "brute_force": c["brute_force"],
+                    "ann": c["ann_calls"],
+                }
+                for name, c in self._costs.items()
+            }
@@ -0,0 +1,214 @@
+"""
+レイテンシ計測と Prometheus テキスト形式の /metrics
+
+- リクエスト単位: エンドポイント（ルートのパステンプレート）・メソッドごとの所要時間ヒストグラムと件数
+- 段階単位: stage("embed") のように囲んだ区間の時間を、リクエストごとに段階名で合計してヒストグラムへ
+  （ワーカースレッドで計測したものも contextvars 経由で元のリクエストに積まれる）
+- それ以外（キャッシュ・プール・コレクション件数など）は collector 関数が /metrics 生成時に値を返す
+
+計測は perf_counter の差分とロック付きの加算だけなので、有効にしたままでも負荷はほぼない。
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable, Optional
+import threading
+import time
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# collector が返す1系列: (メトリクス名, 型, 説明, [(ラベル, 値), ...])
+Sample = tuple[str, str, str, list[tuple[dict, float]]]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestTimings:
+    """1リクエスト分の段階ごとの所要時間（秒）"""
+
+    __slots__ = ("stages", "handler_done", "_lock")
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.handler_done: Optional[float] = None
+        self._lock = threading.Lock()  # ingestのembeddingなどは複数スレッドから同時に足される
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("rag_request_timings", default=None)
+
+
+class Metrics:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._help: dict[str, tuple[str, str]] = {}
+        self._collectors: list[Callable[[], Iterable[Sample]]] = []
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._help[name] = (kind, help_text)
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def collector(self, fn: Callable[[], Iterable[Sample]]) -> Callable[[], Iterable[Sample]]:
+        """/metrics 生成時に呼ばれる関数を登録する（デコレータとしても使える）"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines: list[str] = []
+        seen: set[str] = set()
+
+        def header(name: str, kind: str, help_text: str = "") -> None:
+            if name in seen:
+                return
+            seen.add(name)
+            kind, help_text = self._help.get(name, (kind, help_text))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = [(k, list(h.counts), h.sum, h.count) for k, h in sorted(self._histograms.items())]
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_labels(dict(labels))} {_number(value)}")
+        for (name, labels), counts, total, count in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels({**dict(labels), 'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{_labels(dict(labels))} {_number(total)}")
+            lines.append(f"{name}_count{_labels(dict(labels))} {count}")
+        for fn in self._collectors:
+            for name, kind, help_text, samples in fn():
+                header(name, kind, help_text)
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# --- 段階の計測 ---
+
+def record_stage(name: str, seconds: float) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("embed"): ... の区間を現在のリクエストの段階時間に足す（リクエスト外では何もしない）"""
+    if _current.get() is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def mark_handler_done() -> None:
+    """エンドポイント関数が戻った時刻。レスポンス開始までをシリアライズ時間として数える"""
+    timings = _current.get()
+    if timings is not None:
+        timings.handler_done = time.perf_counter()
+
+
+class MetricsMiddleware:
+    """ASGIミドルウェア。リクエストごとの時間・段階時間を記録し、必要なら Server-Timing ヘッダーを付ける"""
+
+    def __init__(self, app, metrics: Metrics, server_timing: bool = False):
+        self.app = app
+        self.metrics = metrics
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if timings.handler_done is not None:
+                    timings.add("serialize", time.perf_counter() - timings.handler_done)
+                if self.server_timing:
+                    total = time.perf_counter() - started
+                    entries = [f"{n};dur={s * 1000:.2f}" for n, s in timings.stages.items()]
+                    entries.append(f"total;dur={total * 1000:.2f}")
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", ", ".join(entries).encode())
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            m = self.metrics
+            m.observe("rag_request_duration_seconds", elapsed, method=method, endpoint=endpoint)
+            m.inc("rag_requests_total", method=method, endpoint=endpoint, status=str(status))
+            for name, seconds in timings.stages.items():
+                m.observe("rag_stage_duration_seconds", seconds, endpoint=endpoint, stage=name)
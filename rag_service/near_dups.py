@@ -0,0 +1,410 @@
+"""
+コレクション内の近似重複（意味的にほぼ同じドキュメント）の検出ジョブ
+
+embeddingをページ単位で流しながらコサイン類似度が threshold 以上の組を拾い、union-find で
+連結成分（クラスタ）にまとめる。組の拾い方は2通り。
+- exact: BLOCK_ROWS 行のブロックを作り、ブロック × 以降のページを行列積で総当たりする。
+  取りこぼしはないが O(n²·d) で、ページ列を ceil(n / BLOCK_ROWS) 回流し直す
+- ann:   各ページをそのままクエリにしてHNSWで近傍k件を引く。1回流すだけで O(n·log n)。
+  1件から k 件より多くつながる大きなクラスタも、連結成分としてはまとまる
+保持するのはブロック・ページ分の行列と、重複に関わったidの union-find だけなので、
+メモリは件数×次元に比例しない。
+
+クラスタごとに残す1件（keep）を選び、action が delete なら残り（duplicates）を消す。
+merge なら、残す1件に無いメタデータを duplicates から補い、merged_ids を足してから残りを消す。
+
+<jobs_dir>/<job_id>/
+  state.json      状態・進捗・件数
+  clusters.jsonl  クラスタ（1行1件、大きい順）
+"""
+
+from typing import Callable, Iterable, Iterator, Optional
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from quantized import BLOCK_ROWS, normalize
+
+ACTIVE = ("queued", "running")
+CHUNK_KEYS = ("parent_id", "chunk_index", "chunk_count", "section")  # merge で補わないキー
+FETCH_SIZE = 500  # クラスタの本文・メタデータを1回に読む件数
+logger = logging.getLogger("rag_service.near_dups")
+
+Pages = Iterable[tuple[list[str], np.ndarray]]
+
+
+class DedupJobNotFound(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class UnionFind:
+    """重複に関わったidだけを持つ union-find（代表は小さい方のid）"""
+
+    def __init__(self):
+        self.parent: dict[str, str] = {}
+
+    def find(self, x: str) -> str:
+        parent = self.parent
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a: str, b: str) -> None:
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            if rb < ra:
+                ra, rb = rb, ra
+            self.parent[rb] = ra
+
+    def groups(self) -> list[list[str]]:
+        members: dict[str, list[str]] = {}
+        for x in self.parent:
+            members.setdefault(self.find(x), []).append(x)
+        return [sorted(m) for m in members.values()]
+
+
+# --- 組の列挙 ---
+
+def _pairs(left_ids: list[str], left: np.ndarray, right_ids: list[str], right: np.ndarray,
+           threshold: float, offset: Optional[int] = None) -> Iterator[tuple[str, str, float]]:
+    """left × right で類似度 threshold 以上の組。offset は同じブロック内の比較で right の先頭行の位置（行 < 列 だけ拾う）"""
+    sims = left @ right.T
+    rows, cols = np.nonzero(sims >= threshold)
+    if offset is not None:
+        keep = rows < cols + offset
+        rows, cols = rows[keep], cols[keep]
+    for r, c in zip(rows.tolist(), cols.tolist()):
+        yield left_ids[r], right_ids[c], float(sims[r, c])
+
+
+def exact_pairs(pages: Callable[[], Pages], threshold: float,
+                block_rows: int = BLOCK_ROWS) -> Iterator[tuple[str, str, float]]:
+    """類似度 threshold 以上の組を総当たりで漏れなく列挙する
+
+    pages() は呼ぶたびに同じ順で (ids, 行列) のページ列を最初から返すこと。
+    ページを block_rows 行までブロックに溜め、ブロック内と、ブロックより後ろの各ページとを行列積で比べる。
+    """
+    done = 0  # 外側のブロックとして処理し終えたページ数
+    while True:
+        held: list[tuple[list[str], np.ndarray]] = []  # ブロックに入れたページ
+        block_ids: list[str] = []
+        block: Optional[np.ndarray] = None
+        for page_no, (ids, matrix) in enumerate(pages()):
+            if page_no < done:
+                continue
+            page = normalize(matrix)
+            if block is None:
+                held.append((ids, page))
+                block_ids.extend(ids)
+                if len(block_ids) < block_rows:
+                    continue
+                block = np.concatenate([p for _, p in held])
+                yield from _within(block_ids, block, held, threshold)
+                continue
+            yield from _pairs(block_ids, block, ids, page, threshold)
+        if not held:
+            return
+        if block is None:  # 最後のブロック（block_rows に届かないまま終わった）
+            block = np.concatenate([p for _, p in held])
+            yield from _within(block_ids, block, held, threshold)
+        done += len(held)
+
+
+def _within(block_ids: list[str], block: np.ndarray, held: list[tuple[list[str], np.ndarray]],
+            threshold: float) -> Iterator[tuple[str, str, float]]:
+    start = 0
+    for ids, page in held:
+        end = start + len(ids)
+        yield from _pairs(block_ids[:end], block[:end], ids, page, threshold, offset=start)
+        start = end
+
+
+def ann_pairs(pages: Pages, search: Callable[[np.ndarray, int], tuple[list[list[str]], list[list[float]]]],
+              threshold: float, k: int) -> Iterator[tuple[str, str, float]]:
+    """各ページをクエリにして近傍k件を引き、類似度 threshold 以上の組を列挙する
+
+    search(行列, n) は各行の近傍 (ids, コサイン距離) を返すもの。近傍は対称でないので a→b と b→a の両方が
+    見つかることがあるが、exact と同じく組は1回だけ返す。
+    """
+    seen: set[tuple[str, str]] = set()
+    for ids, matrix in pages:
+        found, distances = search(matrix, k + 1)  # 1件目は自分自身
+        for doc_id, neighbors, dists in zip(ids, found, distances):
+            for other, d in zip(neighbors, dists):
+                sim = 1 - d
+                if other == doc_id or sim < threshold:
+                    continue
+                pair = (min(doc_id, other), max(doc_id, other))
+                if pair not in seen:
+                    seen.add(pair)
+                    yield doc_id, other, sim
+
+
+def exact_rows(n: int, block_rows: int, page_size: int) -> int:
+    """exact で流すおおよその延べ行数（進捗の分母）"""
+    block_rows = max(block_rows, page_size)
+    return sum(n - start for start in range(0, n, block_rows))
+
+
+# --- クラスタ ---
+
+def _rank(value) -> tuple:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value, "")
+    return (1, 0, str(value))
+
+
+def choose_keep(members: list[str], docs: dict[str, tuple[str, dict]], keep_by: Optional[str]) -> str:
+    """残す1件。keep_by のメタデータが最大のもの → 本文が最長のもの → idが最小のもの"""
+    def key(doc_id: str) -> tuple:
+        text, meta = docs[doc_id]
+        value = (meta or {}).get(keep_by) if keep_by else None
+        return (value is not None, _rank(value) if value is not None else (), len(text or ""))
+
+    return max(sorted(members), key=key)  # 同点なら先に出たもの（idが最小）
+
+
+def merged_metadata(keep: dict, others: list[dict], duplicate_ids: list[str]) -> dict:
+    meta = dict(keep or {})
+    for other in others:
+        for key, value in (other or {}).items():
+            if key not in meta and key not in CHUNK_KEYS and key != "merged_ids":
+                meta[key] = value
+    merged = [i for i in str(meta.get("merged_ids") or "").split(",") if i]
+    meta["merged_ids"] = ",".join(dict.fromkeys(merged + duplicate_ids))
+    return meta
+
+
+class NearDuplicateJobs:
+    def __init__(self, jobs_dir: str, count: Callable[[str], int], pages: Callable[[str], Pages],
+                 search: Callable[[str, np.ndarray, int], tuple[list[list[str]], list[list[float]]]],
+                 fetch: Callable[[str, list[str]], dict[str, tuple[str, dict]]],
+                 delete: Callable[[str, list[str]], int], update_metadata: Callable[[str, str, dict], None],
+                 exact_max: int = 100000, page_size: int = 500):
+        self.jobs_dir = jobs_dir
+        self.count = count
+        self.pages = pages
+        self.search = search
+        self.fetch = fetch
+        self.delete = delete
+        self.update_metadata = update_metadata
+        self.exact_max = exact_max
+        self.page_size = page_size
+        self._states: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    # --- 起動・保存 ---
+
+    def start(self) -> None:
+        """保存済みジョブを読み込み、ワーカーを起動する。途中だったジョブは再開せず failed にする"""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            try:
+                with open(self._path(job_id, "state.json"), encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if state["status"] in ACTIVE:
+                state.update(status="failed", error="interrupted by restart", finished_at=_now())
+                self._save(state)
+            self._states[job_id] = state
+        self._thread = threading.Thread(target=self._worker, name="rag-dedup", daemon=True)
+        self._thread.start()
+
+    def _path(self, job_id: str, name: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, name)
+
+    def _save(self, state: dict) -> None:
+        path = self._path(state["id"], "state.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    # --- API ---
+
+    def submit(self, collection: str, threshold: float, method: str = "auto", k: int = 10,
+               action: str = "report", keep_by: Optional[str] = None) -> dict:
+        job_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.join(self.jobs_dir, job_id))
+        state = {
+            "id": job_id,
+            "status": "queued",
+            "collection": collection,
+            "threshold": threshold,
+            "method": method,
+            "k": k,
+            "action": action,
+            "keep_by": keep_by,
+            "documents": None,
+            "scanned": 0,
+            "progress": 0.0,
+            "pairs": 0,
+            "clusters": 0,
+            "duplicates": 0,
+            "removed": 0,
+            "elapsed_sec": 0.0,
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+        }
+        with self._lock:
+            self._states[job_id] = state
+            self._save(state)
+        self._queue.put(job_id)
+        return self.status(job_id)
+
+    def status(self, job_id: str) -> dict:
+        with self._lock:
+            state = self._states.get(job_id)
+            if state is None:
+                raise DedupJobNotFound(job_id)
+            return dict(state)
+
+    def all(self) -> list[dict]:
+        with self._lock:
+            return [dict(self._states[job_id]) for job_id in sorted(self._states, reverse=True)]
+
+    def clusters(self, job_id: str, limit: Optional[int] = None) -> Iterator[dict]:
+        """保存済みのクラスタ（大きい順）"""
+        self.status(job_id)
+        try:
+            f = open(self._path(job_id, "clusters.jsonl"), encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for i, line in enumerate(f):
+                if limit is not None and i >= limit:
+                    return
+                yield json.loads(line)
+
+    def cancel(self, job_id: str) -> dict:
+        with self._lock:
+            state = self._states.get(job_id)
+            if state is None:
+                raise DedupJobNotFound(job_id)
+            if state["status"] in ACTIVE:
+                state["status"] = "cancelled"
+                state["finished_at"] = _now()
+                self._save(state)
+        return self.status(job_id)
+
+    # --- ワーカー ---
+
+    def _worker(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                state = self._states[job_id]
+                if state["status"] != "queued":
+                    continue
+                state.update(status="running", started_at=_now())
+                self._save(state)
+            started = time.monotonic()
+            try:
+                self._run(state)
+                status, error = "completed", None
+            except Cancelled:
+                status, error = "cancelled", None
+            except Exception as e:
+                logger.exception("near-duplicate job %s failed", job_id)
+                status, error = "failed", str(e)
+            with self._lock:
+                state["elapsed_sec"] = round(time.monotonic() - started, 3)
+                if state["status"] == "running":
+                    state.update(status=status, error=error, finished_at=_now())
+                self._save(state)
+
+    def _update(self, state: dict, **values) -> None:
+        with self._lock:
+            if state["status"] != "running":
+                raise Cancelled()
+            state.update(values)
+
+    def _run(self, state: dict) -> None:
+        name, threshold = state["collection"], state["threshold"]
+        n = self.count(name)
+        method = state["method"]
+        if method == "auto":
+            method = "exact" if n <= self.exact_max else "ann"
+        expected = exact_rows(n, BLOCK_ROWS, self.page_size) if method == "exact" else n
+        self._update(state, documents=n, method=method)
+
+        def tracked() -> Iterator[tuple[list[str], np.ndarray]]:
+            for ids, matrix in self.pages(name):
+                yield ids, matrix
+                scanned = state["scanned"] + len(ids)
+                self._update(state, scanned=scanned, progress=round(min(scanned / expected, 1.0), 4) if expected else 1.0)
+
+        if method == "exact":
+            pairs = exact_pairs(tracked, threshold)
+        else:
+            pairs = ann_pairs(tracked(), lambda matrix, k: self.search(name, matrix, k), threshold, state["k"])
+        uf = UnionFind()
+        best: dict[str, float] = {}  # id → クラスタ内の他のどれかとの最大類似度
+        found = 0
+        for a, b, sim in pairs:
+            uf.union(a, b)
+            best[a] = max(best.get(a, sim), sim)
+            best[b] = max(best.get(b, sim), sim)
+            found += 1
+        groups = sorted(uf.groups(), key=lambda m: (-len(m), m[0]))
+        self._update(state, pairs=found, clusters=len(groups), duplicates=sum(len(m) - 1 for m in groups),
+                     progress=1.0)
+        logger.info("near-duplicate job %s: %s %d docs, %d clusters (%s)",
+                    state["id"], name, n, len(groups), method)
+        self._write_clusters(state, groups, best)
+
+    def _write_clusters(self, state: dict, groups: list[list[str]], best: dict[str, float]) -> None:
+        name, action = state["collection"], state["action"]
+        removed = 0
+        with open(self._path(state["id"], "clusters.jsonl"), "w", encoding="utf-8") as f:
+            start = 0
+            while start < len(groups):
+                batch, size = [], 0
+                while start < len(groups) and (not batch or size + len(groups[start]) <= FETCH_SIZE):
+                    batch.append(groups[start])
+                    size += len(groups[start])
+                    start += 1
+                docs = self.fetch(name, [doc_id for members in batch for doc_id in members])
+                drop: list[str] = []
+                for members in batch:
+                    present = [m for m in members if m in docs]  # ジョブの途中で消えたものは除く
+                    if len(present) < 2:
+                        continue
+                    keep = choose_keep(present, docs, state["keep_by"])
+                    duplicates = [m for m in present if m != keep]
+                    if action == "merge":
+                        meta = merged_metadata(docs[keep][1], [docs[d][1] for d in duplicates], duplicates)
+                        self.update_metadata(name, keep, meta)
+                    if action in ("delete", "merge"):
+                        drop.extend(duplicates)
+                    cluster = {
+                        "keep": keep,
+                        "size": len(present),
+                        "duplicates": [{"id": d, "max_similarity": round(best.get(d, 0.0), 4)} for d in duplicates],
+                        "action": {"delete": "deleted", "merge": "merged"}.get(action),
+                    }
+                    f.write(json.dumps(cluster, ensure_ascii=False) + "\n")
+                if drop:
+                    removed += self.delete(name, drop)
+                self._update(state, removed=removed)
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
@@ -0,0 +1,244 @@
+"""
+コレクションごとの量子化embedding（int8 / binary）の二次インデックス
+
+大きいコレクションの検索で、量子化した行列を総当たりして候補を多めに拾い、
+候補だけを元のfloat32 embeddingで再スコアするためのもの。
+- int8:   単位ベクトル化した各行を max|x| / 127 でスケールして int8 に丸める（1要素1バイト + 行ごとのscale）
+- binary: 単位ベクトルの符号だけを1ビットで持つ（1要素1/8バイト）。近さはハミング距離で測る
+- float32: 量子化せず単位ベクトルをそのまま持つ（where候補の採点用。score() の値はコサイン類似度そのもの）
+- 行は追記し、削除は alive=False にして、死んだ行が半分を超えたら詰め直す
+- 構築中に来た書き込みは構築側より優先する（古いembeddingで上書きしない）
+
+ChromaのHNSWインデックスはそのまま残るので、メモリは「減る」のではなく
+int8 で n·d バイト、binary で n·d/8 バイト分「増える」。float32の行列（n·d·4 バイト）を
+自前で持つ場合に比べて 1/4（int8）・1/32（binary）で済む、という位置づけ。
+"""
+
+from typing import Iterable, Optional
+import threading
+
+import numpy as np
+
+KINDS = ("int8", "binary", "float32")
+BLOCK_ROWS = 65536  # 総当たり時に一度にfloatへ展開する行数
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.where(norms == 0, 1, norms)
+
+
+def topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """scores の大きい順に上位k件のインデックス"""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    part = np.argpartition(-scores, k)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def exact_topk(queries: np.ndarray, pages: Iterable[tuple[list[str], np.ndarray]], k: int) -> list[list[tuple[str, float]]]:
+    """(ids, 行列) のページ列を流しながら、各クエリのコサイン類似度上位k件を厳密に求める"""
+    q = normalize(np.atleast_2d(queries))
+    best_ids: list[list[str]] = [[] for _ in q]
+    best_scores = [np.empty(0, dtype=np.float32) for _ in q]
+    for ids, matrix in pages:
+        if not len(ids):
+            continue
+        scores = normalize(matrix) @ q.T  # (page, queries)
+        for j in range(len(q)):
+            merged_ids = best_ids[j] + list(ids)
+            merged = np.concatenate([best_scores[j], scores[:, j]])
+            keep = topk(merged, k)
+            best_ids[j] = [merged_ids[i] for i in keep]
+            best_scores[j] = merged[keep]
+    return [list(zip(i, s.tolist())) for i, s in zip(best_ids, best_scores)]
+
+
+def row_bytes(kind: str, dim: int) -> int:
+    """1行あたりのバイト数（int8 は行ごとのscale込み）"""
+    if kind == "binary":
+        return (dim + 7) // 8
+    if kind == "int8":
+        return dim + 4
+    return dim * 4
+
+
+class QuantizedIndex:
+    def __init__(self, kind: str = "int8"):
+        if kind not in KINDS:
+            raise ValueError(f"unsupported quantization: {kind} (allowed: {KINDS})")
+        self.kind = kind
+        self.dim: Optional[int] = None
+        self.codes: Optional[np.ndarray] = None
+        self.scales = np.empty(0, dtype=np.float32)  # int8 のみ
+        self.alive = np.empty(0, dtype=bool)
+        self.ids: list[Optional[str]] = []  # 行 → id
+        self.rows: dict[str, int] = {}  # id → 行
+        self.lock = threading.RLock()
+        self._touched: Optional[set[str]] = None  # 構築中に書き込みがあったid
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    # --- 符号化 ---
+
+    def _encode(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        v = normalize(vectors)
+        if self.kind == "float32":
+            return v, np.empty(0, dtype=np.float32)
+        if self.kind == "binary":
+            return np.packbits(v > 0, axis=1), np.empty(0, dtype=np.float32)
+        scales = np.abs(v).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.rint(v / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _reserve(self, n: int) -> None:
+        """行数 n まで入るように配列を伸ばす（倍々）"""
+        capacity = 0 if self.codes is None else len(self.codes)
+        if n <= capacity:
+            return
+        capacity = max(n, capacity * 2, 1024)
+        width = (self.dim + 7) // 8 if self.kind == "binary" else self.dim
+        dtype = {"binary": np.uint8, "int8": np.int8, "float32": np.float32}[self.kind]
+        codes = np.zeros((capacity, width), dtype=dtype)
+        alive = np.zeros(capacity, dtype=bool)
+        size = len(self.ids)
+        if self.codes is not None:
+            codes[:size] = self.codes[:size]
+            alive[:size] = self.alive[:size]
+        self.codes, self.alive = codes, alive
+        if self.kind == "int8":
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:size] = self.scales[:size]
+            self.scales = scales
+
+    # --- 書き込み ---
+
+    def upsert(self, ids: list[str], vectors: np.ndarray) -> None:
+        with self.lock:
+            if self._touched is not None:
+                self._touched.update(ids)
+            self._upsert(list(ids), vectors)
+
+    def remove(self, ids: list[str]) -> None:
+        with self.lock:
+            if self._touched is not None:
+                self._touched.update(ids)
+            for doc_id in ids:
+                row = self.rows.pop(doc_id, None)
+                if row is not None:
+                    self.alive[row] = False
+                    self.ids[row] = None
+            if len(self.ids) > 1024 and len(self.rows) < len(self.ids) // 2:
+                self.compact()
+
+    def _upsert(self, ids: list[str], vectors: np.ndarray) -> None:
+        if not ids:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"dimension mismatch: index has {self.dim}, got {vectors.shape[1]}")
+        codes, scales = self._encode(vectors)
+        new = [doc_id for doc_id in dict.fromkeys(ids) if doc_id not in self.rows]
+        self._reserve(len(self.ids) + len(new))
+        for doc_id in new:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+        rows = np.array([self.rows[doc_id] for doc_id in ids], dtype=np.int64)
+        self.codes[rows] = codes
+        if self.kind == "int8":
+            self.scales[rows] = scales
+        self.alive[rows] = True
+
+    def compact(self) -> None:
+        """削除済みの行を詰める"""
+        with self.lock:
+            if self.codes is None:
+                return
+            keep = np.flatnonzero(self.alive[:len(self.ids)])
+            self.codes = self.codes[keep].copy()
+            self.alive = np.ones(len(keep), dtype=bool)
+            if self.kind == "int8":
+                self.scales = self.scales[keep].copy()
+            self.ids = [self.ids[i] for i in keep]
+            self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+    def build(self, pages: Iterable[tuple[list[str], np.ndarray]]) -> None:
+        """(ids, 行列) のページ列から構築。構築中に upsert/remove されたidは読み込んだ値で上書きしない"""
+        with self.lock:
+            self._touched = set()
+        try:
+            for ids, matrix in pages:
+                with self.lock:
+                    keep = [i for i, doc_id in enumerate(ids) if doc_id not in self._touched]
+                    if keep:
+                        self._upsert([ids[i] for i in keep], np.asarray(matrix, dtype=np.float32)[keep])
+        finally:
+            with self.lock:
+                self._touched = None
+
+    # --- 検索 ---
+
+    def search(self, query: np.ndarray, k: int = 10) -> list[tuple[str, float]]:
+        """近似スコア上位k件の (id, score)。int8 はコサイン類似度の近似、binary は 1 − 2·ハミング距離/次元"""
+        with self.lock:
+            size = len(self.ids)
+            if not self.rows or k <= 0:
+                return []
+            q = normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+            if len(q) != self.dim:
+                raise ValueError(f"dimension mismatch: index has {self.dim}, query has {len(q)}")
+            qbits = np.packbits(q > 0) if self.kind == "binary" else None
+            scores = np.empty(size, dtype=np.float32)
+            for start in range(0, size, BLOCK_ROWS):
+                end = min(start + BLOCK_ROWS, size)
+                block = self.codes[start:end]
+                if self.kind == "binary":
+                    hamming = POPCOUNT[np.bitwise_xor(block, qbits)].sum(axis=1, dtype=np.int32)
+                    scores[start:end] = 1 - 2 * hamming / self.dim
+                elif self.kind == "float32":
+                    scores[start:end] = block @ q
+                else:
+                    scores[start:end] = (block.astype(np.float32) @ q) * self.scales[start:end]
+            scores[~self.alive[:size]] = -np.inf
+            order = topk(scores, min(k, len(self.rows)))
+            return [(self.ids[i], float(scores[i])) for i in order]
+
+    def score(self, queries: np.ndarray, ids: Iterable[str]) -> tuple[list[str], np.ndarray]:
+        """ids のうちインデックスにあるものだけを各クエリと採点する。(id列, クエリ数×id数 の行列)"""
+        q = normalize(np.atleast_2d(queries))
+        with self.lock:
+            found = [doc_id for doc_id in ids if doc_id in self.rows]
+            if not found:
+                return [], np.empty((len(q), 0), dtype=np.float32)
+            if q.shape[1] != self.dim:
+                raise ValueError(f"dimension mismatch: index has {self.dim}, query has {q.shape[1]}")
+            rows = np.fromiter((self.rows[doc_id] for doc_id in found), dtype=np.int64, count=len(found))
+            codes = self.codes[rows]
+            scales = self.scales[rows] if self.kind == "int8" else None
+        if self.kind == "float32":
+            return found, q @ codes.T
+        if self.kind == "int8":
+            return found, (q @ codes.astype(np.float32).T) * scales
+        hamming = POPCOUNT[np.bitwise_xor(codes[None], np.packbits(q > 0, axis=1)[:, None])].sum(axis=2, dtype=np.int32)
+        return found, 1 - 2 * hamming / self.dim
+
+    def nbytes(self) -> int:
+        """生きている行分の量子化データのバイト数（行ごとのscale込み）"""
+        if self.codes is None:
+            return 0
+        return len(self.rows) * row_bytes(self.kind, self.dim)
+
+    def stats(self) -> dict:
+        n = len(self.rows)
+        return {
+            "kind": self.kind,
+            "documents": n,
+            "dim": self.dim,
+            "bytes": self.nbytes(),
+            "float32_bytes": n * (self.dim or 0) * 4,
+        }
@@ -0,0 +1,74 @@
+"""
+コレクションハンドルのプロセス内レジストリ
+
+get_or_create_collection と count() は毎回SQLiteを叩くので、ハンドルと件数をここで保持する。
+件数はサービス経由の書き込みで増減させ、一定時間ごと（または明示的なrefresh）に実数と突き合わせる。
+"""
+
+from typing import Callable, Optional
+import threading
+import time
+
+from chromadb.api.models.Collection import Collection
+
+
+class CollectionRegistry:
+    def __init__(self, open_collection: Callable[[str], Collection], reconcile_interval: float = 300.0):
+        self._open = open_collection
+        self.reconcile_interval = reconcile_interval  # 秒。0以下なら自動突き合わせしない
+        self._handles: dict[str, Collection] = {}
+        self._counts: dict[str, int] = {}
+        self._counted_at: dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    def get(self, name: str) -> Collection:
+        col = self._handles.get(name)
+        if col is None:
+            with self._lock:
+                col = self._handles.get(name)
+                if col is None:
+                    col = self._open(name)
+                    self._handles[name] = col
+        return col
+
+    def count(self, name: str) -> int:
+        # drop() と競合しないよう、件数と数えた時刻はロックの中でまとめて読む（消えていたら数え直す）
+        with self._lock:
+            n = self._counts.get(name)
+            counted_at = self._counted_at.get(name)
+        if n is None or counted_at is None or (
+            self.reconcile_interval > 0 and time.monotonic() - counted_at > self.reconcile_interval
+        ):
+            return self.reconcile(name)
+        return n
+
+    def adjust(self, name: str, delta: int) -> None:
+        """サービス経由で追加/削除した件数を反映"""
+        if not delta:
+            return
+        with self._lock:
+            if name in self._counts:
+                self._counts[name] = max(0, self._counts[name] + delta)
+
+    def reconcile(self, name: str) -> int:
+        """実際の件数を数え直す"""
+        n = self.get(name).count()
+        with self._lock:
+            self._counts[name] = n
+            self._counted_at[name] = time.monotonic()
+        return n
+
+    def reconcile_all(self) -> dict[str, int]:
+        return {name: self.reconcile(name) for name in list(self._handles)}
+
+    def drop(self, name: Optional[str] = None) -> None:
+        """コレクション削除時などにハンドルを捨てる（name省略で全部）"""
+        with self._lock:
+            names = [name] if name is not None else list(self._handles)
+            for n in names:
+                self._handles.pop(n, None)
+                self._counts.pop(n, None)
+                self._counted_at.pop(n, None)
+
+    def stats(self) -> dict:
+        return {"collections": len(self._handles), "counts": dict(self._counts)}
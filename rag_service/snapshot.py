@@ -0,0 +1,170 @@
+"""
+コレクションのスナップショット（embedding済みのまま持ち運ぶ形式）
+
+<snapshot>/
+  manifest.json     コレクション名・メタデータ・次元・件数・dtype・embeddingモデル
+  embeddings.f32    行優先で連続した埋め込み行列（--dtype float16 なら embeddings.f16）
+  ids.tsv           行番号 \t records.jsonl 内のバイトオフセット \t id
+  records.jsonl     1行1レコード {"id", "text", "metadata"}（embeddings と同じ行順）
+
+importは行列をmemmapして、embeddingモデルを通さずにバッチでupsertする。
+
+CLI（サービス停止中にボリュームを直接扱う時）:
+  python snapshot.py export <collection> <out_dir> [--dtype float16]
+  python snapshot.py import <snapshot_dir> [--collection NAME] [--force]
+"""
+
+from typing import Callable, Optional
+import json
+import os
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+DTYPES = {"float32": ("f32", np.float32), "float16": ("f16", np.float16)}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def export_collection(col, iter_id_pages: Callable, out_dir: str, dtype: str = "float32",
+                      embedding_model: str = "", page_size: int = 500) -> dict:
+    """col を out_dir に書き出す。iter_id_pages(collection_id, page_size) はidをページ単位で返すもの"""
+    if dtype not in DTYPES:
+        raise SnapshotError(f"unsupported dtype: {dtype} (allowed: {list(DTYPES)})")
+    ext, np_dtype = DTYPES[dtype]
+    os.makedirs(out_dir, exist_ok=True)
+    started = time.perf_counter()
+    rows = 0
+    dim = None
+    with open(os.path.join(out_dir, f"embeddings.{ext}"), "wb") as emb_f, \
+            open(os.path.join(out_dir, "records.jsonl"), "wb") as rec_f, \
+            open(os.path.join(out_dir, "ids.tsv"), "w", encoding="utf-8") as ids_f:
+        for ids in iter_id_pages(str(col.id), page_size):
+            got = col.get(ids=ids, include=["embeddings", "documents", "metadatas"])
+            matrix = np.asarray(got["embeddings"], dtype=np_dtype)
+            if dim is None and len(matrix):
+                dim = matrix.shape[1]
+            emb_f.write(np.ascontiguousarray(matrix).tobytes())
+            for doc_id, text, meta in zip(got["ids"], got["documents"], got["metadatas"]):
+                ids_f.write(f"{rows}\t{rec_f.tell()}\t{doc_id}\n")
+                line = json.dumps({"id": doc_id, "text": text, "metadata": meta}, ensure_ascii=False)
+                rec_f.write(line.encode() + b"\n")
+                rows += 1
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "collection": col.name,
+        "collection_metadata": col.metadata or {},
+        "count": rows,
+        "dim": dim or 0,
+        "dtype": dtype,
+        "embeddings_file": f"embeddings.{ext}",
+        "embedding_model": embedding_model,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return {**manifest, "path": out_dir, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+def read_manifest(snapshot_dir: str) -> dict:
+    path = os.path.join(snapshot_dir, "manifest.json")
+    if not os.path.exists(path):
+        raise SnapshotError(f"manifest.json not found in {snapshot_dir}")
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(f"unsupported snapshot format: {manifest.get('format_version')}")
+    return manifest
+
+
+def load_embeddings(snapshot_dir: str, manifest: dict) -> np.ndarray:
+    """埋め込み行列を読み取り専用でmemmapする"""
+    _, np_dtype = DTYPES[manifest["dtype"]]
+    if manifest["count"] == 0:
+        return np.empty((0, manifest["dim"]), dtype=np_dtype)
+    return np.memmap(os.path.join(snapshot_dir, manifest["embeddings_file"]), dtype=np_dtype, mode="r",
+                     shape=(manifest["count"], manifest["dim"]))
+
+
+def import_snapshot(open_collection: Callable[[str, dict], object], snapshot_dir: str,
+                    collection: Optional[str] = None, embedding_model: str = "",
+                    force: bool = False, batch_size: int = 1000) -> dict:
+    """スナップショットをコレクションへ投入する（embeddingモデルは使わない）
+
+    open_collection(name, collection_metadata) は投入先のコレクションを返すもの。
+    embeddingモデルが違うスナップショットは force=True でない限り拒否する。
+    """
+    manifest = read_manifest(snapshot_dir)
+    if embedding_model and manifest.get("embedding_model") and manifest["embedding_model"] != embedding_model \
+            and not force:
+        raise SnapshotError(
+            f"snapshot was embedded with {manifest['embedding_model']}, service uses {embedding_model}"
+        )
+    started = time.perf_counter()
+    matrix = load_embeddings(snapshot_dir, manifest)
+    col = open_collection(collection or manifest["collection"], manifest.get("collection_metadata") or {})
+    rows = 0
+    with open(os.path.join(snapshot_dir, "records.jsonl"), encoding="utf-8") as rec_f:
+        batch: list[dict] = []
+        for line in rec_f:
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                _upsert(col, batch, matrix[rows:rows + len(batch)])
+                rows += len(batch)
+                batch = []
+        if batch:
+            _upsert(col, batch, matrix[rows:rows + len(batch)])
+            rows += len(batch)
+    if rows != manifest["count"]:
+        raise SnapshotError(f"records.jsonl has {rows} rows, manifest says {manifest['count']}")
+    elapsed = time.perf_counter() - started
+    return {
+        "collection": col.name,
+        "imported": rows,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "docs_per_sec": round(rows / elapsed, 1) if elapsed else None,
+    }
+
+
+def _upsert(col, records: list[dict], embeddings: np.ndarray) -> None:
+    col.upsert(
+        ids=[r["id"] for r in records],
+        embeddings=np.asarray(embeddings, dtype=np.float32),
+        documents=[r["text"] for r in records],
+        metadatas=[r["metadata"] or None for r in records],
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import chromadb
+
+    from chroma_sqlite import ChromaSQLite
+
+    parser = argparse.ArgumentParser(description="rag_service collection snapshot")
+    parser.add_argument("--chroma-path", default=os.environ.get("CHROMA_PATH", "/data/chroma"))
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_exp = sub.add_parser("export")
+    p_exp.add_argument("collection")
+    p_exp.add_argument("out_dir")
+    p_exp.add_argument("--dtype", default="float32", choices=list(DTYPES))
+    p_imp = sub.add_parser("import")
+    p_imp.add_argument("snapshot_dir")
+    p_imp.add_argument("--collection")
+    p_imp.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=args.chroma_path)
+    if args.cmd == "export":
+        result = export_collection(client.get_collection(args.collection),
+                                   ChromaSQLite(args.chroma_path).iter_id_pages, args.out_dir, args.dtype)
+    else:
+        result = import_snapshot(
+            lambda name, meta: client.get_or_create_collection(name=name, metadata=meta or None),
+            args.snapshot_dir, args.collection, force=args.force,
+        )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
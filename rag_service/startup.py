@@ -0,0 +1,74 @@
+"""
+起動の段階ごとの所要時間とウォームアップの状態（/ready）
+
+with startup.phase("chroma_client"): のように囲んだ区間の所要時間をログに出して記録する。
+状態は starting（import中）→ warming（ウォームアップ中）→ ready、ウォームアップに失敗したら failed。
+/health はプロセスが応答するかだけを見るので、トラフィックを流してよいかは ready で判断する。
+"""
+
+from contextlib import contextmanager
+from typing import Optional
+import logging
+import threading
+import time
+
+logger = logging.getLogger("rag_service.startup")
+
+
+class Startup:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.state = "starting"
+        self.error: Optional[str] = None
+        self.ready_after: Optional[float] = None  # 起動から ready までの秒数
+        self.phases: list[dict] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        entry = {"name": name, "seconds": None, "ok": True}
+        try:
+            yield
+        except Exception as e:
+            entry["ok"] = False
+            entry["error"] = str(e)
+            raise
+        finally:
+            entry["seconds"] = round(time.perf_counter() - started, 3)
+            with self._lock:
+                self.phases.append(entry)
+            logger.info("startup phase %s: %.3fs%s", name, entry["seconds"], "" if entry["ok"] else " (failed)")
+
+    def loaded(self, warming: bool) -> None:
+        """appのimportが終わった時に呼ぶ。ウォームアップしないならそのまま ready"""
+        logger.info("app loaded in %.3fs", time.perf_counter() - self.started)
+        if warming:
+            self.state = "warming"
+        else:
+            self.mark_ready()
+
+    def mark_ready(self) -> None:
+        self.ready_after = round(time.perf_counter() - self.started, 3)
+        self.state = "ready"
+        logger.info("ready in %.3fs", self.ready_after)
+
+    def mark_failed(self, error: str) -> None:
+        self.error = error
+        self.state = "failed"
+        logger.error("warm-up failed: %s", error)
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def status(self) -> dict:
+        with self._lock:
+            phases = [dict(p) for p in self.phases]
+        return {
+            "status": self.state,
+            "uptime_sec": round(time.perf_counter() - self.started, 3),
+            "ready_after_sec": self.ready_after,
+            "error": self.error,
+            "phases": phases,
+        }
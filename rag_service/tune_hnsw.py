@@ -0,0 +1,205 @@
+"""
+コレクションのHNSWパラメータのチューニング（オフライン）
+
+コレクションのembeddingを読み込み、そこから抜き出した --samples 件をクエリにして
+厳密な総当たり（quantized.exact_topk）の上位k件を正解とし、次を測る。
+- 現在のコレクション（Chromaのインデックスそのもの）の recall@k とレイテンシ
+- M × construction_ef × search_ef の各組み合わせで hnswlib のインデックスを組み直した時の
+  recall@k・1クエリのレイテンシ（p50/p95）・構築時間
+
+目標の recall@k を満たす組み合わせのうち、p50が最速から5%以内のものの中で M・construction_ef・search_ef が
+最も小さい設定を推奨する。--apply を付けると反映する（M・construction_ef が今と同じなら search_ef の変更だけ、
+違えばコレクションを作り直して全件をembedding込みで移す）。--apply はサービスを止めてから実行すること
+（動いているサービスの search_ef だけを変えるなら PUT /collections/{name}/hnsw を使う）。
+
+  python tune_hnsw.py --collection flow_notes --k 10 --target-recall 0.95
+  python tune_hnsw.py --collection flow_notes --m 16,32 --search-ef 20,40,80 --apply
+
+クエリ自身（距離0の自分）は正解・結果の両方から除いて数える。
+current の行はChromaの検索API経由で測るので、hnswlibを直接呼ぶ他の行とはレイテンシを比べられない（recallを比べる）。
+件数が --max-docs を超えるコレクションは先頭（id順）の --max-docs 件だけで測る。
+"""
+
+from typing import Optional
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chromadb  # noqa: E402
+import hnswlib  # noqa: E402
+from chromadb.config import Settings  # noqa: E402
+
+from chroma_hnsw import HNSW_KEYS, UnsupportedChromaVersion, hnsw_params, rebuild_collection, set_search_ef  # noqa: E402
+from chroma_sqlite import ChromaSQLite  # noqa: E402
+from quantized import BLOCK_ROWS, exact_topk  # noqa: E402
+
+LATENCY_TOLERANCE = 1.05  # 最速のp50からこの倍率以内なら「同じ速さ」とみなして小さい設定を選ぶ
+
+
+def load_matrix(col, db: ChromaSQLite, max_docs: int, page_size: int = 500) -> tuple[list[str], np.ndarray]:
+    ids: list[str] = []
+    rows: list[np.ndarray] = []
+    for page in db.iter_id_pages(str(col.id), page_size):
+        got = col.get(ids=page[:max_docs - len(ids)], include=["embeddings"])
+        ids.extend(got["ids"])
+        rows.append(np.asarray(got["embeddings"], dtype=np.float32))
+        if len(ids) >= max_docs:
+            break
+    if not ids:
+        return [], np.empty((0, 0), dtype=np.float32)
+    return ids, np.concatenate(rows)
+
+
+def ground_truth(matrix: np.ndarray, ids: list[str], queries: np.ndarray, query_ids: list[str], k: int) -> list[list[str]]:
+    """各クエリの厳密な上位k件（クエリ自身を除く）"""
+    pages = ((ids[i:i + BLOCK_ROWS], matrix[i:i + BLOCK_ROWS]) for i in range(0, len(ids), BLOCK_ROWS))
+    exact = exact_topk(queries, pages, k + 1)
+    return [[doc_id for doc_id, _ in hits if doc_id != qid][:k] for hits, qid in zip(exact, query_ids)]
+
+
+def recall(found: list[str], truth: list[str]) -> float:
+    return len(set(found) & set(truth)) / len(truth) if truth else 1.0
+
+
+def measure(search, queries: np.ndarray, query_ids: list[str], truth: list[list[str]], k: int) -> dict:
+    """search(query) → id列 を1件ずつ呼んで recall@k とレイテンシを測る"""
+    latencies, recalls = [], []
+    for q, qid, t in zip(queries, query_ids, truth):
+        started = time.perf_counter()
+        found = search(q)
+        latencies.append(time.perf_counter() - started)
+        recalls.append(recall([i for i in found if i != qid][:k], t))
+    ms = np.asarray(latencies) * 1000
+    return {
+        "recall": round(float(np.mean(recalls)), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+    }
+
+
+def sweep(matrix: np.ndarray, ids: list[str], queries: np.ndarray, query_ids: list[str], truth: list[list[str]],
+          k: int, ms: list[int], construction_efs: list[int], search_efs: list[int]) -> list[dict]:
+    rows = []
+    for m in ms:
+        for construction_ef in construction_efs:
+            index = hnswlib.Index(space="cosine", dim=matrix.shape[1])
+            index.init_index(max_elements=len(ids), ef_construction=construction_ef, M=m)
+            started = time.perf_counter()
+            index.add_items(matrix, np.arange(len(ids)))
+            build_sec = time.perf_counter() - started
+            index.set_num_threads(1)  # サービスの1クエリと同じく1スレッドで測る
+            for search_ef in search_efs:
+                index.set_ef(max(search_ef, k + 1))  # hnswlib は ef < 取得件数 だと結果が欠ける
+
+                def search(q, index=index):
+                    labels, _ = index.knn_query(q, k=min(k + 1, len(ids)))
+                    return [ids[i] for i in labels[0]]
+
+                row = {"M": m, "construction_ef": construction_ef, "search_ef": search_ef,
+                       "build_sec": round(build_sec, 3), **measure(search, queries, query_ids, truth, k)}
+                rows.append(row)
+                print(json.dumps(row), file=sys.stderr)
+    return rows
+
+
+def recommend(rows: list[dict], target: float) -> Optional[dict]:
+    passing = [r for r in rows if r["recall"] >= target]
+    if not passing:
+        return None
+    fastest = min(r["p50_ms"] for r in passing)
+    close = [r for r in passing if r["p50_ms"] <= fastest * LATENCY_TOLERANCE]
+    return min(close, key=lambda r: (r["M"], r["construction_ef"], r["search_ef"]))
+
+
+def apply(client, db: ChromaSQLite, col, current: dict, best: dict) -> str:
+    if best["M"] == current["M"] and best["construction_ef"] == current["construction_ef"]:
+        try:
+            set_search_ef(client, col, best["search_ef"])
+            return f"search_ef {current['search_ef']} -> {best['search_ef']}"
+        except UnsupportedChromaVersion as e:
+            print(f"{e}; rebuilding", file=sys.stderr)  # 作り直しなら公開APIだけで反映できる
+    metadata = {**(col.metadata or {}), **{HNSW_KEYS[k]: best[k] for k in ("M", "construction_ef", "search_ef")}}
+    started = time.perf_counter()
+    rebuild_collection(client, col, metadata, db.iter_id_pages)
+    return f"rebuilt with M={best['M']} construction_ef={best['construction_ef']} search_ef={best['search_ef']} " \
+           f"in {time.perf_counter() - started:.1f}s"
+
+
+def main() -> None:
+    ints = lambda s: [int(x) for x in s.split(",")]  # noqa: E731
+    parser = argparse.ArgumentParser(description="tune HNSW parameters of a rag_service collection")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--chroma-path", default=os.environ.get("CHROMA_PATH", "/data/chroma"))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--samples", type=int, default=200, help="クエリにする件数")
+    parser.add_argument("--max-docs", type=int, default=100000, help="読み込む最大件数")
+    parser.add_argument("--m", type=ints, default=[8, 16, 32])
+    parser.add_argument("--construction-ef", type=ints, default=[64, 100, 200])
+    parser.add_argument("--search-ef", type=ints, default=[10, 20, 40, 80, 160])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果をJSONで書き出すパス")
+    parser.add_argument("--apply", action="store_true", help="推奨設定を反映する（サービス停止中に）")
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(
+        path=args.chroma_path,
+        settings=Settings(anonymized_telemetry=False, chroma_product_telemetry_impl="chroma_telemetry.NoProductTelemetry"),
+    )
+    db = ChromaSQLite(args.chroma_path)
+    col = client.get_collection(args.collection, embedding_function=None)
+    current = hnsw_params(client, col)
+
+    ids, matrix = load_matrix(col, db, args.max_docs)
+    if len(ids) <= args.k:
+        sys.exit(f"{args.collection}: need more than k={args.k} documents (has {len(ids)})")
+    rng = np.random.default_rng(args.seed)
+    picked = rng.choice(len(ids), size=min(args.samples, len(ids)), replace=False)
+    queries, query_ids = matrix[picked], [ids[i] for i in picked]
+    truth = ground_truth(matrix, ids, queries, query_ids, args.k)
+
+    def chroma_search(q):
+        return col.query(query_embeddings=[q], n_results=args.k + 1, include=[])["ids"][0]
+
+    baseline = {**current, **measure(chroma_search, queries, query_ids, truth, args.k)}
+    rows = sweep(matrix, ids, queries, query_ids, truth, args.k, args.m, args.construction_ef, args.search_ef)
+    best = recommend(rows, args.target_recall)
+    report = {
+        "collection": args.collection,
+        "documents": len(ids),
+        "dim": int(matrix.shape[1]),
+        "k": args.k,
+        "samples": len(query_ids),
+        "target_recall": args.target_recall,
+        "current": baseline,
+        "results": rows,
+        "recommended": best,
+    }
+
+    print(f"{args.collection}: {len(ids)} docs, dim={matrix.shape[1]}, k={args.k}, samples={len(query_ids)}")
+    print(f"current  M={current['M']} construction_ef={current['construction_ef']} search_ef={current['search_ef']}: "
+          f"recall={baseline['recall']} p50={baseline['p50_ms']}ms p95={baseline['p95_ms']}ms")
+    print(f"{'M':>4} {'c_ef':>5} {'s_ef':>5} {'recall':>7} {'p50_ms':>8} {'p95_ms':>8} {'build_s':>8}")
+    for r in rows:
+        mark = " *" if r is best else ""
+        print(f"{r['M']:>4} {r['construction_ef']:>5} {r['search_ef']:>5} {r['recall']:>7} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['build_sec']:>8}{mark}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if best is None:
+        print(f"no setting reached recall@{args.k} >= {args.target_recall}; try larger --m / --search-ef")
+        sys.exit(1)
+    print(f"recommended: M={best['M']} construction_ef={best['construction_ef']} search_ef={best['search_ef']}")
+    if args.apply:
+        print("applied:", apply(client, db, col, current, best))
+
+
+if __name__ == "__main__":
+    main()